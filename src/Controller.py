@@ -52,6 +52,8 @@ class Controller:
             self.send_to_view("show_error", data)
         elif mode == "terminal_print":
             self.send_to_view("terminal_print", data)
+        elif mode == "terminal_progress":
+            self.send_to_view("terminal_progress", data)
 
     def send_to_view(self, mode, data):
         """
@@ -45,7 +45,7 @@ class Model:
         mode (str): 操作模式
         data (any): 要發送的數據
         """
-        if mode in ['record_imgs', 'show_error', 'terminal_print']:
+        if mode in ['record_imgs', 'show_error', 'terminal_print', 'terminal_progress']:
             self.controller_callback(mode, data)
 
     def send_to_view_system(self, mode, data=None):
@@ -107,7 +107,7 @@ class Model:
         mode (str): 操作模式
         data (any): 附加數據
         """
-        if mode in ['show_error', 'terminal_print']:
+        if mode in ['show_error', 'terminal_print', 'terminal_progress']:
             self.send_to_controller(mode, data)
 
     def recive_from_view_system(self, mode, data):
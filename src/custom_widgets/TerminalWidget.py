@@ -1,5 +1,6 @@
 import sys
 from PyQt5.QtWidgets import QApplication, QMainWindow, QPlainTextEdit, QVBoxLayout, QWidget
+from PyQt5.QtGui import QTextCursor
 
 class TerminalWidget(QWidget):
     def __init__(self, welcome_message="Welcome", font_size=12, background_color="#000000", parent=None):
@@ -26,6 +27,9 @@ class TerminalWidget(QWidget):
         """)
 
         self.welcome_message = welcome_message
+        # 控制台最後的進度區塊：每個鍵值一行，記錄各行內容與區塊的起始行以便原地更新
+        self.progress_lines = {}
+        self.progress_block = None
 
         self.layout.addWidget(self.console)
         self.layout.setContentsMargins(5, 5, 5, 5)
@@ -45,6 +49,31 @@ class TerminalWidget(QWidget):
         """
         formatted_message = f"[{sender}] {message}"
         self.console.appendPlainText(formatted_message)  # 添加文本到控制台
+        # 一般消息結束目前的進度區塊，之後的進度從新的區塊開始
+        self.progress_lines = {}
+        self.progress_block = None
+
+    def post_progress(self, sender, key, message):
+        """
+        發佈進度消息到控制台。連續的進度消息組成控制台最後的進度區塊，每個鍵值一行，
+        多個階段同時回報時各自更新自己的那一行，而不是交替新增行。
+
+        參數:
+        sender (str): 發送者名稱。
+        key (str): 進度鍵值，例如階段名稱。
+        message (str): 消息內容。
+        """
+        self.progress_lines[(sender, key)] = f"[{sender}] {message}"
+        document = self.console.document()
+        if self.progress_block is None:
+            self.progress_block = document.blockCount()
+        else:
+            # 移除舊的進度區塊（包含前一行結尾的換行）後重新輸出
+            cursor = QTextCursor(document.findBlockByNumber(self.progress_block - 1))
+            cursor.movePosition(QTextCursor.EndOfBlock)
+            cursor.movePosition(QTextCursor.End, QTextCursor.KeepAnchor)
+            cursor.removeSelectedText()
+        self.console.appendPlainText("\n".join(self.progress_lines.values()))
 
 class MainWindow(QMainWindow):
     def __init__(self, font_size=12, background_color="#000000"):
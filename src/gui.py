@@ -12,10 +12,12 @@ class MainInterface(QWidget):
     屬性:
     error_signal (pyqtSignal): 自訂錯誤訊號。
     terminal_print_signal (pyqtSignal): 自訂終端輸出訊號。
+    terminal_progress_signal (pyqtSignal): 自訂終端進度訊號。
     """
 
     error_signal = pyqtSignal(dict)
     terminal_print_signal = pyqtSignal(dict)
+    terminal_progress_signal = pyqtSignal(dict)
 
     def __init__(self, callback_to_view=None):
         """
@@ -56,6 +58,7 @@ class MainInterface(QWidget):
 
         self.error_signal.connect(self.handle_error_signal)
         self.terminal_print_signal.connect(self.handle_terminal_print_signal)
+        self.terminal_progress_signal.connect(self.handle_terminal_progress_signal)
 
         self.init_ui()
         self.init_item()
@@ -235,6 +238,18 @@ class MainInterface(QWidget):
         print_data (dict): 終端輸出數據。
         """
         self.set_terminal_message(print_data["owner"], print_data["message"])
+
+    def handle_terminal_progress_signal(self, progress_data):
+        """
+        處理終端進度訊號。
+
+        參數:
+        progress_data (dict): 終端進度數據。
+        """
+        if self.terminal_widget is None:
+            print(f"{self.terminal_widget} is None")
+            return
+        self.terminal_widget.post_progress(progress_data["owner"], progress_data["key"], progress_data["message"])
     
     def set_sider_bar(self, mode="Home"):
         """
@@ -679,6 +694,8 @@ class MainInterface(QWidget):
             self.error_signal.emit({"title": data["title"], "message": data["message"]})
         elif mode == "terminal_print":
             self.terminal_print_signal.emit({"owner": data["owner"], "message": data["message"]})
+        elif mode == "terminal_progress":
+            self.terminal_progress_signal.emit({"owner": data["owner"], "key": data["key"], "message": data["message"]})
 
     def update_image_display_panel(self, image1_array, image2_array):
         """
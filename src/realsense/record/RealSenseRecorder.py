@@ -69,6 +69,8 @@ class RealSenseRecorder:
         self.path_depth = join(args.output_folder, "depth")
         self.path_color = join(args.output_folder, "color")
         self.path_bag = join(args.output_folder, "realsense.bag")
+        # 錄製影像期間存在的標記檔，run_system 的串流模式據此判斷錄製是否仍在進行
+        self.path_recording_marker = join(args.output_folder, "recording.lock")
         self.is_running = False
         self.is_recording = False
         self.thread = None
@@ -416,6 +418,7 @@ class RealSenseRecorder:
                     if self.is_recording and self.args.record_imgs:
                         if frame_count == 0:
                             self.save_intrinsic_as_json(join(self.path_output, "camera_intrinsic.json"), color_frame)
+                            open(self.path_recording_marker, 'w').close()
                         cv2.imwrite(f"{self.path_depth}/{frame_count:06d}.png", self.depth_image)
                         cv2.imwrite(f"{self.path_color}/{frame_count:06d}.jpg", self.color_image)
                         frame_count += 1
@@ -444,6 +447,8 @@ class RealSenseRecorder:
                     self.pipeline.stop()
                     self.is_running = False
                 self.stop_event.set()  # 設置停止事件
+                if exists(self.path_recording_marker):
+                    os.remove(self.path_recording_marker)
                 if self.args.calculate_overlap:
                     p.join()
             except Exception as e:
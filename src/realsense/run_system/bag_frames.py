@@ -0,0 +1,157 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import open3d as o3d
+
+# 直接讀取 bag 時，幀列表中的每一項是「bag 路徑#串流/幀索引」形式的參照，
+# 而不是影像檔路徑
+BAG_SEPARATOR = "#"
+
+# 每個行程各自開啟 bag 並快取解碼後的幀，片段內的幀對與整合都會重複讀取相同的幀
+_reader = None
+_reader_file = None
+_timestamps = None
+_cache = OrderedDict()
+_lock = threading.Lock()
+_cache_size = 120
+_read_ahead = 30
+
+
+def get_index_name(bag_file):
+    """
+    回傳 bag 的幀索引檔名。
+
+    參數:
+    bag_file (str): bag 檔案路徑。
+    """
+    return os.path.splitext(bag_file)[0] + ".frames.json"
+
+
+def open_bag_dataset(bag_file):
+    """
+    不解出影像檔而直接使用 bag：建立輸出資料夾、相機內參與幀索引。
+    幀索引記錄每一幀的時間戳記，讓工作行程可以直接定位到片段的第一幀；
+    建立索引只需在第一次使用時掃描一次 bag。
+
+    參數:
+    bag_file (str): bag 檔案路徑。
+
+    回傳:
+    tuple: (輸出資料夾, 相機內參檔案路徑, 深度比例)
+    """
+    frames_folder = os.path.splitext(bag_file)[0]
+    os.makedirs(frames_folder, exist_ok=True)
+    path_intrinsic = os.path.join(frames_folder, "intrinsic.json")
+    index_name = get_index_name(bag_file)
+    if not os.path.isfile(index_name):
+        reader = o3d.t.io.RSBagReader()
+        reader.open(bag_file)
+        metadata = reader.metadata
+        o3d.io.write_pinhole_camera_intrinsic(path_intrinsic, metadata.intrinsics)
+        timestamps = []
+        reader.next_frame()
+        while not reader.is_eof():
+            timestamps.append(reader.get_timestamp())
+            reader.next_frame()
+        reader.close()
+        with open(index_name, 'w') as f:
+            json.dump({"depth_scale": metadata.depth_scale, "timestamps": timestamps}, f)
+    with open(index_name) as f:
+        depth_scale = json.load(f)["depth_scale"]
+    return frames_folder, path_intrinsic, depth_scale
+
+
+def read_bag_frame_lists(bag_file):
+    """
+    回傳 bag 中所有幀的彩色與深度參照列表。
+
+    參數:
+    bag_file (str): bag 檔案路徑。
+    """
+    with open(get_index_name(bag_file)) as f:
+        n_frames = len(json.load(f)["timestamps"])
+    color_files = [f"{bag_file}{BAG_SEPARATOR}color/{i:06d}" for i in range(n_frames)]
+    depth_files = [f"{bag_file}{BAG_SEPARATOR}depth/{i:06d}" for i in range(n_frames)]
+    return color_files, depth_files
+
+
+def configure(config):
+    """
+    依配置設定目前行程的幀快取大小與預讀幀數。
+
+    參數:
+    config (dict): 重建配置。
+    """
+    global _cache_size, _read_ahead
+    _cache_size = config["bag_cache_frames"]
+    _read_ahead = config["bag_read_ahead"]
+
+
+def _open(bag_file):
+    global _reader, _reader_file, _timestamps
+    if _reader_file == bag_file:
+        return
+    if _reader is not None:
+        _reader.close()
+    with open(get_index_name(bag_file)) as f:
+        _timestamps = json.load(f)["timestamps"]
+    _reader = o3d.t.io.RSBagReader()
+    _reader.open(bag_file)
+    _reader_file = bag_file
+    _cache.clear()
+
+
+def _read_frame(bag_file, index):
+    key = (bag_file, index)
+    frame = _cache.get(key)
+    if frame is not None:
+        _cache.move_to_end(key)
+        return frame
+    # 快取未命中時定位到該幀，並依序預讀後續的幀
+    _open(bag_file)
+    _reader.seek_timestamp(_timestamps[index])
+    for i in range(index, min(index + _read_ahead, len(_timestamps))):
+        rgbd = _reader.next_frame()
+        if _reader.is_eof():
+            break
+        _cache[(bag_file, i)] = (np.asarray(rgbd.color.to_legacy()), np.asarray(rgbd.depth.to_legacy()))
+        _cache.move_to_end((bag_file, i))
+    while len(_cache) > max(_cache_size, _read_ahead):
+        _cache.popitem(last=False)
+    return _cache[key]
+
+
+def _read_array(path):
+    bag_file, frame = path.rsplit(BAG_SEPARATOR, 1)
+    stream, index = frame.split("/")
+    # 整合階段以多個執行緒預讀，bag 讀取器與快取由鎖保護
+    with _lock:
+        color, depth = _read_frame(bag_file, int(index))
+    return color if stream == "color" else depth
+
+
+def read_image(path):
+    """
+    讀取影像檔或 bag 中的一幀，回傳 open3d.geometry.Image。
+
+    參數:
+    path (str): 影像檔路徑或 bag 幀參照。
+    """
+    if BAG_SEPARATOR not in path:
+        return o3d.io.read_image(path)
+    return o3d.geometry.Image(np.ascontiguousarray(_read_array(path)))
+
+
+def read_tensor_image(path):
+    """
+    讀取影像檔或 bag 中的一幀，回傳 open3d.t.geometry.Image。
+
+    參數:
+    path (str): 影像檔路徑或 bag 幀參照。
+    """
+    if BAG_SEPARATOR not in path:
+        return o3d.t.io.read_image(path)
+    return o3d.t.geometry.Image(o3d.core.Tensor(np.ascontiguousarray(_read_array(path))))
@@ -0,0 +1,469 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import datetime
+import threading
+import multiprocessing
+
+import numpy as np
+import open3d as o3d
+import psutil
+
+# 將當前文件的目錄添加到 sys.path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from run_system import Args_run_system, ReconstructionSystem
+from posegraph_store import read_global_trajectory
+from frame_prepass import read_frame_ids
+
+# 合成序列使用的相機內參（與 PrimeSense 預設值相同）
+WIDTH = 640
+HEIGHT = 480
+FOCAL = 525.0
+
+STAGES = ["make", "register", "refine", "integrate", "slac", "slac_integrate"]
+STAGE_MODULES = {
+    "make": "make_fragments",
+    "register": "register_fragments",
+    "refine": "refine_registration",
+    "integrate": "integrate_scene",
+    "slac": "slac",
+    "slac_integrate": "slac_integrate",
+}
+
+
+def make_textured_plane(origin, u_axis, v_axis, spacing, base_color, rng):
+    """
+    建立以格點三角化的平面，頂點顏色為棋盤格加雜訊的程序紋理，提供特徵點。
+
+    參數:
+    origin (numpy.ndarray): 平面的起點。
+    u_axis (numpy.ndarray): 平面第一個方向的邊向量。
+    v_axis (numpy.ndarray): 平面第二個方向的邊向量。
+    spacing (float): 格點間距（公尺）。
+    base_color (numpy.ndarray): 基本顏色。
+    rng (numpy.random.Generator): 亂數產生器。
+    """
+    nu = max(1, int(np.ceil(np.linalg.norm(u_axis) / spacing)))
+    nv = max(1, int(np.ceil(np.linalg.norm(v_axis) / spacing)))
+    a, b = np.meshgrid(np.linspace(0, 1, nu + 1), np.linspace(0, 1, nv + 1), indexing='ij')
+    vertices = origin + a.reshape(-1, 1) * u_axis + b.reshape(-1, 1) * v_axis
+    index = np.arange((nu + 1) * (nv + 1)).reshape(nu + 1, nv + 1)
+    quads = np.stack([index[:-1, :-1], index[1:, :-1], index[1:, 1:], index[:-1, 1:]], axis=-1).reshape(-1, 4)
+    triangles = np.concatenate([quads[:, [0, 1, 2]], quads[:, [0, 2, 3]]])
+
+    checker = ((np.floor(a * nu / 8) + np.floor(b * nv / 8)) % 2).reshape(-1, 1)
+    noise = rng.uniform(-0.25, 0.25, size=(len(vertices), 1))
+    colors = np.clip(base_color * (0.55 + 0.35 * checker + noise), 0.0, 1.0)
+
+    mesh = o3d.geometry.TriangleMesh(o3d.utility.Vector3dVector(vertices),
+                                     o3d.utility.Vector3iVector(triangles))
+    mesh.vertex_colors = o3d.utility.Vector3dVector(colors)
+    return mesh
+
+
+def make_box(center, size, spacing, base_color, rng, inward=False):
+    """
+    以六個紋理平面組成方盒；inward 為 True 時法向量朝內，用於房間的牆面。
+    """
+    size = np.asarray(size, dtype=np.float64)
+    lo = np.asarray(center, dtype=np.float64) - size / 2.0
+    ex, ey, ez = np.diag(size)
+    faces = [
+        (lo, ey, ex), (lo + ez, ex, ey),
+        (lo, ex, ez), (lo + ey, ez, ex),
+        (lo, ez, ey), (lo + ex, ey, ez),
+    ]
+    mesh = o3d.geometry.TriangleMesh()
+    for origin, u_axis, v_axis in faces:
+        if inward:
+            u_axis, v_axis = v_axis, u_axis
+        mesh += make_textured_plane(origin, u_axis, v_axis, spacing, base_color, rng)
+    return mesh
+
+
+def make_synthetic_scene(seed, spacing=0.02):
+    """
+    以固定亂數種子產生的房間場景：紋理牆面與隨機擺放的方盒。
+
+    參數:
+    seed (int): 亂數種子。
+    spacing (float, optional): 格點間距（公尺）。預設為 0.02。
+    """
+    rng = np.random.default_rng(seed)
+    mesh = make_box([0.0, 0.0, 1.5], [6.0, 4.0, 3.0], spacing,
+                    np.array([0.8, 0.75, 0.65]), rng, inward=True)
+    for _ in range(8):
+        size = rng.uniform(0.2, 0.8, size=3)
+        center = np.array([rng.uniform(-2.5, 2.5), rng.uniform(-1.5, 1.5), size[2] / 2.0])
+        mesh += make_box(center, size, spacing, rng.uniform(0.2, 1.0, size=3), rng)
+    return mesh
+
+
+def make_trajectory(n_frames):
+    """
+    產生相機在房間中央繞圈、朝外觀看牆面的平滑軌跡（相機到世界的變換）。
+
+    參數:
+    n_frames (int): 幀數。
+    """
+    poses = np.zeros((n_frames, 4, 4))
+    for i in range(n_frames):
+        phase = 2.0 * np.pi * i / n_frames
+        center = np.array([0.8 * np.cos(phase), 0.5 * np.sin(phase), 1.4 + 0.1 * np.sin(3.0 * phase)])
+        forward = np.array([np.cos(phase + 0.6), np.sin(phase + 0.6), -0.15])
+        forward /= np.linalg.norm(forward)
+        right = np.cross(forward, [0.0, 0.0, 1.0])
+        right /= np.linalg.norm(right)
+        down = np.cross(forward, right)
+        poses[i, :3, 0] = right
+        poses[i, :3, 1] = down
+        poses[i, :3, 2] = forward
+        poses[i, :3, 3] = center
+        poses[i, 3, 3] = 1.0
+    return poses
+
+
+def render_frame(scene, mesh_arrays, intrinsic_matrix, pose):
+    """
+    以光線投射渲染一幀的彩色圖與深度圖（公尺）。
+
+    參數:
+    scene (o3d.t.geometry.RaycastingScene): 光線投射場景。
+    mesh_arrays (tuple): 網格的 (三角形索引, 頂點顏色)。
+    intrinsic_matrix (numpy.ndarray): 相機內參矩陣。
+    pose (numpy.ndarray): 相機到世界的變換。
+    """
+    triangles, colors = mesh_arrays
+    rays = o3d.t.geometry.RaycastingScene.create_rays_pinhole(
+        intrinsic_matrix=o3d.core.Tensor(intrinsic_matrix),
+        extrinsic_matrix=o3d.core.Tensor(np.linalg.inv(pose)),
+        width_px=WIDTH, height_px=HEIGHT)
+    result = scene.cast_rays(rays)
+    rays = rays.numpy()
+    t_hit = result['t_hit'].numpy()
+    hit = np.isfinite(t_hit)
+
+    # 光線距離換算為沿相機光軸的深度
+    points = rays[..., :3] + rays[..., 3:] * np.where(hit, t_hit, 0.0)[..., None]
+    depth = np.where(hit, (points - pose[:3, 3]) @ pose[:3, 2], 0.0)
+
+    primitive_ids = np.where(hit, result['primitive_ids'].numpy(), 0).astype(np.int64)
+    uv = result['primitive_uvs'].numpy()
+    corners = triangles[primitive_ids]
+    color = ((1.0 - uv[..., :1] - uv[..., 1:]) * colors[corners[..., 0]] +
+             uv[..., :1] * colors[corners[..., 1]] + uv[..., 1:] * colors[corners[..., 2]])
+    color = np.where(hit[..., None], color, 0.0)
+    return (color * 255.0).round().astype(np.uint8), depth.astype(np.float32)
+
+
+def make_synthetic_dataset(path_dataset, n_frames, seed):
+    """
+    渲染合成 RGBD 序列並寫出彩色圖、深度圖、相機內參、真值軌跡與真值網格。
+
+    參數:
+    path_dataset (str): 數據集輸出路徑。
+    n_frames (int): 幀數。
+    seed (int): 亂數種子。
+    """
+    os.makedirs(os.path.join(path_dataset, "color"), exist_ok=True)
+    os.makedirs(os.path.join(path_dataset, "depth"), exist_ok=True)
+    mesh = make_synthetic_scene(seed)
+    poses = make_trajectory(n_frames)
+
+    intrinsic = o3d.camera.PinholeCameraIntrinsic(WIDTH, HEIGHT, FOCAL, FOCAL,
+                                                  (WIDTH - 1) / 2.0, (HEIGHT - 1) / 2.0)
+    scene = o3d.t.geometry.RaycastingScene()
+    scene.add_triangles(o3d.t.geometry.TriangleMesh.from_legacy(mesh))
+    mesh_arrays = (np.asarray(mesh.triangles), np.asarray(mesh.vertex_colors))
+    for i, pose in enumerate(poses):
+        color, depth = render_frame(scene, mesh_arrays, intrinsic.intrinsic_matrix, pose)
+        o3d.io.write_image(os.path.join(path_dataset, "color", f"{i:05d}.png"), o3d.geometry.Image(color))
+        o3d.io.write_image(os.path.join(path_dataset, "depth", f"{i:05d}.png"),
+                           o3d.geometry.Image((depth * 1000.0).round().astype(np.uint16)))
+
+    o3d.io.write_pinhole_camera_intrinsic(os.path.join(path_dataset, "intrinsic.json"), intrinsic)
+    o3d.io.write_triangle_mesh(os.path.join(path_dataset, "ground_truth.ply"), mesh)
+    np.save(os.path.join(path_dataset, "ground_truth_poses.npy"), poses)
+    return mesh, poses
+
+
+class ResourceMonitor:
+    def __init__(self, interval=0.05):
+        """
+        初始化 ResourceMonitor 類別，量測主行程與所有子行程的牆鐘時間、CPU 時間與峰值 RSS。
+
+        參數:
+        interval (float, optional): 取樣 RSS 的間隔秒數。預設為 0.05。
+        """
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _processes(self):
+        try:
+            return [self.process] + self.process.children(recursive=True)
+        except psutil.Error:
+            return [self.process]
+
+    def _cpu_time(self):
+        total = 0.0
+        for process in self._processes():
+            try:
+                times = process.cpu_times()
+            except psutil.Error:
+                continue
+            total += times.user + times.system
+            # 已結束並回收的子行程（例如階段暫時建立的行程池）計入 children 欄位
+            total += getattr(times, "children_user", 0.0) + getattr(times, "children_system", 0.0)
+        return total
+
+    def _sample(self):
+        while not self._stop.is_set():
+            rss = 0
+            for process in self._processes():
+                try:
+                    rss += process.memory_info().rss
+                except psutil.Error:
+                    pass
+            self.peak_rss = max(self.peak_rss, rss)
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """
+        開始量測。
+        """
+        self._start_wall = time.perf_counter()
+        self._start_cpu = self._cpu_time()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        停止量測並回傳結果。
+        """
+        self._stop.set()
+        self._thread.join()
+        return {
+            "wall_time": time.perf_counter() - self._start_wall,
+            "cpu_time": self._cpu_time() - self._start_cpu,
+            "peak_rss_mb": self.peak_rss / 1024.0 ** 2,
+        }
+
+
+class BenchmarkSystem(ReconstructionSystem):
+    def __init__(self, args):
+        """
+        初始化 BenchmarkSystem 類別，以無介面方式執行重建系統並量測每個階段。
+
+        參數:
+        args (Args_run_system): 配置參數。
+        """
+        super().__init__(args)
+        self.stage_metrics = {}
+
+    def execute_step(self, module_name, function_name, index, stop_event=None, message_queue=None):
+        monitor = ResourceMonitor()
+        monitor.start()
+        super().execute_step(module_name, function_name, index, stop_event, message_queue)
+        self.stage_metrics[module_name] = monitor.stop()
+
+
+def align_trajectories(estimated, ground_truth):
+    """
+    以 Umeyama 方法求出將估計相機中心對齊到真值的剛體變換。
+
+    參數:
+    estimated (numpy.ndarray): 估計的相機中心，形狀為 (N, 3)。
+    ground_truth (numpy.ndarray): 真值的相機中心，形狀為 (N, 3)。
+    """
+    mu_e = estimated.mean(axis=0)
+    mu_g = ground_truth.mean(axis=0)
+    covariance = (ground_truth - mu_g).T @ (estimated - mu_e) / len(estimated)
+    u, _, vt = np.linalg.svd(covariance)
+    s = np.identity(3)
+    if np.linalg.det(u) * np.linalg.det(vt) < 0:
+        s[2, 2] = -1.0
+    transformation = np.identity(4)
+    transformation[:3, :3] = u @ s @ vt
+    transformation[:3, 3] = mu_g - transformation[:3, :3] @ mu_e
+    return transformation
+
+
+def evaluate_trajectory(frame_ids, poses, ground_truth_poses):
+    """
+    計算對齊後的絕對軌跡誤差（公尺）。
+    """
+    estimated = poses[:, :3, 3]
+    ground_truth = ground_truth_poses[frame_ids, :3, 3]
+    alignment = align_trajectories(estimated, ground_truth)
+    aligned = estimated @ alignment[:3, :3].T + alignment[:3, 3]
+    errors = np.linalg.norm(aligned - ground_truth, axis=1)
+    return alignment, {
+        "ate_rmse": float(np.sqrt(np.mean(errors ** 2))),
+        "ate_mean": float(errors.mean()),
+        "ate_max": float(errors.max()),
+        "n_frames": int(len(errors)),
+    }
+
+
+def evaluate_surface(mesh, alignment, ground_truth_mesh, threshold, n_samples=200000):
+    """
+    計算重建表面與真值表面之間的準確度與完整度。
+
+    參數:
+    mesh (o3d.geometry.TriangleMesh): 重建的網格。
+    alignment (numpy.ndarray): 估計座標系到真值座標系的變換。
+    ground_truth_mesh (o3d.geometry.TriangleMesh): 真值網格。
+    threshold (float): 判定為正確重建的距離門檻（公尺）。
+    n_samples (int, optional): 兩個表面各取樣的點數。預設為 200000。
+    """
+    if len(mesh.triangles) == 0:
+        return {"accuracy_mean": None, "precision": 0.0, "recall": 0.0, "threshold": threshold}
+    o3d.utility.random.seed(0)
+    mesh = o3d.geometry.TriangleMesh(mesh).transform(alignment)
+    reconstructed = mesh.sample_points_uniformly(n_samples)
+    scene = o3d.t.geometry.RaycastingScene()
+    scene.add_triangles(o3d.t.geometry.TriangleMesh.from_legacy(ground_truth_mesh))
+    accuracy = scene.compute_distance(
+        o3d.core.Tensor(np.asarray(reconstructed.points), o3d.core.float32)).numpy()
+
+    # 完整度以整個真值表面計算，包含軌跡看不到的面，適合用於不同執行之間的相對比較
+    ground_truth = ground_truth_mesh.sample_points_uniformly(n_samples)
+    completeness = np.asarray(ground_truth.compute_point_cloud_distance(reconstructed))
+    return {
+        "accuracy_mean": float(accuracy.mean()),
+        "accuracy_median": float(np.median(accuracy)),
+        "accuracy_rmse": float(np.sqrt(np.mean(accuracy ** 2))),
+        "precision": float(np.mean(accuracy < threshold)),
+        "recall": float(np.mean(completeness < threshold)),
+        "threshold": threshold,
+    }
+
+
+def write_config(path_config, path_dataset, overrides):
+    """
+    寫出基準測試使用的重建配置。
+    """
+    config = {
+        "name": "Synthetic benchmark",
+        "path_dataset": os.path.relpath(path_dataset),
+        "path_intrinsic": os.path.join(os.path.relpath(path_dataset), "intrinsic.json"),
+        "depth_scale": 1000.0,
+        "depth_max": 3.0,
+    }
+    config.update(overrides)
+    with open(path_config, 'w') as f:
+        json.dump(config, f, indent=4)
+
+
+def run_benchmark(args):
+    """
+    產生合成數據集、執行指定的重建階段並回傳量測結果。
+
+    參數:
+    args (argparse.Namespace): 命令列參數。
+    """
+    path_dataset = os.path.abspath(args.dataset)
+    ground_truth_poses_file = os.path.join(path_dataset, "ground_truth_poses.npy")
+    start_time = time.perf_counter()
+    if args.regenerate or not os.path.isfile(ground_truth_poses_file):
+        ground_truth_mesh, ground_truth_poses = make_synthetic_dataset(path_dataset, args.frames, args.seed)
+    else:
+        ground_truth_mesh = o3d.io.read_triangle_mesh(os.path.join(path_dataset, "ground_truth.ply"))
+        ground_truth_poses = np.load(ground_truth_poses_file)
+    render_time = time.perf_counter() - start_time
+
+    overrides = json.loads(args.overrides) if args.overrides else {}
+    path_config = os.path.join(path_dataset, "benchmark_config.json")
+    write_config(path_config, path_dataset, overrides)
+
+    stages = args.stages.split(",")
+    system = BenchmarkSystem(Args_run_system(config=path_config, **{stage: True for stage in stages}))
+    system.execute()
+    system.monitor_thread.join()
+
+    results = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "open3d": o3d.__version__,
+        "cpu_count": multiprocessing.cpu_count(),
+        "n_frames": int(len(ground_truth_poses)),
+        "seed": args.seed,
+        "render_time": render_time,
+        "overrides": overrides,
+        "stages": {stage: system.stage_metrics.get(STAGE_MODULES[stage]) for stage in stages},
+    }
+
+    config = system.config
+    if "refine" in stages or "integrate" in stages:
+        frame_ids, _, poses = read_global_trajectory(config["path_dataset"], config)
+        # 軌跡的幀索引指向縮減後的幀列表，比對前換回原始幀索引
+        frame_ids = read_frame_ids(config)[frame_ids]
+        alignment, results["trajectory"] = evaluate_trajectory(frame_ids, poses, ground_truth_poses)
+        mesh_name = os.path.join(config["path_dataset"], config["template_global_mesh"])
+        if "integrate" in stages and os.path.isfile(mesh_name):
+            results["surface"] = evaluate_surface(o3d.io.read_triangle_mesh(mesh_name), alignment,
+                                                  ground_truth_mesh, args.threshold)
+    return results
+
+
+def compare_results(results, baseline):
+    """
+    以文字列出與先前結果相比的各階段時間與準確度變化。
+    """
+    lines = []
+    for stage, metrics in results["stages"].items():
+        previous = baseline.get("stages", {}).get(stage)
+        if metrics is None or previous is None:
+            continue
+        for key in ("wall_time", "cpu_time", "peak_rss_mb"):
+            ratio = metrics[key] / previous[key] if previous[key] else float("nan")
+            lines.append(f"{stage:16} {key:12} {previous[key]:10.2f} -> {metrics[key]:10.2f} ({ratio:.2f}x)")
+    for section in ("trajectory", "surface"):
+        for key, value in results.get(section, {}).items():
+            previous = baseline.get(section, {}).get(key)
+            if previous is not None:
+                lines.append(f"{section:16} {key:12} {previous:10.4f} -> {value:10.4f}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark the Reconstruction System on a synthetic RGBD sequence')
+    parser.add_argument('--dataset', type=str, default='benchmark/synthetic',
+                        help='folder of the rendered dataset, reused if it exists')
+    parser.add_argument('--frames', type=int, default=300,
+                        help='number of frames to render')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the procedural scene')
+    parser.add_argument('--regenerate', action='store_true',
+                        help='render the dataset again even if it exists')
+    parser.add_argument('--stages', type=str, default='make,register,refine,integrate',
+                        help='comma separated stages among ' + ','.join(STAGES))
+    parser.add_argument('--overrides', type=str, default=None,
+                        help='JSON object of config values to override')
+    parser.add_argument('--threshold', type=float, default=0.02,
+                        help='distance threshold of the surface metrics in meters')
+    parser.add_argument('--output', type=str, default='benchmark/results.json',
+                        help='JSON file the results are written to')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='previous results JSON to compare against')
+    args = parser.parse_args()
+
+    for stage in args.stages.split(","):
+        assert stage in STAGES, f"Unknown stage {stage}"
+    results = run_benchmark(args)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=4)
+    print(json.dumps(results, indent=4))
+    if args.compare is not None:
+        with open(args.compare) as f:
+            print(compare_results(results, json.load(f)))
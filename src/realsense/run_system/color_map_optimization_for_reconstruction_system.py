@@ -15,6 +15,8 @@ pyexample_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(pyexample_path)
 from open3d_example import *
 from initialize_config import initialize_config
+from frame_prepass import read_frame_lists
+from bag_frames import read_image
 
 
 def parse_keys(filename):
@@ -62,7 +64,7 @@ def main(config, keys):
     path = config["path_dataset"]
 
     # Read RGBD images
-    color_files, depth_files = get_rgbd_file_lists(path)
+    color_files, depth_files = read_frame_lists(config)
     if len(color_files) != len(depth_files):
         raise ValueError(
             "The number of color images {} must equal to the number of depth images {}."
@@ -95,8 +97,8 @@ def main(config, keys):
     # Load images
     rgbd_images = []
     for i in range(len(depth_files)):
-        depth = o3d.io.read_image(os.path.join(depth_files[i]))
-        color = o3d.io.read_image(os.path.join(color_files[i]))
+        depth = read_image(depth_files[i])
+        color = read_image(color_files[i])
         rgbd_image = o3d.geometry.RGBDImage.create_from_color_and_depth(
             color,
             depth,
@@ -0,0 +1,249 @@
+import os
+import json
+import math
+import time
+import itertools
+
+import numpy as np
+
+from worker_pool import plan_pool_size
+
+STAGES = ["make_fragments", "register_fragments", "refine_registration",
+          "integrate_scene", "slac", "slac_integrate"]
+
+# 未校準時每個工作單位的預設秒數，只用於還沒有任何歷史紀錄的機器；
+# 有紀錄後以實際與預測時間的比例校準
+DEFAULT_SECONDS_PER_UNIT = {
+    "make_fragments": 0.05,
+    "register_fragments": 2.0,
+    "refine_registration": 1.0,
+    "integrate_scene": 0.02,
+    "slac": 0.5,
+    "slac_integrate": 0.03,
+}
+
+# 時間預算模式可調整的參數與候選值，依品質由高到低排列
+CANDIDATES = {
+    "tsdf_cubic_size": [1.5, 3.0, 4.5, 6.0],
+    "voxel_size": [0.03, 0.05, 0.075, 0.1],
+    "n_keyframes_per_n_frame": [3, 5, 10, 20],
+    "ransac_max_iteration": [1000000, 300000, 100000],
+}
+# 各參數對重建品質的相對重要性，用於比較候選組合
+QUALITY_WEIGHTS = {
+    "tsdf_cubic_size": 3.0,
+    "voxel_size": 2.0,
+    "n_keyframes_per_n_frame": 1.0,
+    "ransac_max_iteration": 0.5,
+}
+# 由候選參數推導的配置值，initialize_config 以相同方式設定預設值；
+# 時間預算改變參數後需重新計算，否則各階段讀寫的路徑不一致
+DERIVED_VALUES = {
+    "subfolder_slac": lambda config: "slac/%0.3f/" % config["voxel_size"],
+}
+
+
+def stage_work(stage, n_frames, params):
+    """
+    以參數估計階段的工作量（無單位），時間與工作量成正比。
+
+    參數:
+    stage (str): 階段模組名稱。
+    n_frames (int): 幀數。
+    params (dict): 重建參數。
+    """
+    n_fragments = max(1, math.ceil(n_frames / params["n_frames_per_fragment"]))
+    # TSDF 每幀的工作量約與視野內體素數成正比，以 tsdf_cubic_size = 3 為基準
+    integration = (3.0 / params["tsdf_cubic_size"]) ** 2
+    # 配準的工作量約與降採樣後的點數成正比，以 voxel_size = 0.05 為基準
+    points = (0.05 / params["voxel_size"]) ** 2
+    if stage == "make_fragments":
+        n_keyframes = n_frames / params["n_keyframes_per_n_frame"]
+        n_loops = n_fragments * (n_keyframes / n_fragments) ** 2 / 2.0
+        return n_frames + 3.0 * n_loops + n_frames * integration
+    if stage == "register_fragments":
+        ransac = 0.5 + 0.5 * min(1.0, params["ransac_max_iteration"] / 1000000.0)
+        return n_fragments * (n_fragments - 1) / 2.0 * points * ransac
+    if stage == "refine_registration":
+        return 2.0 * n_fragments * points
+    if stage == "integrate_scene":
+        return n_frames * integration
+    if stage == "slac":
+        return n_fragments * points * params["max_iterations"]
+    if stage == "slac_integrate":
+        return n_frames * integration
+    raise ValueError(f"Unknown stage {stage}")
+
+
+def get_history_name(config):
+    """
+    回傳本機的階段時間紀錄檔路徑；紀錄跨資料集共用，因此預設位於使用者目錄。
+
+    參數:
+    config (dict): 重建配置。
+    """
+    return os.path.expanduser(config["cost_history"]) if config["cost_history"] else ""
+
+
+def read_history(filename):
+    """
+    讀取過去執行的階段時間紀錄。
+
+    參數:
+    filename (str): 紀錄檔路徑（JSON Lines）。
+    """
+    if not filename or not os.path.isfile(filename):
+        return []
+    history = []
+    with open(filename) as f:
+        for line in f:
+            try:
+                history.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return history
+
+
+class CostModel:
+    def __init__(self, history, processes):
+        """
+        初始化 CostModel 類別，以本機過去執行的實際時間校準每個階段的單位成本。
+
+        參數:
+        history (list): read_history 回傳的紀錄。
+        processes (int): 工作行程數量。
+        """
+        self.processes = max(1, processes)
+        self.seconds_per_unit = dict(DEFAULT_SECONDS_PER_UNIT)
+        self.n_samples = {stage: 0 for stage in STAGES}
+        for stage in STAGES:
+            # 以最近紀錄的單位成本中位數校準，較能抵抗個別異常的執行
+            samples = [record["seconds_per_unit"] for record in history[-200:]
+                       if record["stage"] == stage and record["seconds_per_unit"] > 0]
+            if samples:
+                self.seconds_per_unit[stage] = float(np.median(samples[-20:]))
+                self.n_samples[stage] = len(samples)
+
+    def predict(self, stage, n_frames, params):
+        """
+        預測階段的執行時間（秒）。
+
+        參數:
+        stage (str): 階段模組名稱。
+        n_frames (int): 幀數。
+        params (dict): 重建參數。
+        """
+        return self.seconds_per_unit[stage] * stage_work(stage, n_frames, params) / self.processes
+
+    def predict_all(self, stages, n_frames, params):
+        """
+        預測多個階段的執行時間，回傳 {階段: 秒數}。
+
+        參數:
+        stages (list): 階段模組名稱。
+        n_frames (int): 幀數。
+        params (dict): 重建參數。
+        """
+        return {stage: self.predict(stage, n_frames, params) for stage in stages}
+
+
+def quality(params):
+    """
+    候選參數組合的品質分數，數值越小品質越高。
+
+    參數:
+    params (dict): 重建參數。
+    """
+    return sum(QUALITY_WEIGHTS[key] * CANDIDATES[key].index(params[key])
+               for key in CANDIDATES if params[key] in CANDIDATES[key])
+
+
+def choose_profile(config, stages, n_frames, model):
+    """
+    在時間預算內選擇品質最高的參數組合。time_budget_fixed 列出的參數保持配置值；
+    沒有組合符合預算時選擇預測時間最短的組合。
+
+    參數:
+    config (dict): 重建配置。
+    stages (list): 要執行的階段模組名稱。
+    n_frames (int): 幀數。
+    model (CostModel): 成本模型。
+
+    回傳:
+    tuple: (參數, 各階段預測時間)
+    """
+    keys = [key for key in CANDIDATES if key not in config["time_budget_fixed"]]
+    best = None
+    fastest = None
+    for values in itertools.product(*(CANDIDATES[key] for key in keys)):
+        params = dict(config)
+        params.update(zip(keys, values))
+        predicted = model.predict_all(stages, n_frames, params)
+        total = sum(predicted.values())
+        if fastest is None or total < fastest[0]:
+            fastest = (total, params, predicted)
+        if total <= config["time_budget_s"] and (best is None or quality(params) < best[0]):
+            best = (quality(params), params, predicted)
+    _, params, predicted = best if best is not None else fastest
+    return {key: params[key] for key in keys}, predicted
+
+
+def apply_time_budget(config, stages, n_frames, message_queue):
+    """
+    依時間預算選擇參數並寫入配置，重新計算由參數推導的配置值，開始前回報各階段的預測時間。
+
+    參數:
+    config (dict): 重建配置。
+    stages (list): 要執行的階段模組名稱。
+    n_frames (int): 幀數。
+    message_queue (ProgressChannel): 進度通道。
+
+    回傳:
+    dict: 各階段預測時間。
+    """
+    model = CostModel(read_history(get_history_name(config)), plan_pool_size(config))
+    params, predicted = choose_profile(config, stages, n_frames, model)
+    # 與舊參數推導結果不同的值是使用者明確設定的，保持不變
+    derived = [key for key, derive in DERIVED_VALUES.items()
+               if key in config and config[key] == derive(config)]
+    config.update(params)
+    for key in derived:
+        config[key] = DERIVED_VALUES[key](config)
+    message_queue.put(f"Time budget :: {config['time_budget_s']:.0f} s for {n_frames} frames, "
+                      f"predicted {sum(predicted.values()):.0f} s")
+    for key, value in params.items():
+        message_queue.put(f"Time budget :: {key} = {value}")
+    for stage, seconds in predicted.items():
+        calibrated = "calibrated" if model.n_samples[stage] else "default cost"
+        message_queue.put(f"Time budget :: {stage:20} predicted {seconds:.0f} s ({calibrated})")
+    return predicted
+
+
+def record_run(config, stage_times, n_frames, predicted=None):
+    """
+    將本次執行各階段的實際時間與預測時間附加到紀錄檔，供之後的執行校準成本模型。
+
+    參數:
+    config (dict): 重建配置。
+    stage_times (dict): {階段: 實際秒數}，只包含完整執行的階段。
+    n_frames (int): 幀數。
+    predicted (dict, optional): {階段: 預測秒數}。預設為 None。
+    """
+    filename = get_history_name(config)
+    if not filename:
+        return
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    processes = max(1, plan_pool_size(config))
+    with open(filename, 'a') as f:
+        for stage, seconds in stage_times.items():
+            work = stage_work(stage, n_frames, config)
+            f.write(json.dumps({
+                "time": time.time(),
+                "stage": stage,
+                "n_frames": n_frames,
+                "params": {key: config[key] for key in CANDIDATES},
+                "processes": processes,
+                "actual": seconds,
+                "predicted": None if predicted is None else predicted.get(stage),
+                "seconds_per_unit": seconds * processes / work if work > 0 else 0.0,
+            }) + "\n")
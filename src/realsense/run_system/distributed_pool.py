@@ -0,0 +1,527 @@
+import os
+import sys
+import json
+import time
+import uuid
+import pickle
+import socket
+import argparse
+import threading
+import traceback
+import multiprocessing
+
+# 將當前文件的目錄添加到 sys.path，工作行程才能以模組名稱載入各階段
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import profiling
+from progress import ProgressChannel
+from worker_pool import (StageStats, schedule_by_cost, set_shared, stop_requested, thread_environment,
+                         _init_worker, _run_task)
+
+# 共享資料夾中的工作佇列結構，多個協調者可以共用同一個佇列與同一批工作者：
+#   runs/<執行編號>          協調者的心跳檔
+#   runs/<執行編號>.pkl      該次執行的共享狀態（配置與幀列表）
+#   tasks/<編號>.task        等待認領的工作，編號以執行編號開頭
+#   leases/<編號>.<工作者>.lease  已認領的工作，工作者定期更新修改時間
+#   results/<編號>.result    完成的工作結果
+#   events/<執行編號>.<工作者>.jsonl  工作者送出的進度事件
+#   workers/<工作者>          工作者的心跳檔
+#   stop-<執行編號>          停止事件
+FOLDERS = ["runs", "tasks", "leases", "results", "events", "workers"]
+
+
+class FileEvent:
+    def __init__(self, filename, interval=1.0):
+        """
+        初始化 FileEvent 類別，以共享資料夾中的檔案取代跨主機無法使用的停止事件。
+
+        參數:
+        filename (str): 停止檔路徑。
+        interval (float, optional): 重新檢查檔案的間隔秒數。預設為 1.0。
+        """
+        self.filename = filename
+        self.interval = interval
+        self._checked = 0.0
+        self._set = False
+
+    def is_set(self):
+        # 工作會逐幀檢查停止事件，因此只每隔 interval 秒查看一次檔案
+        if not self._set and time.time() - self._checked >= self.interval:
+            self._checked = time.time()
+            self._set = os.path.exists(self.filename)
+        return self._set
+
+    def set(self):
+        open(self.filename, 'w').close()
+        self._set = True
+
+
+class FolderQueue:
+    def __init__(self, filename):
+        """
+        初始化 FolderQueue 類別，將進度通道的事件附加到共享資料夾中的檔案，
+        由協調者讀取後轉送到本機的進度通道。
+
+        參數:
+        filename (str): 事件檔路徑（JSON Lines）。
+        """
+        self.filename = filename
+        self._lock = threading.Lock()
+
+    def put(self, event):
+        with self._lock:
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(event) + "\n")
+
+    def empty(self):
+        return True
+
+
+def _write_atomic(filename, data):
+    # 先寫入暫存檔再改名，其他主機不會讀到寫到一半的檔案
+    tmp_name = f"{filename}.{socket.gethostname()}-{os.getpid()}.tmp"
+    with open(tmp_name, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_name, filename)
+
+
+def _task_id(name):
+    return name.split(".", 1)[0]
+
+
+def _run_id(name):
+    return name.split("-", 1)[0].split(".", 1)[0]
+
+
+class SharedFolderPool:
+    def __init__(self, config, shared):
+        """
+        初始化 SharedFolderPool 類別，將階段的工作發布到共享檔案系統上的佇列，
+        由任意主機上以 distributed_pool.py worker 啟動的工作行程認領執行，
+        介面與 WorkerPool 相同，各階段因此不需修改。
+
+        所有主機必須以相同的路徑看到資料集與佇列資料夾。
+
+        參數:
+        config (dict): 重建配置。
+        shared (dict): 共享狀態。
+        """
+        self.config = config
+        self.shared = shared
+        self.queue_dir = config["distributed_queue"]
+        self.poll_interval = config["distributed_poll_interval"]
+        self.lease_timeout = config["distributed_lease_timeout"]
+        self.threads = config["worker_threads"]
+        self.stats = StageStats("setup")
+        self.run_id = uuid.uuid4().hex[:12]
+        self._seq = 0
+        self._done = {}
+        self._event_offsets = {}
+        self._lock = threading.Lock()
+        start_time = time.time()
+        for folder in FOLDERS:
+            os.makedirs(os.path.join(self.queue_dir, folder), exist_ok=True)
+        # 其他協調者可能正在使用同一個佇列，只清除心跳已過期的執行留下的檔案
+        self._remove_stale_runs()
+        self.run_file = os.path.join(self.queue_dir, "runs", self.run_id)
+        open(self.run_file, 'w').close()
+        self._closed = False
+        threading.Thread(target=self._heartbeat, args=(max(0.5, self.lease_timeout / 3.0),), daemon=True).start()
+        remote_shared = {
+            "config": config,
+            "color_files": shared["color_files"],
+            "depth_files": shared["depth_files"],
+        }
+        _write_atomic(os.path.join(self.queue_dir, "runs", f"{self.run_id}.pkl"),
+                      pickle.dumps(remote_shared, protocol=pickle.HIGHEST_PROTOCOL))
+        self.stop_file = os.path.join(self.queue_dir, f"stop-{self.run_id}")
+        self.startup_time = time.time() - start_time
+        set_shared(shared)
+
+    def _heartbeat(self, interval):
+        while not self._closed:
+            try:
+                os.utime(self.run_file)
+            except FileNotFoundError:
+                pass
+            time.sleep(interval)
+
+    def _remove_run(self, run_id, keep_stop=False):
+        # 移除一次執行在佇列中的檔案；停止檔可以保留，讓仍在執行的工作者看到停止事件
+        for folder in ("tasks", "leases", "results", "events"):
+            path = os.path.join(self.queue_dir, folder)
+            for name in os.listdir(path):
+                if _run_id(name) == run_id:
+                    try:
+                        os.remove(os.path.join(path, name))
+                    except FileNotFoundError:
+                        pass
+        names = [os.path.join("runs", f"{run_id}.pkl"), os.path.join("runs", run_id)]
+        if not keep_stop:
+            names.append(f"stop-{run_id}")
+        for name in names:
+            try:
+                os.remove(os.path.join(self.queue_dir, name))
+            except FileNotFoundError:
+                pass
+
+    def _remove_stale_runs(self):
+        now = time.time()
+        active = set()
+        folder = os.path.join(self.queue_dir, "runs")
+        for name in os.listdir(folder):
+            try:
+                if "." not in name and now - os.path.getmtime(os.path.join(folder, name)) < self.lease_timeout:
+                    active.add(name)
+            except FileNotFoundError:
+                pass
+        stale = {name[len("stop-"):] for name in os.listdir(self.queue_dir) if name.startswith("stop-")}
+        for folder in ("runs", "tasks", "leases", "results", "events"):
+            stale.update(_run_id(name) for name in os.listdir(os.path.join(self.queue_dir, folder)))
+        for run_id in stale - active:
+            self._remove_run(run_id)
+
+    @property
+    def processes(self):
+        """
+        回傳心跳未過期的工作者數量（至少為 1）。
+        """
+        now = time.time()
+        folder = os.path.join(self.queue_dir, "workers")
+        n_alive = 0
+        for name in os.listdir(folder):
+            try:
+                if now - os.path.getmtime(os.path.join(folder, name)) < self.lease_timeout:
+                    n_alive += 1
+            except FileNotFoundError:
+                pass
+        return max(1, n_alive)
+
+    def plan_stage(self, n_tasks):
+        """
+        記錄階段的計畫；工作者數量與每個工作者的執行緒數由各主機啟動時決定。
+
+        參數:
+        n_tasks (int): 階段的工作數量。
+        """
+        processes = self.processes
+        self.shared["message_queue"].put(
+            f"Parallel plan :: {self.stats.name}: {n_tasks} tasks on {processes} distributed workers "
+            f"({self.queue_dir})")
+        return processes, self.threads
+
+    def begin_stage(self, name):
+        """
+        開始記錄新階段的統計。
+
+        參數:
+        name (str): 階段名稱。
+        """
+        self.stats = StageStats(name)
+        return self.stats
+
+    def _publish(self, function, args):
+        start_time = time.perf_counter()
+        payload = pickle.dumps((function, args), protocol=pickle.HIGHEST_PROTOCOL)
+        self.stats.pickle_time += time.perf_counter() - start_time
+        self.stats.pickle_bytes += len(payload)
+        self.stats.n_tasks += 1
+        # 編號依發布順序遞增，工作者依名稱順序認領，預測成本高的工作因此先執行
+        task_id = f"{self.run_id}-{self._seq:08d}"
+        self._seq += 1
+        _write_atomic(os.path.join(self.queue_dir, "tasks", f"{task_id}.task"), payload)
+        return task_id
+
+    def _expire_leases(self):
+        # 心跳逾時的工作者視為已當機，將工作放回佇列
+        folder = os.path.join(self.queue_dir, "leases")
+        now = time.time()
+        for name in os.listdir(folder):
+            if _run_id(name) != self.run_id:
+                continue
+            path = os.path.join(folder, name)
+            try:
+                if now - os.path.getmtime(path) > self.lease_timeout:
+                    os.rename(path, os.path.join(self.queue_dir, "tasks", f"{_task_id(name)}.task"))
+                    self.shared["message_queue"].put(
+                        f"Distributed :: lease {name} expired, task returned to the queue")
+            except FileNotFoundError:
+                pass
+
+    def _forward_events(self):
+        folder = os.path.join(self.queue_dir, "events")
+        message_queue = self.shared["message_queue"]
+        for name in os.listdir(folder):
+            if _run_id(name) != self.run_id:
+                continue
+            path = os.path.join(folder, name)
+            offset = self._event_offsets.get(name, 0)
+            with open(path) as f:
+                f.seek(offset)
+                data = f.read()
+            # 只處理完整的行，最後一行可能還在寫入
+            end = data.rfind("\n") + 1
+            self._event_offsets[name] = offset + end
+            for line in data[:end].splitlines():
+                event = json.loads(line)
+                if event[0] == "progress":
+                    event[1] = [tuple(item) for item in event[1]]
+                message_queue.queue.put(tuple(event))
+
+    def _collect(self):
+        folder = os.path.join(self.queue_dir, "results")
+        for name in sorted(os.listdir(folder)):
+            # 其他協調者的結果由它們自己讀取
+            if not name.endswith(".result") or _run_id(name) != self.run_id:
+                continue
+            task_id = _task_id(name)
+            path = os.path.join(folder, name)
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+            os.remove(path)
+            if task_id in self._done:
+                # 過期後被重新執行的工作可能產生重複的結果
+                continue
+            self._done[task_id] = result
+            # 移除工作過期後重新排入的副本
+            self._cancel([task_id])
+
+    def _poll(self):
+        with self._lock:
+            self._collect()
+            self._expire_leases()
+            self._forward_events()
+
+    def _take(self, task_id):
+        worker, ok, value = self._done.pop(task_id)
+        if not ok:
+            raise RuntimeError(f"Distributed task {task_id} failed on {worker}:\n{value}")
+        return value
+
+    def _cancel(self, task_ids):
+        for task_id in task_ids:
+            try:
+                os.remove(os.path.join(self.queue_dir, "tasks", f"{task_id}.task"))
+            except FileNotFoundError:
+                pass
+
+    def apply_async(self, function, args, memory=0):
+        """
+        發布單一工作，回傳可等待結果的物件。工作者一次只執行一個工作，
+        記憶體由各主機的工作者數量控制，因此不使用預估記憶體。
+
+        參數:
+        function (callable): 模組層級的工作函數。
+        args (tuple): 工作參數。
+        memory (int, optional): 工作的預估峰值記憶體（位元組）。未使用。
+        """
+        return _FolderResult(self, self._publish(function, args))
+
+    def imap_unordered(self, function, args_list, costs=None, memory=None, max_running=None):
+        """
+        依預測成本由大到小發布工作，並依完成順序串流回傳結果。
+        指定 max_running 時佇列中最多只有 max_running 個未完成的工作。
+
+        參數:
+        function (callable): 模組層級的工作函數。
+        args_list (list): 每個工作的參數。
+        costs (list, optional): 每個工作的預測成本。預設為 None。
+        memory (list, optional): 每個工作的預估峰值記憶體。未使用。
+        max_running (int, optional): 同時未完成的工作數上限。預設為 None，不限制。
+        """
+        pending = schedule_by_cost(args_list, costs)
+        running = set()
+        limit = len(pending) if max_running is None else max(1, max_running)
+        while pending or running:
+            if stop_requested():
+                # 通知遠端工作者停止，不等待執行中的工作
+                self.terminate()
+                self._cancel(running)
+                return
+            while pending and len(running) < limit:
+                running.add(self._publish(function, pending.pop()))
+            self._poll()
+            finished = [task_id for task_id in running if task_id in self._done]
+            if not finished:
+                time.sleep(self.poll_interval)
+                continue
+            for task_id in finished:
+                running.remove(task_id)
+                yield self._take(task_id)
+
+    def close(self):
+        """
+        結束這次執行並移除這次執行在佇列中的檔案；工作者保持執行，等待下一次執行的工作。
+        """
+        self._poll()
+        self._closed = True
+        self._remove_run(self.run_id, keep_stop=True)
+
+    def terminate(self):
+        """
+        設置共享資料夾中的停止事件，要求所有工作者停止目前的工作。
+        """
+        open(self.stop_file, 'w').close()
+
+
+class _FolderResult:
+    def __init__(self, pool, task_id):
+        self.pool = pool
+        self.task_id = task_id
+
+    def ready(self):
+        if self.task_id not in self.pool._done:
+            self.pool._poll()
+        return self.task_id in self.pool._done
+
+    def get(self, timeout=None):
+        start_time = time.time()
+        while self.task_id not in self.pool._done:
+            if timeout is not None and time.time() - start_time > timeout:
+                raise multiprocessing.TimeoutError()
+            self.pool._poll()
+            if self.task_id not in self.pool._done:
+                time.sleep(self.pool.poll_interval)
+        return self.pool._take(self.task_id)
+
+
+class _Worker:
+    def __init__(self, queue_dir, name, threads, poll_interval):
+        self.queue_dir = queue_dir
+        self.name = name
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.run_id = None
+        self.initialized = False
+        self.lease = None
+        self.heartbeat_file = os.path.join(queue_dir, "workers", name)
+
+    def load_shared(self, run_id):
+        # 每次執行的共享狀態不同，發現新的執行編號時重新載入
+        with open(os.path.join(self.queue_dir, "runs", f"{run_id}.pkl"), 'rb') as f:
+            shared = pickle.load(f)
+        shared["stop_event"] = FileEvent(os.path.join(self.queue_dir, f"stop-{run_id}"))
+        shared["message_queue"] = ProgressChannel(
+            FolderQueue(os.path.join(self.queue_dir, "events", f"{run_id}.{self.name}.jsonl")))
+        if not self.initialized:
+            _init_worker(shared, self.threads)
+            self.initialized = True
+        else:
+            import bag_frames
+            set_shared(shared)
+            profiling.configure(shared["config"])
+            bag_frames.configure(shared["config"])
+        self.run_id = run_id
+
+    def heartbeat(self, interval):
+        while True:
+            try:
+                open(self.heartbeat_file, 'a').close()
+                os.utime(self.heartbeat_file)
+                if self.lease is not None:
+                    os.utime(self.lease)
+            except FileNotFoundError:
+                # 租約已過期並被放回佇列
+                pass
+            time.sleep(interval)
+
+    def claim(self):
+        # 以改名認領工作：同一個檔案只有一個工作者能改名成功
+        folder = os.path.join(self.queue_dir, "tasks")
+        for name in sorted(os.listdir(folder)):
+            if not name.endswith(".task"):
+                continue
+            lease = os.path.join(self.queue_dir, "leases", f"{_task_id(name)}.{self.name}.lease")
+            try:
+                os.rename(os.path.join(folder, name), lease)
+            except FileNotFoundError:
+                continue
+            os.utime(lease)
+            return _task_id(name), lease
+        return None, None
+
+    def run_task(self, task_id, lease):
+        run_id = task_id.split("-", 1)[0]
+        try:
+            with open(lease, 'rb') as f:
+                payload = f.read()
+        except FileNotFoundError:
+            return
+        try:
+            if run_id != self.run_id:
+                self.load_shared(run_id)
+            value, _ = _run_task(payload)
+            result = (self.name, True, value)
+        except Exception as e:
+            result = (self.name, False, f"{e}\n{traceback.format_exc()}")
+        if self.run_id is not None:
+            # 先送出工作的進度事件，協調者收到結果時進度已是最新
+            from worker_pool import get_shared
+            get_shared("message_queue").flush()
+        _write_atomic(os.path.join(self.queue_dir, "results", f"{task_id}.result"),
+                      pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+        try:
+            os.remove(lease)
+        except FileNotFoundError:
+            pass
+
+    def serve(self, lease_timeout, idle_exit=0):
+        threading.Thread(target=self.heartbeat, args=(max(0.5, lease_timeout / 3.0),), daemon=True).start()
+        idle_since = time.time()
+        while True:
+            task_id, lease = self.claim()
+            if task_id is None:
+                if idle_exit > 0 and time.time() - idle_since > idle_exit:
+                    return
+                time.sleep(self.poll_interval)
+                continue
+            self.lease = lease
+            self.run_task(task_id, lease)
+            self.lease = None
+            idle_since = time.time()
+
+
+def run_worker(queue_dir, name, threads, poll_interval, lease_timeout, idle_exit):
+    """
+    在目前行程中執行一個工作者，持續認領並執行佇列中的工作。
+
+    參數:
+    queue_dir (str): 共享的佇列資料夾。
+    name (str): 工作者名稱，需在所有主機間唯一。
+    threads (int): 每個工作的 OpenMP 執行緒數。
+    poll_interval (float): 佇列為空時重新檢查的間隔秒數。
+    lease_timeout (float): 租約逾時秒數，需與協調者的 distributed_lease_timeout 相同。
+    idle_exit (float): 閒置超過此秒數後結束，0 表示持續執行。
+    """
+    for folder in FOLDERS:
+        os.makedirs(os.path.join(queue_dir, folder), exist_ok=True)
+    _Worker(queue_dir, name, threads, poll_interval).serve(lease_timeout, idle_exit)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distributed reconstruction worker")
+    parser.add_argument("command", choices=["worker"])
+    parser.add_argument("queue_dir", help="shared queue directory (distributed_queue in the config)")
+    parser.add_argument("--processes", type=int, default=1, help="worker processes on this host")
+    parser.add_argument("--threads", type=int, default=0, help="OpenMP threads per worker (0: cores / processes)")
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="seconds between queue scans")
+    parser.add_argument("--lease-timeout", type=float, default=60.0, help="same as distributed_lease_timeout")
+    parser.add_argument("--idle-exit", type=float, default=0, help="exit after this many idle seconds (0: never)")
+    args = parser.parse_args()
+    threads = args.threads if args.threads > 0 else max(1, multiprocessing.cpu_count() // args.processes)
+    prefix = f"{socket.gethostname()}-{os.getpid()}"
+    mp_context = multiprocessing.get_context('spawn')
+    workers = [mp_context.Process(target=run_worker,
+                                  args=(args.queue_dir, f"{prefix}-{i}", threads, args.poll_interval,
+                                        args.lease_timeout, args.idle_exit))
+               for i in range(args.processes)]
+    # 工作行程繼承建立時的執行緒數環境變數
+    with thread_environment(threads):
+        for worker in workers:
+            worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
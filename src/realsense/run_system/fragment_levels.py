@@ -0,0 +1,105 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import open3d as o3d
+
+from open3d_example import join
+
+
+def get_level_voxel_sizes(config):
+    """
+    回傳後續階段實際使用的降採樣體素大小：全域配準與 SLAC 使用 voxel_size，
+    精細配準另外使用 voxel_size 的 1/2 與 1/4。
+
+    參數:
+    config (dict): 重建配置。
+    """
+    voxel_size = config["voxel_size"]
+    return [voxel_size, voxel_size / 2.0, voxel_size / 4.0]
+
+
+def get_level_name(config, fragment_id, voxel_size):
+    """
+    回傳片段點雲在指定體素大小下的檔名。
+
+    參數:
+    config (dict): 重建配置。
+    fragment_id (int): 片段索引。
+    voxel_size (float): 體素大小。
+    """
+    return join(config["path_dataset"], config["template_fragment_pointcloud_level"] % (fragment_id, voxel_size))
+
+
+def make_level(pcd, voxel_size):
+    """
+    降採樣點雲並以配準使用的相同參數估計法向量。
+
+    參數:
+    pcd (open3d.geometry.PointCloud): 完整的片段點雲。
+    voxel_size (float): 體素大小。
+    """
+    pcd_down = pcd.voxel_down_sample(voxel_size)
+    pcd_down.estimate_normals(
+        o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 2.0, max_nn=30))
+    return pcd_down
+
+
+def write_fragment_levels(pcd, pcd_name, fragment_id, config):
+    """
+    以多個執行緒同時寫出完整的片段點雲與各解析度的降採樣點雲。
+
+    參數:
+    pcd (open3d.geometry.PointCloud): 完整的片段點雲。
+    pcd_name (str): 完整點雲的檔名。
+    fragment_id (int): 片段索引。
+    config (dict): 重建配置。
+    """
+    def write(name, cloud):
+        o3d.io.write_point_cloud(name, cloud, format='auto', write_ascii=False, compressed=True)
+
+    def write_level(voxel_size):
+        write(get_level_name(config, fragment_id, voxel_size), make_level(pcd, voxel_size))
+
+    os.makedirs(os.path.dirname(get_level_name(config, fragment_id, config["voxel_size"])), exist_ok=True)
+    voxel_sizes = get_level_voxel_sizes(config)
+    with ThreadPoolExecutor(max_workers=len(voxel_sizes) + 1) as executor:
+        futures = [executor.submit(write, pcd_name, pcd)]
+        futures += [executor.submit(write_level, voxel_size) for voxel_size in voxel_sizes]
+        for future in futures:
+            future.result()
+
+
+def get_level_file_names(config, n_fragments, voxel_size):
+    """
+    回傳每個片段在指定體素大小下的點雲檔名；沒有降採樣點雲時（例如舊版流程
+    產生的資料）回傳完整點雲的檔名。
+
+    參數:
+    config (dict): 重建配置。
+    n_fragments (int): 片段數量。
+    voxel_size (float): 體素大小。
+    """
+    names = []
+    for fragment_id in range(n_fragments):
+        name = get_level_name(config, fragment_id, voxel_size)
+        if not os.path.isfile(name):
+            name = join(config["path_dataset"], config["template_fragment_pointcloud"] % fragment_id)
+        names.append(name)
+    return names
+
+
+def read_fragment_pointcloud(config, fragment_id, voxel_size):
+    """
+    讀取指定體素大小的片段點雲（含法向量）；沒有降採樣點雲時讀取完整點雲並降採樣。
+
+    參數:
+    config (dict): 重建配置。
+    fragment_id (int): 片段索引。
+    voxel_size (float): 體素大小。
+    """
+    name = get_level_name(config, fragment_id, voxel_size)
+    if os.path.isfile(name):
+        return o3d.io.read_point_cloud(name)
+    pcd = o3d.io.read_point_cloud(
+        join(config["path_dataset"], config["template_fragment_pointcloud"] % fragment_id))
+    return make_level(pcd, voxel_size)
@@ -0,0 +1,120 @@
+import os
+import json
+import math
+
+from open3d_example import join
+from frame_prepass import estimate_motion, read_frame_lists
+
+
+def uniform_fragment_table(n_files, config):
+    """
+    每個片段固定 n_frames_per_fragment 幀的片段表。
+
+    參數:
+    n_files (int): 幀數。
+    config (dict): 重建配置。
+    """
+    n = config['n_frames_per_fragment']
+    return [(sid, min(sid + n, n_files)) for sid in range(0, n_files, n)]
+
+
+def predict_fragment_cost(n_frames, config):
+    """
+    預估片段的配對成本：相鄰幀的里程計加上關鍵幀之間的閉環配對。
+
+    參數:
+    n_frames (int): 片段的幀數。
+    config (dict): 重建配置。
+    """
+    n_keyframes = math.ceil(n_frames / config['n_keyframes_per_n_frame'])
+    return (n_frames - 1) * 1.0 + n_keyframes * (n_keyframes - 1) / 2.0 * 3.0
+
+
+def adaptive_fragment_table(motion, config):
+    """
+    依累積運動量與預估成本切分片段：快速掃動時片段較短，緩慢移動時片段較長，
+    但不超過成本上限。
+
+    參數:
+    motion (numpy.ndarray): 相鄰幀的運動量，長度為幀數減一。
+    config (dict): 重建配置。
+    """
+    n_files = len(motion) + 1
+    min_frames = config["fragment_min_frames"]
+    max_cost = config["fragment_max_cost"]
+    if max_cost <= 0:
+        max_cost = predict_fragment_cost(2 * config['n_frames_per_fragment'], config)
+
+    table = []
+    sid = 0
+    accumulated = 0.0
+    for i in range(1, n_files):
+        accumulated += motion[i - 1]
+        n_frames = i - sid
+        if n_frames >= min_frames and (accumulated >= config["fragment_motion_target"] or
+                                       predict_fragment_cost(n_frames + 1, config) > max_cost):
+            table.append((sid, i))
+            sid = i
+            accumulated = 0.0
+    table.append((sid, n_files))
+    # 過短的最後一個片段併入前一個片段
+    if len(table) > 1 and table[-1][1] - table[-1][0] < min_frames:
+        table[-2:] = [(table[-2][0], table[-1][1])]
+    return table
+
+
+def make_fragment_table(config, depth_files, message_queue):
+    """
+    建立並寫出片段表，後續所有階段都由片段表取得每個片段的幀範圍。
+
+    參數:
+    config (dict): 重建配置。
+    depth_files (list): 深度圖檔案路徑。
+    message_queue (ProgressChannel): 進度通道。
+    """
+    n_files = len(depth_files)
+    if config["adaptive_fragments"] and n_files > 1:
+        motion = estimate_motion(depth_files, config)
+        table = adaptive_fragment_table(motion, config)
+        motion_per_fragment = [float(motion[sid:eid - 1].sum()) for sid, eid in table]
+        sizes = [eid - sid for sid, eid in table]
+        message_queue.put(
+            f"Adaptive fragments :: {len(table)} fragments of {min(sizes)} to {max(sizes)} frames")
+    else:
+        table = uniform_fragment_table(n_files, config)
+        motion_per_fragment = None
+
+    write_fragment_table(config, table, motion_per_fragment)
+    return table
+
+
+def write_fragment_table(config, table, motion=None):
+    """
+    寫出片段表。
+
+    參數:
+    config (dict): 重建配置。
+    table (list): 每個片段的幀範圍 (sid, eid)。
+    motion (list, optional): 每個片段的累積運動量。預設為 None。
+    """
+    with open(join(config["path_dataset"], config["template_fragment_table"]), 'w') as f:
+        json.dump({
+            "adaptive": motion is not None,
+            "fragments": [list(fragment) for fragment in table],
+            "motion": motion,
+        }, f, indent=4)
+
+
+def read_fragment_table(config):
+    """
+    讀取片段表；沒有片段表時（例如舊版流程產生的資料）以固定幀數切分。
+
+    參數:
+    config (dict): 重建配置。
+    """
+    filename = join(config["path_dataset"], config["template_fragment_table"])
+    if os.path.isfile(filename):
+        with open(filename) as f:
+            return [tuple(fragment) for fragment in json.load(f)["fragments"]]
+    [color_files, depth_files] = read_frame_lists(config)
+    return uniform_fragment_table(len(depth_files), config)
@@ -0,0 +1,221 @@
+import os
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from open3d_example import join, get_rgbd_file_lists
+from bag_frames import read_image, read_bag_frame_lists
+
+
+def read_downscaled_depth(depth_file, config):
+    """
+    讀取深度圖並以固定間隔降採樣，回傳以公尺為單位的深度，無效深度為 0。
+
+    參數:
+    depth_file (str): 深度圖檔案路徑。
+    config (dict): 重建配置。
+    """
+    factor = config["prepass_downscale"]
+    depth = np.asarray(read_image(depth_file))[::factor, ::factor]
+    depth = depth.astype(np.float32) / config["depth_scale"]
+    depth[depth > config["depth_max"]] = 0.0
+    return depth
+
+
+def read_downscaled_grey(color_file, config):
+    """
+    讀取彩色影像並以固定間隔降採樣為 0 到 1 的灰階影像。
+
+    參數:
+    color_file (str): 彩色影像檔案路徑。
+    config (dict): 重建配置。
+    """
+    factor = config["prepass_downscale"]
+    color = np.asarray(read_image(color_file))[::factor, ::factor]
+    if color.ndim == 3:
+        color = color[..., :3].mean(axis=2)
+    return color.astype(np.float32) / 255.0
+
+
+def read_downscaled_frame(files, config):
+    """
+    讀取一幀的降採樣深度與灰階影像。
+
+    參數:
+    files (tuple): (彩色影像檔案路徑, 深度圖檔案路徑)。
+    config (dict): 重建配置。
+    """
+    color_file, depth_file = files
+    return read_downscaled_depth(depth_file, config), read_downscaled_grey(color_file, config)
+
+
+def iterate_downscaled(files, read, config):
+    """
+    以多個執行緒依序讀取降採樣影像並逐幀回傳。最多預先讀取執行緒數兩倍的幀，
+    記憶體用量與影片長度無關。
+
+    參數:
+    files (list): 傳給 read 的每幀檔案。
+    read (callable): 讀取函數，參數為 (檔案, 配置)。
+    config (dict): 重建配置。
+    """
+    n_threads = max(1, config["integrate_prefetch_threads"])
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        pending = deque()
+        for f in files:
+            pending.append(executor.submit(read, f, config))
+            if len(pending) >= 2 * n_threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def depth_change(a, b):
+    """
+    以兩幀降採樣深度的相對差異估計幀間運動量。
+
+    運動量為兩幀皆有效像素的平均相對深度差，加上有效性改變的像素比例，不需要估計姿態。
+
+    參數:
+    a (numpy.ndarray): 前一幀的降採樣深度。
+    b (numpy.ndarray): 後一幀的降採樣深度。
+    """
+    valid_a = a > 0
+    valid_b = b > 0
+    both = valid_a & valid_b
+    relative = np.where(both, np.abs(a - b) / np.maximum(a, 1e-3), 0.0)
+    return float(relative.sum() / max(int(both.sum()), 1) + (valid_a ^ valid_b).mean())
+
+
+def estimate_motion(depth_files, config):
+    """
+    逐幀讀取降採樣深度並估計相鄰兩幀的運動量，回傳長度為 N - 1 的陣列。
+    只保留前一幀，記憶體用量與影片長度無關。
+
+    參數:
+    depth_files (list): 深度圖檔案路徑。
+    config (dict): 重建配置。
+    """
+    motion = np.zeros(max(0, len(depth_files) - 1))
+    previous = None
+    for i, depth in enumerate(iterate_downscaled(depth_files, read_downscaled_depth, config)):
+        if previous is not None:
+            motion[i - 1] = depth_change(previous, depth)
+        previous = depth
+    return motion
+
+
+def find_static_frames(color_files, depth_files, config):
+    """
+    標記相機靜止時的重複幀，回傳要保留的幀遮罩。
+
+    逐幀讀取降採樣深度與灰階影像並與前一幀比較；自上一個保留幀起累積的差異
+    都低於門檻時該幀視為重複，累積值可避免緩慢漂移被整段移除。
+    連續移除的幀數不超過 static_frame_max_run，讓里程計仍有足夠的幀。
+
+    參數:
+    color_files (list): 彩色影像檔案路徑。
+    depth_files (list): 深度圖檔案路徑。
+    config (dict): 重建配置。
+    """
+    keep = np.ones(len(depth_files), dtype=bool)
+    accumulated_depth = 0.0
+    accumulated_grey = 0.0
+    run = 0
+    previous = None
+    frames = iterate_downscaled(list(zip(color_files, depth_files)), read_downscaled_frame, config)
+    for i, (depth, grey) in enumerate(frames):
+        if previous is None:
+            previous = (depth, grey)
+            continue
+        accumulated_depth += depth_change(previous[0], depth)
+        accumulated_grey += float(np.abs(grey - previous[1]).mean())
+        previous = (depth, grey)
+        if (accumulated_depth < config["static_frame_depth_change"] and
+                accumulated_grey < config["static_frame_grey_change"] and
+                run < config["static_frame_max_run"]):
+            keep[i] = False
+            run += 1
+        else:
+            accumulated_depth = 0.0
+            accumulated_grey = 0.0
+            run = 0
+    return keep
+
+
+def dedup_static_frames(config, message_queue):
+    """
+    在 make_fragments 之前移除相機靜止時的重複幀，並寫出保留的幀列表，
+    之後所有階段都經由 read_frame_lists 使用同一份縮減後的幀列表。
+    未啟用時刪除舊的幀列表。
+
+    參數:
+    config (dict): 重建配置。
+    message_queue (ProgressChannel): 進度通道。
+
+    回傳:
+    tuple: (原始幀數, 保留的幀數)
+    """
+    filename = join(config["path_dataset"], config["template_frame_list"])
+    [color_files, depth_files] = list_frames(config)
+    n_files = len(depth_files)
+    # 串流模式下幀仍在錄製，不移除重複幀
+    if not config["static_frame_dedup"] or config["streaming"] or n_files < 2:
+        if os.path.isfile(filename):
+            os.remove(filename)
+        return n_files, n_files
+
+    start_time = time.time()
+    keep = find_static_frames(color_files, depth_files, config)
+    frames = np.flatnonzero(keep)
+    with open(filename, 'w') as f:
+        json.dump({"n_frames": n_files, "frames": frames.tolist()}, f)
+    message_queue.put(
+        f"Static frame dedup :: removed {n_files - len(frames)} of {n_files} frames "
+        f"in {time.time() - start_time:.2f} s")
+    return n_files, len(frames)
+
+
+def list_frames(config):
+    """
+    回傳數據集的所有幀：資料夾中的影像檔，或直接讀取 bag 時的幀參照。
+
+    參數:
+    config (dict): 重建配置。
+    """
+    if config["path_bag"]:
+        return read_bag_frame_lists(config["path_bag"])
+    return get_rgbd_file_lists(config["path_dataset"])
+
+
+def read_frame_ids(config):
+    """
+    回傳縮減後的幀列表在原始數據集中的幀索引；沒有幀列表時為所有幀。
+
+    參數:
+    config (dict): 重建配置。
+    """
+    filename = join(config["path_dataset"], config["template_frame_list"])
+    if os.path.isfile(filename):
+        with open(filename) as f:
+            return np.array(json.load(f)["frames"], dtype=int)
+    [color_files, depth_files] = list_frames(config)
+    return np.arange(len(depth_files))
+
+
+def read_frame_lists(config):
+    """
+    回傳重建使用的彩色與深度影像列表，已移除靜止時的重複幀。
+
+    參數:
+    config (dict): 重建配置。
+    """
+    [color_files, depth_files] = list_frames(config)
+    filename = join(config["path_dataset"], config["template_frame_list"])
+    if not os.path.isfile(filename):
+        return color_files, depth_files
+    frames = read_frame_ids(config)
+    return [color_files[i] for i in frames], [depth_files[i] for i in frames]
@@ -0,0 +1,140 @@
+import json
+from collections import deque
+
+import numpy as np
+import open3d as o3d
+
+from bag_frames import read_image
+
+
+def read_depth_samples(depth_file, stride, config):
+    """
+    讀取深度圖並以固定間隔取樣，回傳以公尺為單位的深度與對應的像素座標。
+
+    參數:
+    depth_file (str): 深度圖檔案路徑。
+    stride (int): 取樣間隔（像素）。
+    config (dict): 重建配置。
+    """
+    depth = np.asarray(read_image(depth_file))[::stride, ::stride]
+    depth = depth.astype(np.float32) / config["depth_scale"]
+    v, u = np.nonzero((depth > config["depth_min"]) & (depth < config["depth_max"]))
+    return depth, u * stride, v * stride, depth[v, u]
+
+
+def unproject(u, v, z, intrinsic):
+    """
+    將像素座標與深度反投影為相機座標系中的點，回傳形狀為 (N, 3)。
+    """
+    fx, fy = intrinsic.get_focal_length()
+    cx, cy = intrinsic.get_principal_point()
+    return np.stack([(u - cx) / fx * z, (v - cy) / fy * z, z], axis=1)
+
+
+def covered_by_keyframe(points, keyframe, intrinsic, stride, config):
+    """
+    回傳世界座標點是否已被關鍵幀觀測到：投影到關鍵幀影像內，且深度與關鍵幀一致。
+
+    參數:
+    points (numpy.ndarray): 世界座標點，形狀為 (N, 3)。
+    keyframe (tuple): 關鍵幀的 (姿態, 取樣深度圖)。
+    intrinsic (o3d.camera.PinholeCameraIntrinsic): 相機內參。
+    stride (int): 深度圖取樣間隔。
+    config (dict): 重建配置。
+    """
+    keyframe_pose, keyframe_depth = keyframe
+    world_to_camera = np.linalg.inv(keyframe_pose)
+    p = points @ world_to_camera[:3, :3].T + world_to_camera[:3, 3]
+    fx, fy = intrinsic.get_focal_length()
+    cx, cy = intrinsic.get_principal_point()
+    z = p[:, 2]
+    valid = z > 1e-6
+    u = np.full(len(p), -1, dtype=np.int64)
+    v = np.full(len(p), -1, dtype=np.int64)
+    u[valid] = np.round((p[valid, 0] * fx / z[valid] + cx) / stride).astype(np.int64)
+    v[valid] = np.round((p[valid, 1] * fy / z[valid] + cy) / stride).astype(np.int64)
+    height, width = keyframe_depth.shape
+    inside = valid & (u >= 0) & (u < width) & (v >= 0) & (v < height)
+    covered = np.zeros(len(p), dtype=bool)
+    observed = keyframe_depth[v[inside], u[inside]]
+    covered[inside] = (observed > 0) & (np.abs(observed - z[inside]) < config["depth_diff_max"])
+    return covered
+
+
+def pose_delta(pose_a, pose_b):
+    """
+    回傳兩個姿態之間的平移距離（公尺）與旋轉角度（度）。
+    """
+    relative = np.linalg.inv(pose_a) @ pose_b
+    translation = np.linalg.norm(relative[:3, 3])
+    cos_angle = np.clip((np.trace(relative[:3, :3]) - 1.0) / 2.0, -1.0, 1.0)
+    return translation, np.degrees(np.arccos(cos_angle))
+
+
+def select_frames(depth_files, poses, intrinsic, config):
+    """
+    依姿態變化與深度重投影覆蓋率挑選要整合的幀。
+
+    依序處理每一幀：與最近的關鍵幀相比視角差異夠大、或有足夠比例的表面
+    未被最近幾個關鍵幀觀測到時選用該幀；連續略過的幀數不超過設定上限，
+    以確保最低的整合頻率。
+
+    參數:
+    depth_files (list): 每一幀的深度圖路徑。
+    poses (numpy.ndarray): 每一幀的相機姿態，形狀為 (N, 4, 4)。
+    intrinsic (o3d.camera.PinholeCameraIntrinsic): 相機內參。
+    config (dict): 重建配置。
+
+    回傳:
+    tuple: (選用幀的布林遮罩, 每一幀保留的表面覆蓋率)
+    """
+    n_frames = len(depth_files)
+    stride = config["frame_selection_stride"]
+    selected = np.zeros(n_frames, dtype=bool)
+    coverage = np.ones(n_frames)
+    keyframes = deque(maxlen=config["frame_selection_keyframes"])
+    last_selected = -1
+    for i in range(n_frames):
+        depth, u, v, z = read_depth_samples(depth_files[i], stride, config)
+        select = not keyframes or i - last_selected >= config["frame_selection_max_gap"]
+        if not select:
+            translation, rotation = pose_delta(keyframes[-1][0], poses[i])
+            select = (translation > config["frame_selection_translation"] or
+                      rotation > config["frame_selection_rotation"])
+        if not select and len(z) > 0:
+            points = unproject(u, v, z, intrinsic)
+            points = points @ poses[i][:3, :3].T + poses[i][:3, 3]
+            covered = np.zeros(len(points), dtype=bool)
+            for keyframe in keyframes:
+                covered |= covered_by_keyframe(points, keyframe, intrinsic, stride, config)
+            coverage[i] = covered.mean()
+            select = 1.0 - coverage[i] > config["frame_selection_novelty"]
+        if select:
+            selected[i] = True
+            coverage[i] = 1.0
+            keyframes.append((poses[i], depth))
+            last_selected = i
+    return selected, coverage
+
+
+def write_selection_report(filename, frame_ids, selected, coverage):
+    """
+    寫出幀挑選報告，列出選用的幀與保留的表面覆蓋率。
+
+    參數:
+    filename (str): 報告檔案路徑。
+    frame_ids (list): 每一幀的絕對幀索引。
+    selected (numpy.ndarray): 選用幀的布林遮罩。
+    coverage (numpy.ndarray): 每一幀保留的表面覆蓋率。
+    """
+    report = {
+        "n_frames": int(len(selected)),
+        "n_selected": int(selected.sum()),
+        "selected_ratio": float(selected.mean()) if len(selected) else 1.0,
+        "mean_coverage_retained": float(coverage.mean()) if len(coverage) else 1.0,
+        "min_coverage_retained": float(coverage.min()) if len(coverage) else 1.0,
+        "selected_frames": [int(frame_ids[i]) for i in np.flatnonzero(selected)],
+    }
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=4)
+    return report
@@ -0,0 +1,426 @@
+import os
+import json
+import time
+
+import numpy as np
+import open3d as o3d
+
+from open3d_example import join, get_file_list
+from fragment_levels import read_fragment_pointcloud, get_level_file_names, get_level_voxel_sizes
+from frame_prepass import read_frame_lists
+from integrate_scene import integrate_tensor_frames, select_scene_frames, save_scene
+from optimize_posegraph import run_posegraph_optimization
+from pair_journal import PairJournal, input_fingerprint
+from posegraph_store import (read_pose_graph, write_pose_graph, read_node_poses,
+                             compose_trajectory, write_global_trajectory)
+from refine_registration import local_refinement, predict_pair_cost, predict_pair_memory
+from register_fragments import preprocess_point_cloud, register_point_cloud_fpfh, compute_initial_registration
+from tiled_integration import tiled_integrate_rgb_frames
+from worker_pool import get_shared, stage_pool
+
+# 進度通道中的階段名稱
+PROGRESS_INCREMENTAL = "Add session"
+
+# 錨定邊的資訊量相對於配準邊最大資訊量的倍數
+ANCHOR_INFORMATION_SCALE = 1e3
+
+
+def get_session_config(config, path_dataset):
+    """
+    回傳指定資料集的配置；場景中的每個拍攝場次使用相同的參數與檔名樣板。
+
+    參數:
+    config (dict): 重建配置。
+    path_dataset (str): 場次的資料集路徑。
+    """
+    return dict(config, path_dataset=path_dataset)
+
+
+def count_fragments(path_dataset, config):
+    """
+    回傳資料集中的片段數量。
+
+    參數:
+    path_dataset (str): 資料集路徑。
+    config (dict): 重建配置。
+    """
+    return len(get_file_list(join(path_dataset, config["folder_fragment"]), ".ply"))
+
+
+def read_sessions(base_path, config):
+    """
+    回傳既有場景的場次列表，每個場次記錄資料集路徑、片段數量與在場景姿態圖中的節點偏移。
+    尚未加入過場次時，場景只包含基礎資料集本身。
+
+    參數:
+    base_path (str): 場景（基礎資料集）路徑。
+    config (dict): 重建配置。
+    """
+    filename = join(base_path, config["template_scene_sessions"])
+    if os.path.isfile(filename):
+        with open(filename) as f:
+            return json.load(f)["sessions"]
+    return [{"path_dataset": base_path, "n_fragments": count_fragments(base_path, config), "offset": 0}]
+
+
+def read_scene_pose_graph(base_path, config):
+    """
+    讀取既有場景的最佳化姿態圖；尚未加入過場次時為基礎資料集細化後的姿態圖。
+
+    參數:
+    base_path (str): 場景（基礎資料集）路徑。
+    config (dict): 重建配置。
+    """
+    filename = join(base_path, config["template_scene_posegraph"])
+    if os.path.isfile(filename) or os.path.isfile(os.path.splitext(filename)[0] + ".npz"):
+        return read_pose_graph(filename)
+    return read_pose_graph(join(base_path, config["template_refined_posegraph_optimized"]))
+
+
+def read_fpfh(config, fragment_id):
+    """
+    讀取片段的降採樣點雲與 FPFH 特徵。特徵計算後保存在片段資料夾，
+    之後加入其他場次時舊片段的特徵直接由磁碟讀取。
+
+    參數:
+    config (dict): 片段所屬資料集的配置。
+    fragment_id (int): 片段索引。
+
+    回傳:
+    tuple: (降採樣點雲, FPFH 特徵)
+    """
+    pcd_down = read_fragment_pointcloud(config, fragment_id, config["voxel_size"])
+    filename = join(config["path_dataset"], config["template_fragment_fpfh"] % (fragment_id, config["voxel_size"]))
+    if os.path.isfile(filename):
+        with np.load(filename) as data:
+            if data["data"].shape[1] == len(pcd_down.points):
+                feature = o3d.pipelines.registration.Feature()
+                feature.data = data["data"]
+                return pcd_down, feature
+    (pcd_down, feature) = preprocess_point_cloud(pcd_down, config)
+    # 多個工作可能同時計算同一片段的特徵，先寫入暫存檔再改名
+    tmp_name = f"{filename}.{os.getpid()}.npz"
+    np.savez(tmp_name, data=np.asarray(feature.data))
+    os.replace(tmp_name, filename)
+    return pcd_down, feature
+
+
+def fragment_descriptor_task(path_dataset, fragment_id):
+    """
+    回傳片段的全域描述子：FPFH 特徵的平均值，正規化為單位長度，用於挑選候選配對。
+
+    參數:
+    path_dataset (str): 片段所屬的資料集路徑。
+    fragment_id (int): 片段索引。
+    """
+    config = get_session_config(get_shared("config"), path_dataset)
+    _, feature = read_fpfh(config, fragment_id)
+    descriptor = np.asarray(feature.data).mean(axis=1)
+    return path_dataset, fragment_id, descriptor / max(np.linalg.norm(descriptor), 1e-12)
+
+
+def select_session_pairs(n_old, n_new, old_descriptors, new_descriptors, config):
+    """
+    回傳新場次需要計算的配對（場景節點索引 s < t）：新片段之間的所有配對，
+    以及每個新片段與描述子最相似的 incremental_candidates 個舊片段。
+
+    參數:
+    n_old (int): 場景中既有的片段數量。
+    n_new (int): 新場次的片段數量。
+    old_descriptors (numpy.ndarray): 舊片段的描述子，形狀為 (n_old, 33)。
+    new_descriptors (numpy.ndarray): 新片段的描述子，形狀為 (n_new, 33)。
+    config (dict): 重建配置。
+    """
+    pairs = [(n_old + s, n_old + t) for s in range(n_new) for t in range(s + 1, n_new)]
+    similarity = new_descriptors @ old_descriptors.T
+    n_candidates = min(config["incremental_candidates"], n_old)
+    for i in range(n_new):
+        for j in np.argsort(-similarity[i])[:n_candidates]:
+            pairs.append((int(j), n_old + i))
+    return pairs
+
+
+def register_session_pair_task(s, t, source, target):
+    """
+    配準一對片段：相鄰的新片段以片段姿態圖初始化，其他配對以 FPFH 全域配準初始化，
+    再以多尺度 ICP 細化。
+
+    參數:
+    s (int): 來源片段的場景節點索引。
+    t (int): 目標片段的場景節點索引。
+    source (tuple): 來源片段的 (資料集路徑, 片段索引)。
+    target (tuple): 目標片段的 (資料集路徑, 片段索引)。
+    """
+    config = get_shared("config")
+    stop_event = get_shared("stop_event")
+    message_queue = get_shared("message_queue")
+    start_time = time.time()
+    source_config = get_session_config(config, source[0])
+    target_config = get_session_config(config, target[0])
+    (source_down, source_fpfh) = read_fpfh(source_config, source[1])
+    (target_down, target_fpfh) = read_fpfh(target_config, target[1])
+    if source[0] == target[0] and target[1] == source[1] + 1:
+        (success, transformation, information) = compute_initial_registration(
+            source[1], target[1], source_down, target_down, source_fpfh, target_fpfh,
+            source[0], source_config, stop_event, message_queue)
+    else:
+        (success, transformation, information) = register_point_cloud_fpfh(
+            source_down, target_down, source_fpfh, target_fpfh, config)
+    if success and not stop_event.is_set():
+        source_levels = [read_fragment_pointcloud(source_config, source[1], v) for v in get_level_voxel_sizes(config)]
+        target_levels = [read_fragment_pointcloud(target_config, target[1], v) for v in get_level_voxel_sizes(config)]
+        (transformation, information) = local_refinement(
+            source_levels, target_levels, transformation, config, stop_event, message_queue)
+    message_queue.update(PROGRESS_INCREMENTAL, None, 1, time.time() - start_time)
+    return s, t, (success, transformation, information)
+
+
+def initial_session_poses(scene_poses, n_old, n_new, results):
+    """
+    以新片段之間的相鄰配對串接新場次的相對姿態，再以資訊量最大的新舊配對
+    將整個新場次放入場景座標，作為全域最佳化的初始值。
+
+    參數:
+    scene_poses (numpy.ndarray): 舊片段在場景中的姿態，形狀為 (n_old, 4, 4)。
+    n_old (int): 場景中既有的片段數量。
+    n_new (int): 新場次的片段數量。
+    results (dict): {(s, t): (success, transformation, information)}。
+
+    回傳:
+    numpy.ndarray: 新片段的初始姿態，形狀為 (n_new, 4, 4)；沒有成功的新舊配對時為 None。
+    """
+    # 邊 (s, t) 的變換將 s 轉換到 t 的座標，因此 pose_t = pose_s @ inv(T)
+    local = [np.identity(4)]
+    for i in range(n_new - 1):
+        (_, transformation, _) = results[(n_old + i, n_old + i + 1)]
+        local.append(local[-1] @ np.linalg.inv(transformation))
+    anchors = [(information[5, 5], s, t, transformation)
+               for (s, t), (success, transformation, information) in results.items()
+               if success and s < n_old]
+    if not anchors:
+        return None
+    (_, s, t, transformation) = max(anchors, key=lambda anchor: anchor[0])
+    pose_t = scene_poses[s] @ np.linalg.inv(transformation)
+    offset = pose_t @ np.linalg.inv(local[t - n_old])
+    return np.array([offset @ pose for pose in local])
+
+
+def make_scene_pose_graph(old_graph, new_poses, results, n_old, anchor=False):
+    """
+    將新片段的節點與新配對的邊加入既有場景的姿態圖。舊節點保留最佳化後的姿態、
+    舊邊沿用既有結果，全域最佳化因此由既有解開始。
+
+    舊片段的幀已以原本的姿態整合到場景中，anchor 為 True 時以參考節點到每個舊節點、
+    資訊量極大且不可剪除的邊固定舊節點之間的相對姿態，最佳化只移動新節點。
+
+    參數:
+    old_graph (o3d.pipelines.registration.PoseGraph): 既有場景的姿態圖。
+    new_poses (numpy.ndarray): 新片段的姿態。
+    results (dict): {(s, t): (success, transformation, information)}。
+    n_old (int): 場景中既有的片段數量。
+    anchor (bool, optional): 是否加入固定舊節點的錨定邊。預設為 False。
+    """
+    pose_graph = o3d.pipelines.registration.PoseGraph()
+    for node in old_graph.nodes:
+        pose_graph.nodes.append(o3d.pipelines.registration.PoseGraphNode(node.pose))
+    for edge in old_graph.edges:
+        pose_graph.edges.append(edge)
+    for pose in new_poses:
+        pose_graph.nodes.append(o3d.pipelines.registration.PoseGraphNode(pose))
+    for (s, t), (success, transformation, information) in sorted(results.items()):
+        if not success:
+            continue
+        odometry = s >= n_old and t == s + 1
+        pose_graph.edges.append(
+            o3d.pipelines.registration.PoseGraphEdge(s, t, transformation, information,
+                                                     uncertain=not odometry))
+    if anchor:
+        scale = max([np.abs(information).max() for (_, _, information) in results.values()], default=1.0)
+        information = np.identity(6) * scale * ANCHOR_INFORMATION_SCALE
+        pose_0 = old_graph.nodes[0].pose
+        for i in range(1, n_old):
+            # 邊 (s, t) 的變換將 s 轉換到 t 的座標，即 inv(pose_t) @ pose_s
+            transformation = np.linalg.inv(old_graph.nodes[i].pose) @ pose_0
+            pose_graph.edges.append(
+                o3d.pipelines.registration.PoseGraphEdge(0, i, transformation, information, uncertain=False))
+    return pose_graph
+
+
+def check_scene_store(base_path, config):
+    """
+    確認既有場景保存了可以繼續整合的 TSDF（整合時需啟用 save_tsdf）。
+
+    參數:
+    base_path (str): 場景（基礎資料集）路徑。
+    config (dict): 重建配置。
+    """
+    if config["integrate_tiled"]:
+        index_name = join(base_path, config["template_tile_index"])
+        if not os.path.isfile(index_name):
+            raise FileNotFoundError(f"No tile store in {base_path}; integrate the scene with save_tsdf first")
+        with open(index_name) as f:
+            tiles = json.load(f)["tiles"]
+        missing = [tile["key"] for tile in tiles
+                   if not os.path.isfile(join(base_path, config["template_tile_tsdf"] % tuple(tile["key"])))]
+        if missing:
+            raise FileNotFoundError(f"{len(missing)} tiles in {base_path} have no saved TSDF; "
+                                    f"integrate the scene with save_tsdf first")
+    elif not os.path.isfile(join(base_path, config["template_scene_tsdf"])):
+        raise FileNotFoundError(f"No saved TSDF in {base_path}; integrate the scene with save_tsdf first")
+
+
+def integrate_session(base_path, intrinsic, frame_ids, fragment_ids, poses, config, stop_event, message_queue, pool):
+    """
+    只將新場次的幀整合到場景保存的 TSDF 或圖塊庫，並更新場景網格。中途停止時回傳 False。
+
+    參數:
+    base_path (str): 場景（基礎資料集）路徑。
+    intrinsic (o3d.camera.PinholeCameraIntrinsic): 相機內參。
+    frame_ids (numpy.ndarray): 新場次的幀索引。
+    fragment_ids (numpy.ndarray): 每一幀所屬的片段索引。
+    poses (numpy.ndarray): 新場次的幀在場景中的姿態。
+    config (dict): 新場次的配置。
+    stop_event (multiprocessing.Event): 停止事件。
+    message_queue (ProgressChannel): 進度通道。
+    pool (WorkerPool or SerialPool): 行程池。
+    """
+    [color_files, depth_files] = read_frame_lists(config)
+    indices = select_scene_frames(config["path_dataset"], intrinsic, depth_files, frame_ids, poses, config, message_queue)
+    if config["integrate_tiled"]:
+        mesh = tiled_integrate_rgb_frames(base_path, intrinsic, frame_ids[indices], poses[indices],
+                                          config, stop_event, message_queue, pool, incremental=True)
+        if stop_event.is_set():
+            return False
+    else:
+        tsdf_name = join(base_path, config["template_scene_tsdf"])
+        voxel_grid = o3d.t.geometry.VoxelBlockGrid.load(tsdf_name)
+        if not integrate_tensor_frames(voxel_grid, color_files, depth_files, frame_ids[indices],
+                                       fragment_ids[indices], poses[indices], intrinsic, config,
+                                       stop_event, message_queue):
+            return False
+        voxel_grid.save(tsdf_name)
+        mesh = voxel_grid.extract_triangle_mesh().to_legacy()
+        mesh.compute_vertex_normals()
+    if mesh is not None:
+        save_scene(base_path, mesh, config)
+    return True
+
+
+def run(config, stop_event, message_queue, pool=None):
+    """
+    將目前的資料集作為新的拍攝場次加入 incremental_base 指定的既有場景：
+    只計算新片段之間與新舊片段之間的配對，以既有姿態圖為初始值做全域最佳化，
+    再只將新場次的幀整合到場景保存的 TSDF 或圖塊庫。
+
+    參數:
+    config (dict): 新場次的配置。
+    stop_event (multiprocessing.Event): 停止事件。
+    message_queue (ProgressChannel): 進度通道。
+    pool (WorkerPool or SerialPool, optional): 行程池。預設為 None。
+    """
+    session_path = config["path_dataset"]
+    base_path = config["incremental_base"]
+    message_queue.put(f"add session {session_path} to scene {base_path}.")
+    sessions = read_sessions(base_path, config)
+    if any(os.path.abspath(session["path_dataset"]) == os.path.abspath(session_path) for session in sessions):
+        raise ValueError(f"{session_path} is already part of the scene in {base_path}")
+    check_scene_store(base_path, config)
+    os.makedirs(join(session_path, config["folder_scene"]), exist_ok=True)
+
+    old_graph = read_scene_pose_graph(base_path, config)
+    scene_poses = np.array([node.pose for node in old_graph.nodes])
+    n_old = len(scene_poses)
+    n_new = count_fragments(session_path, config)
+    if n_new == 0:
+        raise FileNotFoundError(f"No fragments in {session_path}; run make_fragments first")
+    # 場景節點索引對應的 (資料集路徑, 片段索引)
+    fragments = [(session["path_dataset"], i) for session in sessions for i in range(session["n_fragments"])]
+    fragments += [(session_path, i) for i in range(n_new)]
+    assert len(fragments) == n_old + n_new
+
+    with stage_pool(pool, config, stop_event, message_queue) as pool:
+        # 舊片段的特徵已在加入先前的場次時保存，只有新片段需要計算
+        descriptors = {}
+        pool.plan_stage(len(fragments))
+        for path, fragment_id, descriptor in pool.imap_unordered(fragment_descriptor_task, fragments):
+            descriptors[(path, fragment_id)] = descriptor
+        if stop_event.is_set():
+            return
+        pairs = select_session_pairs(n_old, n_new,
+                                     np.array([descriptors[fragment] for fragment in fragments[:n_old]]),
+                                     np.array([descriptors[fragment] for fragment in fragments[n_old:]]),
+                                     config)
+        message_queue.put(f"Add session :: {n_new} new fragments, {len(pairs)} new pairs "
+                          f"instead of {(n_old + n_new) * (n_old + n_new - 1) // 2} for a full registration")
+        message_queue.begin(PROGRESS_INCREMENTAL, len(pairs), "pairs")
+
+        level_names = {}
+        for path in {path for path, _ in fragments}:
+            session_config = get_session_config(config, path)
+            ids = [i for p, i in fragments if p == path]
+            for i, name in zip(ids, get_level_file_names(session_config, len(ids), config["voxel_size"])):
+                level_names[(path, i)] = name
+        file_names = [level_names[fragment] for fragment in fragments]
+        journal = PairJournal(
+            join(session_path, config["template_incremental_journal"]),
+            input_fingerprint(file_names, config, ["voxel_size", "global_registration", "icp_method", "incremental_base"]))
+        results = {pair: journal.get(*pair) for pair in pairs if pair in journal}
+        if results:
+            message_queue.put(f"Resuming session registration :: {len(results)} pairs from journal")
+            message_queue.update(PROGRESS_INCREMENTAL, None, len(results), 0.0)
+        remaining = [pair for pair in pairs if pair not in journal]
+        args = [(s, t, fragments[s], fragments[t]) for s, t in remaining]
+        costs = [predict_pair_cost(file_names, s, t) for s, t in remaining]
+        memory = [predict_pair_memory(file_names, s, t, factor=12.0) for s, t in remaining]
+        pool.plan_stage(len(args))
+        for s, t, result in pool.imap_unordered(register_session_pair_task, args, costs, memory):
+            results[(s, t)] = result
+            # 停止後完成的配對可能是提前中止的結果，不寫入日誌
+            if not stop_event.is_set():
+                journal.append(s, t, *result)
+        journal.close()
+        if stop_event.is_set():
+            message_queue.put("Stopping session registration")
+            return
+        message_queue.end(PROGRESS_INCREMENTAL)
+
+        new_poses = initial_session_poses(scene_poses, n_old, n_new, results)
+        if new_poses is None:
+            raise RuntimeError(f"No fragment of {session_path} could be registered to the scene in {base_path}")
+        pose_graph_name = join(session_path, config["template_incremental_posegraph"])
+        pose_graph_optimized_name = join(session_path, config["template_incremental_posegraph_optimized"])
+        write_pose_graph(pose_graph_name, make_scene_pose_graph(old_graph, new_poses, results, n_old, anchor=True),
+                         config)
+        run_posegraph_optimization(pose_graph_name, pose_graph_optimized_name,
+                                   max_correspondence_distance=config["voxel_size"] * 1.4,
+                                   preference_loop_closure=config["preference_loop_closure_registration"],
+                                   config=config)
+        optimized = read_node_poses(pose_graph_optimized_name)
+        # 舊節點由錨定邊固定，殘餘的移動量應接近零
+        drift = np.linalg.norm(optimized[:n_old, :3, 3] - scene_poses[:, :3, 3], axis=1).max()
+        message_queue.put(f"Add session :: existing fragments moved at most {drift:.4f} m (anchored)")
+
+        local_poses = [
+            read_node_poses(join(session_path, config["template_fragment_posegraph_optimized"] % fragment_id))
+            for fragment_id in range(n_new)]
+        frame_ids, fragment_ids, poses = compose_trajectory(optimized[n_old:], local_poses, config)
+        write_global_trajectory(session_path, config, frame_ids, fragment_ids, poses)
+
+        if config["path_intrinsic"]:
+            intrinsic = o3d.io.read_pinhole_camera_intrinsic(config["path_intrinsic"])
+        else:
+            intrinsic = o3d.camera.PinholeCameraIntrinsic(
+                o3d.camera.PinholeCameraIntrinsicParameters.PrimeSenseDefault)
+        if not integrate_session(base_path, intrinsic, frame_ids, fragment_ids, poses, config,
+                                 stop_event, message_queue, pool):
+            message_queue.put("Stopping session integration; the scene store may contain part of the session")
+            return
+
+    # 整合完成後才更新場景，下一個場次以包含此場次的姿態圖為基礎；舊節點寫回原本的姿態，
+    # 與已整合到場景中的幾何一致，且不保存錨定邊
+    write_pose_graph(join(base_path, config["template_scene_posegraph"]),
+                     make_scene_pose_graph(old_graph, optimized[n_old:], results, n_old), config)
+    sessions.append({"path_dataset": session_path, "n_fragments": n_new, "offset": n_old})
+    with open(join(base_path, config["template_scene_sessions"]), 'w') as f:
+        json.dump({"sessions": sessions}, f, indent=4)
+    message_queue.put(f"Add session :: scene now has {len(sessions)} sessions, {n_old + n_new} fragments")
@@ -15,6 +15,7 @@ import json
 from os.path import isfile, join, splitext, dirname, basename
 from warnings import warn
 from data_loader import lounge_data_loader, bedroom_data_loader, jackjack_data_loader
+from bag_frames import open_bag_dataset
 import multiprocessing
 
 def extract_rgbd_frames(rgbd_video_file):
@@ -51,6 +52,30 @@ def initialize_config(config, message_queue):
     set_default_value(config, "depth_map_type", "redwood")
     set_default_value(config, "n_frames_per_fragment", 100)
     set_default_value(config, "n_keyframes_per_n_frame", 5)
+    # Adaptive fragments cut the sequence where the accumulated inter-frame motion,
+    # estimated on depth downscaled by `prepass_downscale`, reaches
+    # `fragment_motion_target` or the predicted pair cost exceeds `fragment_max_cost`
+    # (0 uses the cost of a fragment twice `n_frames_per_fragment` long).
+    set_default_value(config, "adaptive_fragments", False)
+    set_default_value(config, "fragment_motion_target", 2.0)
+    set_default_value(config, "fragment_min_frames", 20)
+    set_default_value(config, "fragment_max_cost", 0)
+    set_default_value(config, "prepass_downscale", 8)
+    # The loop closure filter describes every keyframe by a bag of binary words over
+    # its ORB descriptors and only registers each keyframe with its
+    # `loop_closure_candidates` most similar keyframes and the next keyframe.
+    set_default_value(config, "loop_closure_filter", False)
+    set_default_value(config, "loop_closure_candidates", 3)
+    set_default_value(config, "loop_closure_min_score", 0.1)
+    set_default_value(config, "loop_closure_words", 64)
+    # Static frame dedup drops frames recorded while the camera is paused before
+    # `make_fragments`: a frame is removed while the depth and grey change accumulated
+    # since the last kept frame stay below the thresholds, at most
+    # `static_frame_max_run` frames in a row. All stages then use `template_frame_list`.
+    set_default_value(config, "static_frame_dedup", False)
+    set_default_value(config, "static_frame_depth_change", 0.01)
+    set_default_value(config, "static_frame_grey_change", 0.01)
+    set_default_value(config, "static_frame_max_run", 30)
     set_default_value(config, "depth_min", 0.3)
     set_default_value(config, "depth_max", 3.0)
     set_default_value(config, "voxel_size", 0.05)
@@ -61,7 +86,95 @@ def initialize_config(config, message_queue):
     set_default_value(config, "tsdf_cubic_size", 3.0)
     set_default_value(config, "icp_method", "color")
     set_default_value(config, "global_registration", "ransac")
+    set_default_value(config, "ransac_max_iteration", 1000000)
+    set_default_value(config, "ransac_confidence", 0.999)
+    # Adaptive multiscale ICP stops a scale once the relative change of fitness and
+    # RMSE between iterations drops below `icp_converged_*` (one ICP call per scale);
+    # finer scales are skipped when the coarse scale changed less than `icp_skip_*`.
+    # Each finer scale only registers the source points near the correspondences
+    # found by the previous scale; the information matrix still uses whole clouds.
+    set_default_value(config, "icp_adaptive", False)
+    set_default_value(config, "icp_converged_fitness", 1e-4)
+    set_default_value(config, "icp_converged_rmse", 1e-5)
+    set_default_value(config, "icp_skip_fitness", 1e-3)
+    set_default_value(config, "icp_skip_rmse", 1e-4)
     set_default_value(config, "python_multi_threading", True)
+    # Streaming builds fragments while the recorder is still writing frames: each
+    # fragment starts as soon as `n_frames_per_fragment` new frames exist. Recording
+    # is considered running while `recording_marker` exists in the dataset and new
+    # frames arrived within `streaming_timeout` seconds.
+    set_default_value(config, "streaming", False)
+    set_default_value(config, "recording_marker", "recording.lock")
+    set_default_value(config, "streaming_poll_interval", 1.0)
+    set_default_value(config, "streaming_timeout", 30.0)
+    # Worker pool sizing. Tasks are only dispatched while their estimated peak
+    # memory fits in the budget; 0 uses `memory_budget_fraction` of the memory
+    # available when each stage starts. `worker_memory_gb` is the memory one
+    # busy worker is expected to need when choosing the pool size.
+    set_default_value(config, "memory_budget_gb", 0)
+    set_default_value(config, "memory_budget_fraction", 0.8)
+    set_default_value(config, "worker_memory_gb", 1.0)
+    # Processes x threads are planned per stage from the task count; a positive
+    # `worker_threads` fixes the OpenMP threads of each worker instead.
+    set_default_value(config, "worker_threads", 0)
+    set_default_value(config, "worker_cpu_affinity", False)
+    # Cores the reconstruction may use (0 uses every core of the machine). The job
+    # service gives each concurrent job its share of the global budget here and
+    # places it at `worker_core_offset` when workers are pinned to cores.
+    set_default_value(config, "worker_cores", 0)
+    set_default_value(config, "worker_core_offset", 0)
+    # Distributed mode publishes every worker pool task to `distributed_queue`, a
+    # folder on a filesystem shared by all hosts (the dataset must have the same
+    # path everywhere). Start workers with `python distributed_pool.py worker <queue>`;
+    # a task whose worker stops its heartbeat for `distributed_lease_timeout`
+    # seconds is put back in the queue.
+    set_default_value(config, "distributed_queue", "")
+    set_default_value(config, "distributed_poll_interval", 0.2)
+    set_default_value(config, "distributed_lease_timeout", 60.0)
+    # Incremental mode adds this dataset as a new capture session to the scene in
+    # `incremental_base`: the register step then only registers new-new pairs and
+    # each new fragment against its `incremental_candidates` most similar existing
+    # fragments, optimizes the scene pose graph starting from the existing solution
+    # and integrates only the new frames into the TSDF saved by `save_tsdf`.
+    set_default_value(config, "incremental_base", "")
+    set_default_value(config, "incremental_candidates", 3)
+    set_default_value(config, "save_tsdf", False)
+    # A positive `time_budget_s` picks tsdf_cubic_size, voxel_size,
+    # n_keyframes_per_n_frame and ransac_max_iteration so the predicted run time fits
+    # the budget; keys listed in `time_budget_fixed` keep their configured value.
+    # Predictions use per-stage costs calibrated from the timings of past runs on
+    # this machine, which every run appends to `cost_history` ("" disables it).
+    set_default_value(config, "time_budget_s", 0)
+    set_default_value(config, "time_budget_fixed", [])
+    set_default_value(config, "cost_history", "~/.run_system/cost_history.jsonl")
+    # Profiling writes per-stage cProfile/tracemalloc results and a Chrome
+    # trace of the main and worker processes to `folder_profiling`.
+    set_default_value(config, "profiling", False)
+    set_default_value(config, "folder_profiling", "profiling/")
+    # `integrate_scene` related parameters.
+    # "legacy" uses the ScalableTSDFVolume, "tensor" opts in to a VoxelBlockGrid on
+    # the CPU, which integrates faster but uses `sdf_trunc` and `block_count` from this
+    # config, so its mesh differs from the legacy one. `save_tsdf` needs "tensor".
+    set_default_value(config, "integrate_engine", "legacy")
+    set_default_value(config, "integrate_prefetch_threads", 4)
+    # Tiled integration splits the scene into cubes of `tile_size` meters that are
+    # integrated independently, so memory is bounded by the tile and not the site.
+    # The output is the tile meshes in `folder_tiles` listed in `template_tile_index`;
+    # `stitch_tiles` also merges them into `template_global_mesh`, which loads the
+    # whole scene into memory.
+    set_default_value(config, "integrate_tiled", False)
+    set_default_value(config, "tile_size", 4.0)
+    set_default_value(config, "stitch_tiles", False)
+    # Frame selection integrates only frames that see new surface or a new viewpoint,
+    # in both `make_fragments` and `integrate_scene`. At most `frame_selection_max_gap`
+    # consecutive frames are skipped.
+    set_default_value(config, "frame_selection", False)
+    set_default_value(config, "frame_selection_translation", 0.05)
+    set_default_value(config, "frame_selection_rotation", 10.0)
+    set_default_value(config, "frame_selection_novelty", 0.1)
+    set_default_value(config, "frame_selection_max_gap", 10)
+    set_default_value(config, "frame_selection_keyframes", 3)
+    set_default_value(config, "frame_selection_stride", 8)
 
     # `slac` and `slac_integrate` related parameters.
     # `voxel_size` and `depth_min` parameters from previous section,
@@ -81,6 +194,8 @@ def initialize_config(config, message_queue):
 
     # path related parameters.
     set_default_value(config, "folder_fragment", "fragments/")
+    set_default_value(config, "template_frame_list", "frame_list.json")
+    # Recomputed when the time budget changes `voxel_size`, unless set explicitly.
     set_default_value(config, "subfolder_slac",
                       "slac/%0.3f/" % config["voxel_size"])
     set_default_value(config, "template_fragment_posegraph",
@@ -89,6 +204,20 @@ def initialize_config(config, message_queue):
                       "fragments/fragment_optimized_%03d.json")
     set_default_value(config, "template_fragment_pointcloud",
                       "fragments/fragment_%03d.ply")
+    set_default_value(config, "template_fragment_table",
+                      "fragments/fragment_table.json")
+    # Downsampled fragment point clouds (with normals) at the voxel sizes used by
+    # `register_fragments`, `refine_registration` and `slac`.
+    set_default_value(config, "template_fragment_pointcloud_level",
+                      "fragments/levels/fragment_%03d_%0.4f.ply")
+    # Finished pairwise registrations are journaled so an interrupted
+    # `register_fragments` or `refine_registration` resumes where it stopped.
+    set_default_value(config, "template_register_journal",
+                      "fragments/register_journal.jsonl")
+    set_default_value(config, "template_refine_journal",
+                      "fragments/refine_journal.jsonl")
+    set_default_value(config, "template_refine_icp_stats",
+                      "scene/refine_icp_stats.json")
     set_default_value(config, "folder_scene", "scene/")
     set_default_value(config, "template_global_posegraph",
                       "scene/global_registration.json")
@@ -100,18 +229,63 @@ def initialize_config(config, message_queue):
                       "scene/refined_registration_optimized.json")
     set_default_value(config, "template_global_mesh", "scene/integrated.ply")
     set_default_value(config, "template_global_traj", "scene/trajectory.log")
+    set_default_value(config, "template_global_trajectory", "scene/trajectory.npz")
+    # Pose graphs are stored as .npz next to the configured .json names; the
+    # Open3D JSON and the .log trajectory are exported only when enabled.
+    set_default_value(config, "export_json_pose_graphs", False)
+    set_default_value(config, "export_trajectory_log", True)
+    set_default_value(config, "template_fragment_frame_selection",
+                      "fragments/frame_selection_%03d.json")
+    set_default_value(config, "template_scene_frame_selection",
+                      "scene/frame_selection.json")
+    set_default_value(config, "folder_tiles", "scene/tiles/")
+    set_default_value(config, "template_tile_mesh",
+                      "scene/tiles/tile_%d_%d_%d.ply")
+    set_default_value(config, "template_tile_index", "scene/tiles/index.json")
+    set_default_value(config, "template_tile_tsdf",
+                      "scene/tiles/tile_%d_%d_%d.npz")
+    set_default_value(config, "template_scene_tsdf", "scene/tsdf.npz")
+    set_default_value(config, "template_fragment_fpfh",
+                      "fragments/levels/fragment_%03d_fpfh_%0.4f.npz")
+    set_default_value(config, "template_scene_sessions", "scene/sessions.json")
+    set_default_value(config, "template_scene_posegraph", "scene/scene_posegraph.json")
+    set_default_value(config, "template_incremental_journal",
+                      "scene/incremental_journal.jsonl")
+    set_default_value(config, "template_incremental_posegraph",
+                      "scene/incremental_posegraph.json")
+    set_default_value(config, "template_incremental_posegraph_optimized",
+                      "scene/incremental_posegraph_optimized.json")
+    # A .bag dataset is read directly by the workers, which decode and cache
+    # `bag_cache_frames` frames each, `bag_read_ahead` at a time after a seek.
+    # PNG/JPG frames are extracted only when `bag_extract_frames` is set.
+    set_default_value(config, "bag_extract_frames", False)
+    set_default_value(config, "bag_cache_frames", 120)
+    set_default_value(config, "bag_read_ahead", 30)
+    set_default_value(config, "path_bag", "")
 
     config["path_dataset"] = os.getcwd() + '\\' + config["path_dataset"].replace("/", "\\")
+    if config["incremental_base"]:
+        config["incremental_base"] = os.path.abspath(config["incremental_base"])
+        # 之後的場次會繼續整合到此場次更新的 TSDF
+        config["save_tsdf"] = True
+    if config["save_tsdf"]:
+        # 只有 VoxelBlockGrid 可以保存並繼續整合
+        config["integrate_engine"] = "tensor"
 
     if config["path_dataset"].endswith(".bag"):
         assert os.path.isfile(config["path_dataset"]), (
             f"File {config['path_dataset']} not found.")
-        if message_queue is not None:
-            message_queue.put("Extracting frames from RGBD video file")
+        if config["bag_extract_frames"]:
+            if message_queue is not None:
+                message_queue.put("Extracting frames from RGBD video file")
+            else:
+                print("Extracting frames from RGBD video file")
+            config["path_dataset"], config["path_intrinsic"], config[
+                "depth_scale"] = extract_rgbd_frames(config["path_dataset"])
         else:
-            print("Extracting frames from RGBD video file")
-        config["path_dataset"], config["path_intrinsic"], config[
-            "depth_scale"] = extract_rgbd_frames(config["path_dataset"])
+            config["path_bag"] = config["path_dataset"]
+            config["path_dataset"], config["path_intrinsic"], config[
+                "depth_scale"] = open_bag_dataset(config["path_bag"])
 
 
 def dataset_loader(dataset_name):
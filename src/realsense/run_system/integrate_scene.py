@@ -10,61 +10,204 @@
 import numpy as np
 import math
 import os, sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import open3d as o3d
+import open3d.core as o3c
 
 from open3d_example import *
+from frame_selection import select_frames, write_selection_report
+from frame_prepass import read_frame_lists
+from bag_frames import read_tensor_image
+from posegraph_store import read_global_trajectory
+from tiled_integration import tiled_integrate_rgb_frames
+from worker_pool import get_frame_files, stage_pool
+from profiling import span
+
+# 進度通道中的階段名稱
+PROGRESS_INTEGRATE = "Integrate scene"
+
+
+def compute_scene_poses(path_dataset, config):
+    # 全域軌跡由 refine_registration 預先計算，這裡一次讀入
+    return read_global_trajectory(path_dataset, config)
+
+
+def select_scene_frames(path_dataset, intrinsic, depth_files, frame_ids, poses, config, message_queue):
+    # 只整合帶來新表面或新視角的幀，其餘幀的姿態仍會寫入軌跡
+    if not config["frame_selection"]:
+        return np.arange(len(frame_ids))
+    selected, coverage = select_frames([depth_files[i] for i in frame_ids], poses, intrinsic, config)
+    report = write_selection_report(
+        join(path_dataset, config["template_scene_frame_selection"]), frame_ids, selected, coverage)
+    message_queue.put(
+        f"Frame selection kept {report['n_selected']} / {report['n_frames']} frames, "
+        f"mean surface coverage retained {report['mean_coverage_retained'] * 100.0:.1f}%")
+    return np.flatnonzero(selected)
+
+
+def prefetch(executor, function, args_list, n_ahead):
+    # 在背景執行緒預先讀取並解碼後續的影像，依原順序回傳
+    futures = deque()
+    for args in args_list:
+        futures.append(executor.submit(function, *args))
+        if len(futures) > n_ahead:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+def read_tensor_frame(color_file, depth_file):
+    depth = read_tensor_image(depth_file)
+    color = read_tensor_image(color_file)
+    return depth, color
 
 
 def scalable_integrate_rgb_frames(path_dataset, intrinsic, config, stop_event, message_queue):
-    poses = []
-    [color_files, depth_files] = get_rgbd_file_lists(path_dataset)
-    n_files = len(color_files)
-    n_fragments = int(math.ceil(float(n_files) / config['n_frames_per_fragment']))
+    [color_files, depth_files] = read_frame_lists(config)
+    frame_ids, fragment_ids, poses = compute_scene_poses(path_dataset, config)
+    extrinsics = np.linalg.inv(poses)
+    indices = select_scene_frames(path_dataset, intrinsic, depth_files, frame_ids, poses, config, message_queue)
     volume = o3d.pipelines.integration.ScalableTSDFVolume(
         voxel_length=config["tsdf_cubic_size"] / 512.0,
         sdf_trunc=0.04,
         color_type=o3d.pipelines.integration.TSDFVolumeColorType.RGB8)
 
-    pose_graph_fragment = o3d.io.read_pose_graph(
-        join(path_dataset, config["template_refined_posegraph_optimized"]))
-
-    for fragment_id in range(len(pose_graph_fragment.nodes)):
-        if stop_event.is_set():
-            message_queue.put(f"Stopping integration for fragment {fragment_id}")
-            return
-
-        pose_graph_rgbd = o3d.io.read_pose_graph(
-            join(path_dataset,
-                 config["template_fragment_posegraph_optimized"] % fragment_id))
-
-        for frame_id in range(len(pose_graph_rgbd.nodes)):
+    message_queue.begin(PROGRESS_INTEGRATE, len(indices), "frames")
+    start_time = time.time()
+    n_threads = config["integrate_prefetch_threads"]
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        frames = prefetch(executor, read_rgbd_image,
+                          [(color_files[frame_ids[i]], depth_files[frame_ids[i]], False, config) for i in indices],
+                          2 * n_threads)
+        for i, rgbd in zip(indices, frames):
             if stop_event.is_set():
-                message_queue.put(f"Stopping integration for frame {frame_id}")
+                message_queue.put(f"Stopping integration for frame {frame_ids[i]}")
                 return
-                
-            frame_id_abs = fragment_id * config['n_frames_per_fragment'] + frame_id
-            message_queue.put(
-                f"Fragment {fragment_id:03d} / {n_fragments - 1:03d} :: integrate rgbd frame {frame_id_abs} ({frame_id + 1} of {len(pose_graph_rgbd.nodes)}).")
-            rgbd = read_rgbd_image(color_files[frame_id_abs],
-                                   depth_files[frame_id_abs], False, config)
-            pose = np.dot(pose_graph_fragment.nodes[fragment_id].pose,
-                          pose_graph_rgbd.nodes[frame_id].pose)
-            volume.integrate(rgbd, intrinsic, np.linalg.inv(pose))
-            poses.append(pose)
+            frame_start_time = time.time()
+            with span("integrate_frame", frame=int(frame_ids[i])):
+                volume.integrate(rgbd, intrinsic, extrinsics[i])
+            message_queue.update(PROGRESS_INTEGRATE, int(fragment_ids[i]), 1, time.time() - frame_start_time)
+    message_queue.end(PROGRESS_INTEGRATE)
+    report_throughput(len(indices), time.time() - start_time, message_queue)
 
     mesh = volume.extract_triangle_mesh()
     mesh.compute_vertex_normals()
+    save_scene(path_dataset, mesh, config)
+
+
+def make_voxel_grid(config):
+    # VoxelBlockGrid 在 CPU 上以多執行緒整合
+    return o3d.t.geometry.VoxelBlockGrid(
+        attr_names=('tsdf', 'weight', 'color'),
+        attr_dtypes=(o3c.float32, o3c.float32, o3c.float32),
+        attr_channels=((1), (1), (3)),
+        voxel_size=config["tsdf_cubic_size"] / 512.0,
+        block_resolution=16,
+        block_count=config['block_count'],
+        device=o3d.core.Device("CPU:0"))
+
+
+def tensor_integrate_rgb_frames(path_dataset, intrinsic, config, stop_event, message_queue):
+    [color_files, depth_files] = read_frame_lists(config)
+    frame_ids, fragment_ids, poses = compute_scene_poses(path_dataset, config)
+    indices = select_scene_frames(path_dataset, intrinsic, depth_files, frame_ids, poses, config, message_queue)
+    voxel_grid = make_voxel_grid(config)
+    if not integrate_tensor_frames(voxel_grid, color_files, depth_files, frame_ids[indices],
+                                   fragment_ids[indices], poses[indices], intrinsic, config,
+                                   stop_event, message_queue):
+        return
+    if config["save_tsdf"]:
+        voxel_grid.save(join(path_dataset, config["template_scene_tsdf"]))
+
+    mesh = voxel_grid.extract_triangle_mesh().to_legacy()
+    mesh.compute_vertex_normals()
+    save_scene(path_dataset, mesh, config)
+
+
+def integrate_tensor_frames(voxel_grid, color_files, depth_files, frame_ids, fragment_ids, poses,
+                            intrinsic, config, stop_event, message_queue):
+    """
+    將幀整合到 VoxelBlockGrid，影像解碼交給背景執行緒。中途停止時回傳 False。
+
+    參數:
+    voxel_grid (o3d.t.geometry.VoxelBlockGrid): 體素網格，可為讀入的既有場景。
+    color_files (list): 彩色影像列表。
+    depth_files (list): 深度影像列表。
+    frame_ids (numpy.ndarray): 要整合的幀索引。
+    fragment_ids (numpy.ndarray): 每一幀所屬的片段索引，用於進度回報。
+    poses (numpy.ndarray): 每一幀在場景中的姿態，形狀為 (N, 4, 4)。
+    intrinsic (o3d.camera.PinholeCameraIntrinsic): 相機內參。
+    config (dict): 重建配置。
+    stop_event (multiprocessing.Event): 停止事件。
+    message_queue (ProgressChannel): 進度通道。
+    """
+    extrinsics = np.linalg.inv(poses)
+    voxel_size = config["tsdf_cubic_size"] / 512.0
+    trunc_voxel_multiplier = config["sdf_trunc"] / voxel_size
+    intrinsic_t = o3d.core.Tensor(intrinsic.intrinsic_matrix, o3c.float64)
+    depth_scale = float(config['depth_scale'])
+    depth_max = float(config['depth_max'])
+
+    message_queue.begin(PROGRESS_INTEGRATE, len(frame_ids), "frames")
+    start_time = time.time()
+    n_threads = config["integrate_prefetch_threads"]
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        frames = prefetch(executor, read_tensor_frame,
+                          [(color_files[frame_id], depth_files[frame_id]) for frame_id in frame_ids],
+                          2 * n_threads)
+        for i, (depth, color) in enumerate(frames):
+            if stop_event.is_set():
+                message_queue.put(f"Stopping integration for frame {frame_ids[i]}")
+                return False
+            frame_start_time = time.time()
+            extrinsic_t = o3d.core.Tensor(extrinsics[i], o3c.float64)
+            with span("integrate_frame", frame=int(frame_ids[i])):
+                frustum_block_coords = voxel_grid.compute_unique_block_coordinates(
+                    depth, intrinsic_t, extrinsic_t, depth_scale, depth_max,
+                    trunc_voxel_multiplier)
+                voxel_grid.integrate(frustum_block_coords, depth, color,
+                                     intrinsic_t, extrinsic_t, depth_scale,
+                                     depth_max, trunc_voxel_multiplier)
+            message_queue.update(PROGRESS_INTEGRATE, int(fragment_ids[i]), 1, time.time() - frame_start_time)
+    message_queue.end(PROGRESS_INTEGRATE)
+    report_throughput(len(frame_ids), time.time() - start_time, message_queue)
+    return True
+
+
+def tiled_integrate_scene(path_dataset, intrinsic, config, stop_event, message_queue, pool):
+    # 大型場景依空間圖塊分區整合，記憶體用量受圖塊大小限制而非整個場景
+    frame_ids, fragment_ids, poses = compute_scene_poses(path_dataset, config)
+    start_time = time.time()
+    with stage_pool(pool, config, stop_event, message_queue) as pool:
+        color_files, depth_files = get_frame_files(int(frame_ids.max()))
+        indices = select_scene_frames(path_dataset, intrinsic, depth_files,
+                                      frame_ids, poses, config, message_queue)
+        mesh = tiled_integrate_rgb_frames(path_dataset, intrinsic, frame_ids[indices], poses[indices],
+                                          config, stop_event, message_queue, pool)
+    if stop_event.is_set():
+        return
+    report_throughput(len(indices), time.time() - start_time, message_queue)
+    if mesh is not None:
+        save_scene(path_dataset, mesh, config)
+
+
+def report_throughput(n_frames, elapsed, message_queue):
+    message_queue.put(
+        f"Integrated {n_frames} frames in {elapsed:.2f} s "
+        f"({n_frames / max(elapsed, 1e-6):.2f} frames/s)")
+
+
+def save_scene(path_dataset, mesh, config):
     if config["debug_mode"]:
         o3d.visualization.draw_geometries([mesh])
 
     mesh_name = join(path_dataset, config["template_global_mesh"])
     o3d.io.write_triangle_mesh(mesh_name, mesh, False, True)
 
-    traj_name = join(path_dataset, config["template_global_traj"])
-    write_poses_to_log(traj_name, poses)
-
 
-def run(config, stop_event, message_queue):
+def run(config, stop_event, message_queue, pool=None):
     message_queue.put("integrate the whole RGBD sequence using estimated camera pose.")
     if config["path_intrinsic"]:
         intrinsic = o3d.io.read_pinhole_camera_intrinsic(
@@ -72,4 +215,9 @@ def run(config, stop_event, message_queue):
     else:
         intrinsic = o3d.camera.PinholeCameraIntrinsic(
             o3d.camera.PinholeCameraIntrinsicParameters.PrimeSenseDefault)
-    scalable_integrate_rgb_frames(config["path_dataset"], intrinsic, config, stop_event, message_queue)
+    if config["integrate_tiled"]:
+        tiled_integrate_scene(config["path_dataset"], intrinsic, config, stop_event, message_queue, pool)
+    elif config["integrate_engine"] == "tensor":
+        tensor_integrate_rgb_frames(config["path_dataset"], intrinsic, config, stop_event, message_queue)
+    else:
+        scalable_integrate_rgb_frames(config["path_dataset"], intrinsic, config, stop_event, message_queue)
@@ -0,0 +1,393 @@
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import threading
+import traceback
+import multiprocessing
+
+import psutil
+
+# 將當前文件的目錄添加到 sys.path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from worker_pool import GB
+
+# 工作描述檔中的階段名稱，對應 Args_run_system 的參數
+STAGE_ARGS = ["make", "register", "refine", "integrate", "slac", "slac_integrate"]
+STAGE_NAMES = ["make_fragments", "register_fragments", "refine_registration",
+               "integrate_scene", "slac", "slac_integrate"]
+
+FINAL_STATES = ("done", "failed", "stopped")
+
+
+def write_json(filename, data):
+    """
+    以暫存檔替換的方式寫出 JSON，讀取端不會讀到寫到一半的檔案。
+
+    參數:
+    filename (str): 檔案路徑。
+    data (dict): 資料。
+    """
+    tmp_name = filename + ".tmp"
+    with open(tmp_name, 'w') as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp_name, filename)
+
+
+def read_json(filename, default=None):
+    """
+    讀取 JSON 檔，檔案不存在或無法解析時回傳 default。
+
+    參數:
+    filename (str): 檔案路徑。
+    default (any, optional): 預設值。預設為 None。
+    """
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return default
+
+
+class JobFiles:
+    def __init__(self, job_dir):
+        """
+        初始化 JobFiles 類別，管理單一工作資料夾中的描述檔、狀態、日誌與時間檔。
+
+        參數:
+        job_dir (str): 工作資料夾。
+        """
+        self.job_dir = job_dir
+        self.job = os.path.join(job_dir, "job.json")
+        self.config = os.path.join(job_dir, "config.json")
+        self.status = os.path.join(job_dir, "status.json")
+        self.log = os.path.join(job_dir, "log.txt")
+        self.times = os.path.join(job_dir, "times.json")
+        self.cancel = os.path.join(job_dir, "cancel")
+
+    def update_status(self, **fields):
+        """
+        更新狀態檔中的欄位。
+
+        參數:
+        fields (dict): 要更新的欄位。
+        """
+        status = read_json(self.status, {})
+        status.update(fields)
+        status["updated"] = datetime.datetime.now().isoformat(timespec="seconds")
+        write_json(self.status, status)
+
+    def read_status(self):
+        """
+        回傳狀態檔內容。
+        """
+        return read_json(self.status, {})
+
+
+def run_job(job_dir):
+    """
+    在獨立的行程中執行一個工作。每個工作擁有自己的重建系統與行程池，
+    模組層級的狀態（共享狀態、分析、bag 讀取器）因此不會在工作之間混用。
+
+    參數:
+    job_dir (str): 工作資料夾。
+    """
+    from run_system import Args_run_system, ReconstructionSystem
+
+    files = JobFiles(job_dir)
+    job = read_json(files.job)
+    errors = []
+    log_lock = threading.Lock()
+    log_file = open(files.log, 'a', encoding='utf-8')
+
+    def log(message):
+        with log_lock:
+            log_file.write(f"{datetime.datetime.now().isoformat(timespec='seconds')} {message}\n")
+            log_file.flush()
+
+    def callback(mode, data):
+        if mode == "terminal_print":
+            log(data["message"])
+        elif mode == "terminal_progress":
+            files.update_status(progress={**files.read_status().get("progress", {}), data["key"]: data["message"]})
+        elif mode == "show_error":
+            errors.append(f"{data['title']}: {data['message']}")
+            log(f"ERROR {data['title']}: {data['message']}")
+
+    stages = {name: name in job["stages"] for name in STAGE_ARGS}
+    args = Args_run_system(config=files.config, debug_mode=job.get("debug_mode", False), **stages)
+    system = ReconstructionSystem(args, callback)
+    files.update_status(state="running", pid=os.getpid(), started=time.time())
+
+    # 服務建立 cancel 檔時停止工作
+    def watch_cancel():
+        while not system.monitor_event.is_set():
+            if os.path.isfile(files.cancel):
+                system.stop_event.set()
+                return
+            time.sleep(1.0)
+
+    threading.Thread(target=watch_cancel, daemon=True).start()
+    start_time = time.time()
+    try:
+        system.execute()
+    except Exception as e:
+        errors.append(f"{e}\n{traceback.format_exc()}")
+    finally:
+        system.monitor_event.set()
+        system.monitor_thread.join()
+
+    write_json(files.times, {
+        "total": time.time() - start_time,
+        "stages": {STAGE_NAMES[i]: system.times[i] for i in range(len(STAGE_NAMES)) if stages[STAGE_ARGS[i]]},
+        "completed": [STAGE_NAMES[i] for i in sorted(system.completed)],
+        "predicted": system.predicted_times,
+    })
+    if system.stop_event.is_set():
+        state = "stopped"
+    elif errors:
+        state = "failed"
+    else:
+        state = "done"
+    files.update_status(state=state, finished=time.time(), errors=errors)
+    log(f"Job {state}")
+    log_file.close()
+
+
+class JobService:
+    def __init__(self, spool_dir, cores=0, memory_gb=0, max_jobs=2, poll_interval=2.0, min_memory_gb=1.0):
+        """
+        初始化 JobService 類別，從 spool 資料夾接收重建工作並在共同的資源預算下同時執行。
+        工作開始時分到目前空閒的核心與記憶體，結束後歸還給之後開始的工作。
+
+        spool 資料夾結構：
+        incoming/<名稱>.json  提交的工作：{"config": 配置檔路徑或配置, "stages": [...],
+                              "owner": 提交者（選填）, "debug_mode": bool（選填）}
+        jobs/<名稱>/          每個工作的 job.json、config.json、status.json、log.txt、times.json；
+                              建立 cancel 檔可停止工作
+
+        參數:
+        spool_dir (str): spool 資料夾。
+        cores (int, optional): 所有工作共用的核心數，0 表示整台機器。預設為 0。
+        memory_gb (float, optional): 所有工作共用的記憶體預算（GB），0 表示目前可用記憶體的 80%。預設為 0。
+        max_jobs (int, optional): 同時執行的工作數量上限。預設為 2。
+        poll_interval (float, optional): 檢查新工作的間隔（秒）。預設為 2.0。
+        min_memory_gb (float, optional): 開始工作所需的最少空閒記憶體（GB）。預設為 1.0。
+        """
+        self.spool_dir = spool_dir
+        self.incoming_dir = os.path.join(spool_dir, "incoming")
+        self.jobs_dir = os.path.join(spool_dir, "jobs")
+        os.makedirs(self.incoming_dir, exist_ok=True)
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        self.cores = cores if cores > 0 else multiprocessing.cpu_count()
+        if memory_gb <= 0:
+            memory_gb = psutil.virtual_memory().available * 0.8 / GB
+        self.memory_gb = memory_gb
+        self.max_jobs = max(1, min(max_jobs, self.cores))
+        self.poll_interval = poll_interval
+        self.min_memory_gb = min_memory_gb
+        # 執行中的工作：名稱 -> (行程, 起始核心, 核心數, 記憶體預算, 提交者)
+        self.running = {}
+        self.last_start = {}
+        self.stop_event = threading.Event()
+        self.mp_context = multiprocessing.get_context('spawn')
+
+    def free_resources(self):
+        """
+        回傳未被執行中工作預留的資源：(最長連續空閒核心區段的起始核心, 區段核心數, 記憶體 GB)。
+        工作行程綁定到連續的核心，因此只分配單一區段。
+        """
+        used = set()
+        for _, offset, cores, _, _ in self.running.values():
+            used.update(range(offset, offset + cores))
+        best = (0, 0)
+        start = None
+        for core in range(self.cores + 1):
+            if core < self.cores and core not in used:
+                if start is None:
+                    start = core
+            elif start is not None:
+                if core - start > best[1]:
+                    best = (start, core - start)
+                start = None
+        memory_gb = self.memory_gb - sum(memory for _, _, _, memory, _ in self.running.values())
+        return best[0], best[1], memory_gb
+
+    def job_share(self, n_starting):
+        """
+        回傳下一個工作分到的 (起始核心, 核心數, 記憶體預算 GB)，空閒資源不足時回傳 None。
+        空閒資源由這一輪要開始、且資源足夠容納的工作平分；行程池在工作開始時決定大小，
+        因此單獨執行的工作使用整個預算，之後的工作等待資源歸還。
+
+        參數:
+        n_starting (int): 這一輪還要開始的工作數量。
+        """
+        offset, free_cores, free_memory_gb = self.free_resources()
+        n_starting = min(n_starting, free_cores, int(free_memory_gb // self.min_memory_gb))
+        if n_starting < 1:
+            return None
+        return offset, free_cores // n_starting, free_memory_gb / n_starting
+
+    def accept_incoming(self):
+        """
+        將 incoming 中新提交的工作移到各自的工作資料夾並建立工作專用的配置。
+        """
+        for name in sorted(os.listdir(self.incoming_dir)):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.incoming_dir, name)
+            job = read_json(path)
+            if job is None:
+                # 提交端可能還在寫入
+                continue
+            job_name = os.path.splitext(name)[0]
+            job_dir = os.path.join(self.jobs_dir, job_name)
+            suffix = 1
+            while os.path.exists(job_dir):
+                job_dir = os.path.join(self.jobs_dir, f"{job_name}_{suffix}")
+                suffix += 1
+            os.makedirs(job_dir)
+            files = JobFiles(job_dir)
+            try:
+                config = job["config"]
+                if isinstance(config, str):
+                    with open(config, encoding='utf-8') as f:
+                        config = json.load(f)
+                unknown = [stage for stage in job["stages"] if stage not in STAGE_ARGS]
+                if unknown:
+                    raise ValueError(f"Unknown stages {unknown}, expected a subset of {STAGE_ARGS}")
+                job.setdefault("owner", "default")
+                write_json(files.config, config)
+                write_json(files.job, job)
+                files.update_status(state="queued", owner=job["owner"], submitted=os.path.getmtime(path))
+            except Exception as e:
+                write_json(files.job, job)
+                files.update_status(state="failed", errors=[f"Invalid job: {e}"])
+            os.remove(path)
+
+    def pending_jobs(self):
+        """
+        依公平排程的順序回傳等待中的工作：執行中工作最少的提交者優先，
+        相同時最久沒有開始工作的提交者優先，同一提交者依提交時間。
+        """
+        pending = []
+        for job_name in os.listdir(self.jobs_dir):
+            if job_name in self.running:
+                continue
+            status = JobFiles(os.path.join(self.jobs_dir, job_name)).read_status()
+            if status.get("state") == "queued":
+                pending.append((job_name, status["owner"], status["submitted"]))
+        running_owners = [owner for _, _, _, _, owner in self.running.values()]
+
+        def priority(item):
+            job_name, owner, submitted = item
+            return (running_owners.count(owner), self.last_start.get(owner, 0.0), submitted)
+
+        return sorted(pending, key=priority)
+
+    def start_job(self, job_name, owner, offset, cores, memory_gb):
+        """
+        設定工作的核心與記憶體預算後在新的行程中開始工作。
+
+        參數:
+        job_name (str): 工作名稱。
+        owner (str): 提交者。
+        offset (int): 工作的起始核心。
+        cores (int): 工作的核心數。
+        memory_gb (float): 工作的記憶體預算（GB）。
+        """
+        files = JobFiles(os.path.join(self.jobs_dir, job_name))
+        config = read_json(files.config)
+        config["worker_cores"] = cores
+        config["worker_core_offset"] = offset
+        config["memory_budget_gb"] = memory_gb
+        write_json(files.config, config)
+        files.update_status(state="starting", cores=cores, memory_gb=memory_gb)
+        process = self.mp_context.Process(target=run_job, args=(files.job_dir,), name=f"job-{job_name}")
+        process.start()
+        self.running[job_name] = (process, offset, cores, memory_gb, owner)
+        self.last_start[owner] = time.time()
+        print(f"Job service :: started {job_name} ({owner}) with {cores} cores, {memory_gb:.1f} GB")
+
+    def reap_jobs(self):
+        """
+        移除已結束的工作並歸還其資源；行程異常結束而沒有寫入最終狀態時標記為失敗。
+        """
+        for job_name, (process, _, _, _, _) in list(self.running.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            files = JobFiles(os.path.join(self.jobs_dir, job_name))
+            state = files.read_status().get("state")
+            if state not in FINAL_STATES:
+                files.update_status(state="failed", finished=time.time(),
+                                    errors=[f"Job process exited with code {process.exitcode}"])
+                state = "failed"
+            del self.running[job_name]
+            print(f"Job service :: {job_name} {state}")
+
+    def step(self):
+        """
+        執行一次排程：接收新工作、回收結束的工作並在有空位與空閒資源時開始等待中的工作。
+        """
+        self.accept_incoming()
+        self.reap_jobs()
+        while len(self.running) < self.max_jobs:
+            # 每開始一個工作後重新排序，同一提交者的工作因此不會佔滿所有空位
+            pending = self.pending_jobs()
+            if not pending:
+                break
+            share = self.job_share(min(len(pending), self.max_jobs - len(self.running)))
+            if share is None:
+                break
+            job_name, owner, _ = pending[0]
+            self.start_job(job_name, owner, *share)
+
+    def serve(self, once=False):
+        """
+        持續處理 spool 中的工作。
+
+        參數:
+        once (bool, optional): 所有工作處理完畢後結束。預設為 False。
+        """
+        print(f"Job service :: spool {self.spool_dir}, {self.cores} cores, "
+              f"{self.memory_gb:.1f} GB, {self.max_jobs} concurrent jobs")
+        try:
+            while not self.stop_event.is_set():
+                self.step()
+                if once and not self.running and not self.pending_jobs() and \
+                        not any(name.endswith(".json") for name in os.listdir(self.incoming_dir)):
+                    break
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            print("Job service :: stopping running jobs")
+            self.stop()
+
+    def stop(self):
+        """
+        停止服務並要求所有執行中的工作停止。
+        """
+        self.stop_event.set()
+        for job_name in self.running:
+            open(JobFiles(os.path.join(self.jobs_dir, job_name)).cancel, 'w').close()
+        for process, _, _, _, _ in self.running.values():
+            process.join()
+        self.reap_jobs()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless reconstruction job service")
+    parser.add_argument("spool_dir", help="spool directory with incoming/ and jobs/")
+    parser.add_argument("--cores", type=int, default=0, help="cores shared by all jobs (0: all)")
+    parser.add_argument("--memory-gb", type=float, default=0, help="memory shared by all jobs (0: 80%% of available)")
+    parser.add_argument("--max-jobs", type=int, default=2, help="jobs running at the same time")
+    parser.add_argument("--poll-interval", type=float, default=2.0, help="seconds between spool scans")
+    parser.add_argument("--min-memory-gb", type=float, default=1.0, help="free memory needed to start a job")
+    parser.add_argument("--once", action="store_true", help="exit when the spool is empty")
+    args = parser.parse_args()
+    service = JobService(args.spool_dir, args.cores, args.memory_gb, args.max_jobs, args.poll_interval,
+                         args.min_memory_gb)
+    service.serve(once=args.once)
@@ -0,0 +1,92 @@
+import numpy as np
+
+
+def unpack_descriptors(descriptors):
+    """
+    將 ORB 二進位描述子展開為 0/1 浮點陣列，漢明距離因此可以用矩陣乘法計算。
+
+    參數:
+    descriptors (numpy.ndarray): ORB 描述子，形狀為 (N, 32)，型別為 uint8。
+    """
+    return np.unpackbits(descriptors, axis=1).astype(np.float32)
+
+
+def hamming_distances(bits, words):
+    """
+    計算每個描述子與每個視覺單字之間的漢明距離，回傳形狀為 (N, K) 的陣列。
+
+    參數:
+    bits (numpy.ndarray): 展開後的描述子，形狀為 (N, 256)。
+    words (numpy.ndarray): 展開後的視覺單字，形狀為 (K, 256)。
+    """
+    return bits.sum(axis=1)[:, None] + words.sum(axis=1)[None, :] - 2.0 * bits @ words.T
+
+
+def train_vocabulary(bits, n_words, n_iterations=10, seed=0):
+    """
+    以 k-majority 分群訓練二進位視覺單字：每個單字為所屬描述子逐位元的多數值。
+
+    參數:
+    bits (numpy.ndarray): 展開後的訓練描述子，形狀為 (N, 256)。
+    n_words (int): 視覺單字數量。
+    n_iterations (int, optional): 分群迭代次數。預設為 10。
+    seed (int, optional): 初始單字的隨機種子。預設為 0。
+    """
+    rng = np.random.default_rng(seed)
+    n_words = min(n_words, len(bits))
+    words = bits[rng.choice(len(bits), n_words, replace=False)]
+    for _ in range(n_iterations):
+        labels = hamming_distances(bits, words).argmin(axis=1)
+        counts = np.bincount(labels, minlength=n_words)
+        ones = np.zeros_like(words)
+        np.add.at(ones, labels, bits)
+        # 沒有描述子的單字保留原值
+        used = counts > 0
+        words[used] = (ones[used] * 2 > counts[used, None]).astype(np.float32)
+    return words
+
+
+def bow_histograms(descriptor_sets, words):
+    """
+    計算每張影像的 tf-idf 加權詞袋直方圖，並正規化為單位長度。
+
+    參數:
+    descriptor_sets (list): 每張影像展開後的描述子，沒有特徵時為 None。
+    words (numpy.ndarray): 視覺單字，形狀為 (K, 256)。
+    """
+    n_words = len(words)
+    histograms = np.zeros((len(descriptor_sets), n_words), dtype=np.float32)
+    for i, bits in enumerate(descriptor_sets):
+        if bits is not None and len(bits) > 0:
+            labels = hamming_distances(bits, words).argmin(axis=1)
+            histograms[i] = np.bincount(labels, minlength=n_words) / len(bits)
+    document_frequency = np.count_nonzero(histograms, axis=0)
+    histograms *= np.log(len(descriptor_sets) / np.maximum(document_frequency, 1))
+    norms = np.linalg.norm(histograms, axis=1, keepdims=True)
+    return histograms / np.maximum(norms, 1e-12)
+
+
+def select_loop_closure_candidates(keyframes, histograms, config):
+    """
+    依詞袋相似度為片段內的每個關鍵幀挑選最相似的關鍵幀作為閉環候選，
+    相鄰的關鍵幀一律保留。配對數因此與關鍵幀數量大致成線性而非平方。
+
+    參數:
+    keyframes (list): 片段內關鍵幀的幀索引，依序排列。
+    histograms (numpy.ndarray): 對應的詞袋直方圖，形狀為 (N, K)。
+    config (dict): 重建配置。
+
+    回傳:
+    set: 閉環候選幀對 (s, t)，s < t。
+    """
+    n_candidates = config["loop_closure_candidates"]
+    similarity = histograms @ histograms.T
+    np.fill_diagonal(similarity, -np.inf)
+    candidates = set()
+    for i, s in enumerate(keyframes):
+        if i + 1 < len(keyframes):
+            candidates.add((s, keyframes[i + 1]))
+        for j in np.argsort(-similarity[i])[:n_candidates]:
+            if similarity[i, j] >= config["loop_closure_min_score"]:
+                candidates.add((min(s, keyframes[j]), max(s, keyframes[j])))
+    return candidates
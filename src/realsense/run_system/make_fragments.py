@@ -1,122 +1,389 @@
-import math
-import multiprocessing
 import os
+import time
+from collections import OrderedDict
 import numpy as np
 import open3d as o3d
 from open3d_example import *
 from optimize_posegraph import optimize_posegraph_for_fragment
+from frame_selection import select_frames, write_selection_report
+from posegraph_store import write_pose_graph, read_node_poses
+from worker_pool import get_shared, get_frame_files, stage_pool, schedule_by_cost
+from profiling import span
+from tiled_integration import estimate_tile_blocks, estimate_tile_memory
+from fragment_table import make_fragment_table, write_fragment_table
+from fragment_levels import write_fragment_levels
+from loop_closure import unpack_descriptors, train_vocabulary, bow_histograms, select_loop_closure_candidates
 
 # check opencv python package
 with_opencv = initialize_opencv()
 if with_opencv:
-    from opencv_pose_estimation import pose_estimation
+    from opencv_pose_estimation import pose_estimation, compute_orb_features
+
+# 每個行程各自快取關鍵幀的 ORB 特徵，關鍵幀在同一片段內會與多個幀配對，
+# 避免對同一張影像重複執行 detectAndCompute
+ORB_FEATURE_CACHE_SIZE = 64
+_orb_feature_cache = OrderedDict()
+
+# 進度通道中的階段名稱
+PROGRESS_PAIRS = "Fragment RGBD matching"
+PROGRESS_INTEGRATION = "Fragment integration"
+
+def get_orb_features(color_file, rgbd_image):
+    features = _orb_feature_cache.get(color_file)
+    if features is not None:
+        _orb_feature_cache.move_to_end(color_file)
+        return features
+    features = compute_orb_features(rgbd_image)
+    _orb_feature_cache[color_file] = features
+    if len(_orb_feature_cache) > ORB_FEATURE_CACHE_SIZE:
+        _orb_feature_cache.popitem(last=False)
+    return features
 
 def register_one_rgbd_pair(s, t, color_files, depth_files, intrinsic, with_opencv, config):
-    source_rgbd_image = read_rgbd_image(color_files[s], depth_files[s], True, config)
-    target_rgbd_image = read_rgbd_image(color_files[t], depth_files[t], True, config)
+    with span("read_rgbd_pair", s=s, t=t):
+        source_rgbd_image = read_rgbd_image(color_files[s], depth_files[s], True, config)
+        target_rgbd_image = read_rgbd_image(color_files[t], depth_files[t], True, config)
     option = o3d.pipelines.odometry.OdometryOption()
     option.depth_diff_max = config["depth_diff_max"]
     if abs(s - t) != 1:
         if with_opencv:
-            success_5pt, odo_init = pose_estimation(source_rgbd_image, target_rgbd_image, intrinsic, False)
+            with span("pose_estimation", s=s, t=t):
+                success_5pt, odo_init = pose_estimation(
+                    source_rgbd_image, target_rgbd_image, intrinsic, False,
+                    get_orb_features(color_files[s], source_rgbd_image),
+                    get_orb_features(color_files[t], target_rgbd_image))
             if success_5pt:
-                [success, trans, info] = o3d.pipelines.odometry.compute_rgbd_odometry(
-                    source_rgbd_image, target_rgbd_image, intrinsic, odo_init,
-                    o3d.pipelines.odometry.RGBDOdometryJacobianFromHybridTerm(), option)
+                with span("odometry", s=s, t=t):
+                    [success, trans, info] = o3d.pipelines.odometry.compute_rgbd_odometry(
+                        source_rgbd_image, target_rgbd_image, intrinsic, odo_init,
+                        o3d.pipelines.odometry.RGBDOdometryJacobianFromHybridTerm(), option)
                 return [success, trans, info]
         return [False, np.identity(4), np.identity(6)]
     else:
         odo_init = np.identity(4)
-        [success, trans, info] = o3d.pipelines.odometry.compute_rgbd_odometry(
-            source_rgbd_image, target_rgbd_image, intrinsic, odo_init,
-            o3d.pipelines.odometry.RGBDOdometryJacobianFromHybridTerm(), option)
+        with span("odometry", s=s, t=t):
+            [success, trans, info] = o3d.pipelines.odometry.compute_rgbd_odometry(
+                source_rgbd_image, target_rgbd_image, intrinsic, odo_init,
+                o3d.pipelines.odometry.RGBDOdometryJacobianFromHybridTerm(), option)
         return [success, trans, info]
 
-def make_posegraph_for_fragment(path_dataset, sid, eid, color_files, depth_files, fragment_id, n_fragments, intrinsic, with_opencv, config, stop_event, message_queue):
+def get_fragment_range(fragment_id, fragment_table):
+    # 片段的幀範圍由片段表決定，可能是固定幀數或依運動量切分
+    return fragment_table[fragment_id]
+
+def is_keyframe(s, sid, config):
+    # 關鍵幀以片段的第一幀起算，依運動切分的片段也從關鍵幀開始且間距一致
+    return (s - sid) % config['n_keyframes_per_n_frame'] == 0
+
+def get_rgbd_pairs_for_fragment(sid, eid, config, candidates=None):
+    # 片段內需要配準的 RGBD 幀對：相鄰幀的里程計邊與關鍵幀之間的閉環邊，
+    # 有閉環候選時只保留候選中的關鍵幀對
+    pairs = []
+    for s in range(sid, eid):
+        for t in range(s + 1, eid):
+            if t == s + 1 or (is_keyframe(s, sid, config) and is_keyframe(t, sid, config)
+                              and (candidates is None or (s, t) in candidates)):
+                pairs.append((s, t))
+    return pairs
+
+def get_keyframes_for_fragment(sid, eid, config):
+    return [s for s in range(sid, eid) if is_keyframe(s, sid, config)]
+
+def predict_rgbd_pair_cost(s, t):
+    # 閉環幀對需要 ORB 匹配、5 點 RANSAC 與 3D RANSAC 再做 RGBD 里程計
+    if t == s + 1:
+        return 1.0
+    return 3.0
+
+def predict_rgbd_pair_memory(intrinsic):
+    # 兩張 RGBD 影像（彩色、深度與灰階浮點影像）及里程計的影像金字塔
+    return 16 * intrinsic.width * intrinsic.height * 4 + 32 * 1024 ** 2
+
+def predict_integration_memory(n_frames, intrinsic, config):
+    # 片段的 TSDF 體積，與圖塊整合使用相同的體素區塊估計
+    return estimate_tile_memory(estimate_tile_blocks(n_frames, intrinsic, config))
+
+def read_intrinsic(config):
+    if config["path_intrinsic"]:
+        return o3d.io.read_pinhole_camera_intrinsic(config["path_intrinsic"])
+    return o3d.camera.PinholeCameraIntrinsic(o3d.camera.PinholeCameraIntrinsicParameters.PrimeSenseDefault)
+
+def register_rgbd_pair_task(fragment_id, s, t, n_fragments):
+    config = get_shared("config")
+    stop_event = get_shared("stop_event")
+    message_queue = get_shared("message_queue")
+    if stop_event.is_set():
+        return fragment_id, s, t, None
     o3d.utility.set_verbosity_level(o3d.utility.VerbosityLevel.Error)
+    start_time = time.time()
+    intrinsic = read_intrinsic(config)
+    color_files, depth_files = get_frame_files(t)
+    result = register_one_rgbd_pair(s, t, color_files, depth_files, intrinsic, with_opencv, config)
+    message_queue.update(PROGRESS_PAIRS, fragment_id, 1, time.time() - start_time)
+    return fragment_id, s, t, result
+
+def keyframe_descriptor_task(s):
+    config = get_shared("config")
+    if get_shared("stop_event").is_set():
+        return s, None
+    color_files, depth_files = get_frame_files(s)
+    rgbd_image = read_rgbd_image(color_files[s], depth_files[s], True, config)
+    # 特徵存入行程快取，同一行程之後配準此關鍵幀時不必重算
+    _, des = get_orb_features(color_files[s], rgbd_image)
+    return s, des
+
+def find_loop_closure_candidates(pool, fragment_table, intrinsic, config, stop_event, message_queue):
+    # 以關鍵幀 ORB 描述子的詞袋直方圖挑選閉環候選，只對相似的關鍵幀執行昂貴的配準
+    keyframes = [get_keyframes_for_fragment(sid, eid, config) for sid, eid in fragment_table]
+    frames = [s for fragment_keyframes in keyframes for s in fragment_keyframes]
+    descriptors = {}
+    for s, des in pool.imap_unordered(keyframe_descriptor_task, [(s,) for s in frames],
+                                      memory=[predict_rgbd_pair_memory(intrinsic)] * len(frames)):
+        descriptors[s] = None if des is None or len(des) == 0 else unpack_descriptors(des)
+    training = [bits for bits in descriptors.values() if bits is not None]
+    if stop_event.is_set() or not training:
+        return {}
+    words = train_vocabulary(np.concatenate(training), config["loop_closure_words"])
+    candidates = {}
+    n_pairs = 0
+    for fragment_id, fragment_keyframes in enumerate(keyframes):
+        histograms = bow_histograms([descriptors[s] for s in fragment_keyframes], words)
+        candidates[fragment_id] = select_loop_closure_candidates(fragment_keyframes, histograms, config)
+        n_pairs += len(fragment_keyframes) * (len(fragment_keyframes) - 1) // 2
+    message_queue.put(
+        f"Loop closure filter :: {sum(len(c) for c in candidates.values())} of {n_pairs} keyframe pairs kept")
+    return candidates
+
+def make_posegraph_for_fragment(path_dataset, sid, eid, fragment_id, pair_results, config, candidates=None):
+    # 以與逐幀配準相同的順序組裝姿態圖，結果與配對完成的先後無關
     pose_graph = o3d.pipelines.registration.PoseGraph()
     trans_odometry = np.identity(4)
     pose_graph.nodes.append(o3d.pipelines.registration.PoseGraphNode(trans_odometry))
-    for s in range(sid, eid):
-        for t in range(s + 1, eid):
-            if stop_event.is_set():
-                message_queue.put(f"Stopping posegraph creation for fragment {fragment_id}")
-                return
-            if t == s + 1:
-                message_queue.put(f"Fragment {fragment_id:03d} / {n_fragments - 1:03d} :: RGBD matching between frame : {s} and {t}")
-                [success, trans, info] = register_one_rgbd_pair(s, t, color_files, depth_files, intrinsic, with_opencv, config)
-                trans_odometry = np.dot(trans, trans_odometry)
-                trans_odometry_inv = np.linalg.inv(trans_odometry)
-                pose_graph.nodes.append(o3d.pipelines.registration.PoseGraphNode(trans_odometry_inv))
-                pose_graph.edges.append(o3d.pipelines.registration.PoseGraphEdge(s - sid, t - sid, trans, info, uncertain=False))
-            if s % config['n_keyframes_per_n_frame'] == 0 and t % config['n_keyframes_per_n_frame'] == 0:
-                message_queue.put(f"Fragment {fragment_id:03d} / {n_fragments - 1:03d} :: RGBD matching between frame : {s} and {t}")
-                [success, trans, info] = register_one_rgbd_pair(s, t, color_files, depth_files, intrinsic, with_opencv, config)
-                if success:
-                    pose_graph.edges.append(o3d.pipelines.registration.PoseGraphEdge(s - sid, t - sid, trans, info, uncertain=True))
-    o3d.io.write_pose_graph(join(path_dataset, config["template_fragment_posegraph"] % fragment_id), pose_graph)
-
-def integrate_rgb_frames_for_fragment(color_files, depth_files, fragment_id, n_fragments, pose_graph_name, intrinsic, config, stop_event, message_queue):
-    pose_graph = o3d.io.read_pose_graph(pose_graph_name)
+    for (s, t) in get_rgbd_pairs_for_fragment(sid, eid, config, candidates):
+        [success, trans, info] = pair_results[(s, t)]
+        if t == s + 1:
+            trans_odometry = np.dot(trans, trans_odometry)
+            trans_odometry_inv = np.linalg.inv(trans_odometry)
+            pose_graph.nodes.append(o3d.pipelines.registration.PoseGraphNode(trans_odometry_inv))
+            pose_graph.edges.append(o3d.pipelines.registration.PoseGraphEdge(s - sid, t - sid, trans, info, uncertain=False))
+        if is_keyframe(s, sid, config) and is_keyframe(t, sid, config):
+            if success:
+                pose_graph.edges.append(o3d.pipelines.registration.PoseGraphEdge(s - sid, t - sid, trans, info, uncertain=True))
+    write_pose_graph(join(path_dataset, config["template_fragment_posegraph"] % fragment_id), pose_graph, config)
+
+def integrate_rgb_frames_for_fragment(color_files, depth_files, fragment_id, n_fragments, sid, pose_graph_name, intrinsic, config, stop_event, message_queue):
+    poses = read_node_poses(pose_graph_name)
     volume = o3d.pipelines.integration.ScalableTSDFVolume(
         voxel_length=config["tsdf_cubic_size"] / 512.0,
         sdf_trunc=0.04,
         color_type=o3d.pipelines.integration.TSDFVolumeColorType.RGB8)
-    for i in range(len(pose_graph.nodes)):
+    n_nodes = len(poses)
+    frame_ids = sid + np.arange(n_nodes)
+    indices = range(n_nodes)
+    if config["frame_selection"]:
+        # 只整合帶來新表面或新視角的幀，略過的幀直接計入進度
+        selected, coverage = select_frames([depth_files[i] for i in frame_ids], poses, intrinsic, config)
+        write_selection_report(
+            join(config["path_dataset"], config["template_fragment_frame_selection"] % fragment_id),
+            frame_ids, selected, coverage)
+        indices = np.flatnonzero(selected)
+        message_queue.update(PROGRESS_INTEGRATION, fragment_id, n_nodes - len(indices), 0.0)
+    for i in indices:
         if stop_event.is_set():
             message_queue.put(f"Stopping integration for fragment {fragment_id}")
             return
-        i_abs = fragment_id * config['n_frames_per_fragment'] + i
-        message_queue.put(f"Fragment {fragment_id:03d} / {n_fragments - 1:03d} :: integrate rgbd frame {i_abs} ({i + 1} of {len(pose_graph.nodes)}).")
-        rgbd = read_rgbd_image(color_files[i_abs], depth_files[i_abs], False, config)
-        pose = pose_graph.nodes[i].pose
-        volume.integrate(rgbd, intrinsic, np.linalg.inv(pose))
+        i_abs = frame_ids[i]
+        start_time = time.time()
+        with span("integrate_frame", frame=int(i_abs)):
+            rgbd = read_rgbd_image(color_files[i_abs], depth_files[i_abs], False, config)
+            volume.integrate(rgbd, intrinsic, np.linalg.inv(poses[i]))
+        message_queue.update(PROGRESS_INTEGRATION, fragment_id, 1, time.time() - start_time)
     mesh = volume.extract_triangle_mesh()
     mesh.compute_vertex_normals()
     return mesh
 
-def make_pointcloud_for_fragment(path_dataset, color_files, depth_files, fragment_id, n_fragments, intrinsic, config, stop_event, message_queue):
-    mesh = integrate_rgb_frames_for_fragment(color_files, depth_files, fragment_id, n_fragments, join(path_dataset, config["template_fragment_posegraph_optimized"] % fragment_id), intrinsic, config, stop_event, message_queue)
+def make_pointcloud_for_fragment(path_dataset, color_files, depth_files, fragment_id, n_fragments, sid, intrinsic, config, stop_event, message_queue):
+    mesh = integrate_rgb_frames_for_fragment(color_files, depth_files, fragment_id, n_fragments, sid, join(path_dataset, config["template_fragment_posegraph_optimized"] % fragment_id), intrinsic, config, stop_event, message_queue)
+    if mesh is None:
+        return
     pcd = o3d.geometry.PointCloud()
     pcd.points = mesh.vertices
     pcd.colors = mesh.vertex_colors
     pcd_name = join(path_dataset, config["template_fragment_pointcloud"] % fragment_id)
-    o3d.io.write_point_cloud(pcd_name, pcd, format='auto', write_ascii=False, compressed=True)
+    write_fragment_levels(pcd, pcd_name, fragment_id, config)
 
-def process_single_fragment(fragment_id, color_files, depth_files, n_files, n_fragments, config, stop_event, message_queue):
+def make_fragment_task(fragment_id, n_fragments, sid, eid, pair_results, candidates=None):
+    # 片段的所有邊都完成後，在工作行程中組裝並優化其姿態圖再整合，
+    # 主行程因此不會因姿態圖優化而暫停派送其他幀對
+    config = get_shared("config")
+    stop_event = get_shared("stop_event")
+    message_queue = get_shared("message_queue")
     if stop_event.is_set():
         message_queue.put(f"Skipping fragment {fragment_id} as stop event is set")
-        return
-    if config["path_intrinsic"]:
-        intrinsic = o3d.io.read_pinhole_camera_intrinsic(config["path_intrinsic"])
-    else:
-        intrinsic = o3d.camera.PinholeCameraIntrinsic(o3d.camera.PinholeCameraIntrinsicParameters.PrimeSenseDefault)
-    sid = fragment_id * config['n_frames_per_fragment']
-    eid = min(sid + config['n_frames_per_fragment'], n_files)
-
-    make_posegraph_for_fragment(config["path_dataset"], sid, eid, color_files, depth_files, fragment_id, n_fragments, intrinsic, with_opencv, config, stop_event, message_queue)
-    if stop_event.is_set():
-        return
+        return fragment_id
+    make_posegraph_for_fragment(config["path_dataset"], sid, eid, fragment_id, pair_results, config, candidates)
     optimize_posegraph_for_fragment(config["path_dataset"], fragment_id, config)
-    if stop_event.is_set():
-        return
-    make_pointcloud_for_fragment(config["path_dataset"], color_files, depth_files, fragment_id, n_fragments, intrinsic, config, stop_event, message_queue)
+    intrinsic = read_intrinsic(config)
+    color_files, depth_files = get_frame_files(eid - 1)
+    make_pointcloud_for_fragment(config["path_dataset"], color_files, depth_files, fragment_id, n_fragments, sid, intrinsic, config, stop_event, message_queue)
+    return fragment_id
+
+def submit_fragment(pool, fragment_id, pair_results, fragment_table, intrinsic, config, candidates=None):
+    sid, eid = get_fragment_range(fragment_id, fragment_table)
+    return pool.apply_async(make_fragment_task,
+                            (fragment_id, len(fragment_table), sid, eid, pair_results, candidates),
+                            predict_integration_memory(eid - sid, intrinsic, config))
+
+def make_pair_tasks(fragment_ids, fragment_table, config, loop_candidates):
+    # 工作單位是 RGBD 幀對，所有片段的幀對共用同一個行程池，
+    # 核心使用率因此不再受片段數量限制
+    n_fragments = len(fragment_table)
+    tasks = []
+    costs = []
+    pending = {}
+    pair_results = {}
+    for fragment_id in fragment_ids:
+        sid, eid = get_fragment_range(fragment_id, fragment_table)
+        pairs = get_rgbd_pairs_for_fragment(sid, eid, config, loop_candidates.get(fragment_id))
+        pending[fragment_id] = len(pairs)
+        pair_results[fragment_id] = {}
+        for (s, t) in pairs:
+            tasks.append((fragment_id, s, t, n_fragments))
+            # 先依片段順序派送，讓前面的片段儘早完成並開始整合，
+            # 同一片段內再由成本高的幀對先執行
+            costs.append((n_fragments - fragment_id, predict_rgbd_pair_cost(s, t)))
+    return tasks, costs, pending, pair_results
+
+def add_pair_result(pool, fragment_id, s, t, pair_result, pending, pair_results, fragment_table, intrinsic, config,
+                    stop_event, loop_candidates):
+    # 記錄一個幀對的結果；片段的最後一個幀對完成時提交該片段，回傳提交的工作
+    pair_results[fragment_id][(s, t)] = pair_result
+    pending[fragment_id] -= 1
+    if pending[fragment_id] > 0 or stop_event.is_set():
+        return None
+    return submit_fragment(pool, fragment_id, pair_results.pop(fragment_id), fragment_table, intrinsic, config,
+                           loop_candidates.get(fragment_id))
 
-def run(config, stop_event, message_queue):
+def register_and_integrate(pool, tasks, costs, pending, pair_results, fragment_table, intrinsic, config,
+                           stop_event, loop_candidates):
+    pair_memory = predict_rgbd_pair_memory(intrinsic)
+
+    # 只有單一幀的片段沒有幀對，可以直接組裝
+    integrations = []
+    for fragment_id in list(pending):
+        if pending[fragment_id] == 0:
+            integrations.append(submit_fragment(pool, fragment_id, pair_results.pop(fragment_id), fragment_table,
+                                                intrinsic, config, loop_candidates.get(fragment_id)))
+
+    for fragment_id, s, t, pair_result in pool.imap_unordered(register_rgbd_pair_task, tasks, costs,
+                                                                [pair_memory] * len(tasks)):
+        if pair_result is None:
+            continue
+        integration = add_pair_result(pool, fragment_id, s, t, pair_result, pending, pair_results, fragment_table,
+                                      intrinsic, config, stop_event, loop_candidates)
+        if integration is not None:
+            integrations.append(integration)
+    return integrations
+
+def recording_in_progress(config, last_frame_time):
+    # 錄製程式在錄製期間保留標記檔；標記檔殘留但長時間沒有新幀時視為錄製已結束
+    marker = join(config["path_dataset"], config["recording_marker"])
+    return os.path.isfile(marker) and time.time() - last_frame_time < config["streaming_timeout"]
+
+def count_complete_frames(config, recording):
+    [color_files, depth_files] = get_rgbd_file_lists(config["path_dataset"])
+    n_files = min(len(color_files), len(depth_files))
+    # 錄製中的最後一幀可能仍在寫入
+    return max(n_files - 1, 0) if recording else n_files
+
+def run_streaming(pool, intrinsic, config, stop_event, message_queue):
+    # 錄製進行中就監看幀資料夾，每累積 n_frames_per_fragment 幀立即建立該片段；
+    # 幀對以單一工作提交，監看與處理完成的結果交錯進行，配準因此與錄製重疊，
+    # 錄製結束時只剩最後一個片段需要處理
+    n_frames = config['n_frames_per_fragment']
+    pair_memory = predict_rgbd_pair_memory(intrinsic)
+    fragment_table = []
+    integrations = []
+    running = []
+    pending = {}
+    pair_results = {}
+    last_frame_time = time.time()
+    n_seen = 0
+    pool.plan_stage(len(get_rgbd_pairs_for_fragment(0, n_frames, config)))
+    message_queue.put("Streaming :: waiting for recorded frames")
+    while not stop_event.is_set():
+        recording = recording_in_progress(config, last_frame_time)
+        n_files = count_complete_frames(config, recording)
+        if n_files > n_seen:
+            n_seen = n_files
+            last_frame_time = time.time()
+        sid = fragment_table[-1][1] if fragment_table else 0
+        progressed = False
+        if n_files - sid >= n_frames or (not recording and n_files > sid):
+            fragment_id = len(fragment_table)
+            fragment_table.append((sid, min(sid + n_frames, n_files)))
+            write_fragment_table(config, fragment_table)
+            message_queue.put(f"Streaming :: fragment {fragment_id} with frames {sid} to {fragment_table[-1][1] - 1}")
+            tasks, costs, fragment_pending, fragment_results = make_pair_tasks([fragment_id], fragment_table, config, {})
+            pending.update(fragment_pending)
+            pair_results.update(fragment_results)
+            if pending[fragment_id] == 0:
+                integrations.append(submit_fragment(pool, fragment_id, pair_results.pop(fragment_id),
+                                                    fragment_table, intrinsic, config))
+            pending_tasks = schedule_by_cost(tasks, costs)
+            while pending_tasks:
+                running.append(pool.apply_async(register_rgbd_pair_task, pending_tasks.pop(), pair_memory))
+            progressed = True
+        # 處理已完成的幀對，未完成的留到下一輪
+        still_running = []
+        for result in running:
+            if not result.ready():
+                still_running.append(result)
+                continue
+            fragment_id, s, t, pair_result = result.get()
+            progressed = True
+            if pair_result is None:
+                continue
+            integration = add_pair_result(pool, fragment_id, s, t, pair_result, pending, pair_results,
+                                          fragment_table, intrinsic, config, stop_event, {})
+            if integration is not None:
+                integrations.append(integration)
+        running = still_running
+        if not recording and not running and n_files <= (fragment_table[-1][1] if fragment_table else 0):
+            break
+        if not progressed:
+            time.sleep(config["streaming_poll_interval"])
+    return integrations
+
+def run(config, stop_event, message_queue, pool=None):
     message_queue.put("making fragments from RGBD sequence.")
     make_clean_folder(join(config["path_dataset"], config["folder_fragment"]))
 
-    [color_files, depth_files] = get_rgbd_file_lists(config["path_dataset"])
-    n_files = len(color_files)
-    n_fragments = int(math.ceil(float(n_files) / config['n_frames_per_fragment']))
-
-    if config["python_multi_threading"] is True:
-        max_workers = min(max(1, multiprocessing.cpu_count() - 1), n_fragments)
-        os.environ['OMP_NUM_THREADS'] = '1'
-        mp_context = multiprocessing.get_context('spawn')
-        with mp_context.Pool(processes=max_workers) as pool:
-            args = [(fragment_id, color_files, depth_files, n_files, n_fragments, config, stop_event, message_queue) for fragment_id in range(n_fragments)]
-            pool.starmap(process_single_fragment, args)
-    else:
-        for fragment_id in range(n_fragments):
-            process_single_fragment(fragment_id, color_files, depth_files, n_files, n_fragments, config, stop_event, message_queue)
+    with stage_pool(pool, config, stop_event, message_queue) as pool:
+        intrinsic = read_intrinsic(config)
+        if config["streaming"]:
+            # 串流模式下總數未知，進度總數隨完成數量增加
+            message_queue.begin(PROGRESS_PAIRS, 0, "pairs")
+            message_queue.begin(PROGRESS_INTEGRATION, 0, "frames")
+            integrations = run_streaming(pool, intrinsic, config, stop_event, message_queue)
+        else:
+            n_files = len(get_shared("color_files"))
+            fragment_table = make_fragment_table(config, get_shared("depth_files"), message_queue)
+            loop_candidates = {}
+            if config["loop_closure_filter"] and with_opencv:
+                loop_candidates = find_loop_closure_candidates(pool, fragment_table, intrinsic, config,
+                                                               stop_event, message_queue)
+            tasks, costs, pending, pair_results = make_pair_tasks(range(len(fragment_table)), fragment_table,
+                                                                  config, loop_candidates)
+            pool.plan_stage(len(tasks))
+            message_queue.begin(PROGRESS_PAIRS, len(tasks), "pairs")
+            message_queue.begin(PROGRESS_INTEGRATION, n_files, "frames")
+            integrations = register_and_integrate(pool, tasks, costs, pending, pair_results, fragment_table,
+                                                  intrinsic, config, stop_event, loop_candidates)
+        for integration in integrations:
+            integration.get()
+        if stop_event.is_set():
+            message_queue.put("Stopping fragment creation")
+        else:
+            message_queue.end(PROGRESS_PAIRS)
+            message_queue.end(PROGRESS_INTEGRATION)
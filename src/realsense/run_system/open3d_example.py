@@ -18,6 +18,7 @@ from warnings import warn
 import json
 import open3d as o3d
 import copy
+from bag_frames import read_image
 
 if (sys.version_info > (3, 0)):
     pyver = 3
@@ -189,8 +190,8 @@ def add_if_exists(path_dataset, folder_names):
 
 
 def read_rgbd_image(color_file, depth_file, convert_rgb_to_intensity, config):
-    color = o3d.io.read_image(color_file)
-    depth = o3d.io.read_image(depth_file)
+    color = read_image(color_file)
+    depth = read_image(depth_file)
     rgbd_image = o3d.geometry.RGBDImage.create_from_color_and_depth(
         color,
         depth,
@@ -233,17 +234,12 @@ def check_folder_structure(path_dataset):
 
 
 def write_poses_to_log(filename, poses):
+    # Format each pose with a single call and write the file at once.
+    record = '{} {} {}\n' + '{:.8f} {:.8f} {:.8f} {:.8f}\n' * 4
     with open(filename, 'w') as f:
-        for i, pose in enumerate(poses):
-            f.write('{} {} {}\n'.format(i, i, i + 1))
-            f.write('{0:.8f} {1:.8f} {2:.8f} {3:.8f}\n'.format(
-                pose[0, 0], pose[0, 1], pose[0, 2], pose[0, 3]))
-            f.write('{0:.8f} {1:.8f} {2:.8f} {3:.8f}\n'.format(
-                pose[1, 0], pose[1, 1], pose[1, 2], pose[1, 3]))
-            f.write('{0:.8f} {1:.8f} {2:.8f} {3:.8f}\n'.format(
-                pose[2, 0], pose[2, 1], pose[2, 2], pose[2, 3]))
-            f.write('{0:.8f} {1:.8f} {2:.8f} {3:.8f}\n'.format(
-                pose[3, 0], pose[3, 1], pose[3, 2], pose[3, 3]))
+        f.write(''.join(
+            record.format(i, i, i + 1, *pose.ravel())
+            for i, pose in enumerate(np.asarray(poses).reshape(-1, 4, 4))))
 
 
 def read_poses_from_log(traj_log):
@@ -20,14 +20,9 @@ from matplotlib import pyplot as plt  # for visualizing feature matching
 import copy
 
 
-def pose_estimation(source_rgbd_image, target_rgbd_image,
-                    pinhole_camera_intrinsic, debug_draw_correspondences):
-    success = False
-    trans = np.identity(4)
-
+def compute_orb_features(rgbd_image):
     # transform double array to unit8 array
-    color_cv_s = np.uint8(np.asarray(source_rgbd_image.color) * 255.0)
-    color_cv_t = np.uint8(np.asarray(target_rgbd_image.color) * 255.0)
+    color_cv = np.uint8(np.asarray(rgbd_image.color) * 255.0)
 
     orb = cv2.ORB_create(scaleFactor=1.2,
                          nlevels=8,
@@ -37,21 +32,37 @@ def pose_estimation(source_rgbd_image, target_rgbd_image,
                          scoreType=cv2.ORB_HARRIS_SCORE,
                          nfeatures=100,
                          patchSize=31)  # to save time
-    [kp_s, des_s] = orb.detectAndCompute(color_cv_s, None)
-    [kp_t, des_t] = orb.detectAndCompute(color_cv_t, None)
+    [kp, des] = orb.detectAndCompute(color_cv, None)
+    # keypoints are reduced to an (N, 2) array so the result can be cached
+    # and pickled between processes
+    pts = np.array([k.pt for k in kp], dtype=np.float64).reshape(-1, 2)
+    return pts, des
+
+
+def pose_estimation(source_rgbd_image, target_rgbd_image,
+                    pinhole_camera_intrinsic, debug_draw_correspondences,
+                    source_features=None, target_features=None):
+    success = False
+    trans = np.identity(4)
+
+    if source_features is None:
+        source_features = compute_orb_features(source_rgbd_image)
+    if target_features is None:
+        target_features = compute_orb_features(target_rgbd_image)
+    [kp_s, des_s] = source_features
+    [kp_t, des_t] = target_features
     if len(kp_s) == 0 or len(kp_t) == 0:
         return success, trans
 
     bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
     matches = bf.match(des_s, des_t)
+    if len(matches) == 0:
+        return success, trans
 
-    pts_s = []
-    pts_t = []
-    for match in matches:
-        pts_t.append(kp_t[match.trainIdx].pt)
-        pts_s.append(kp_s[match.queryIdx].pt)
-    pts_s = np.asarray(pts_s)
-    pts_t = np.asarray(pts_t)
+    query_idx = np.array([match.queryIdx for match in matches])
+    train_idx = np.array([match.trainIdx for match in matches])
+    pts_s = kp_s[query_idx]
+    pts_t = kp_t[train_idx]
     # inlier points after initial BF matching
     if debug_draw_correspondences:
         draw_correspondences(np.asarray(source_rgbd_image.color),
@@ -85,20 +96,11 @@ def pose_estimation(source_rgbd_image, target_rgbd_image,
     # make 3D correspondences
     depth_s = np.asarray(source_rgbd_image.depth)
     depth_t = np.asarray(target_rgbd_image.depth)
-    pts_xyz_s = np.zeros([3, pts_s.shape[0]])
-    pts_xyz_t = np.zeros([3, pts_s.shape[0]])
-    cnt = 0
-    for i in range(pts_s.shape[0]):
-        if mask[i]:
-            xyz_s = get_xyz_from_pts(pts_s[i, :], depth_s, pp_x, pp_y,
-                                     focal_input)
-            pts_xyz_s[:, cnt] = xyz_s
-            xyz_t = get_xyz_from_pts(pts_t[i, :], depth_t, pp_x, pp_y,
-                                     focal_input)
-            pts_xyz_t[:, cnt] = xyz_t
-            cnt = cnt + 1
-    pts_xyz_s = pts_xyz_s[:, :cnt]
-    pts_xyz_t = pts_xyz_t[:, :cnt]
+    inlier = np.asarray(mask).ravel() != 0
+    pts_xyz_s = get_xyz_from_pts_array(pts_s[inlier], depth_s, pp_x, pp_y,
+                                       focal_input)
+    pts_xyz_t = get_xyz_from_pts_array(pts_t[inlier], depth_t, pp_x, pp_y,
+                                       focal_input)
 
     success, trans, inlier_id_vec = estimate_3D_transform_RANSAC(
         pts_xyz_s, pts_xyz_t)
@@ -238,6 +240,41 @@ def get_xyz_from_pts(pts_row, depth, px, py, focal):
         return [0, 0, 0]
 
 
+def get_xyz_from_pts_array(pts, depth, px, py, focal):
+    # vectorized version of get_xyz_from_pts: pts is (N, 2), returns (3, N).
+    # points whose bilinear footprint leaves the image are set to zero, which
+    # matches the per-point version.
+    pts = np.asarray(pts, dtype=np.float64).reshape(-1, 2)
+    xyz = np.zeros([3, pts.shape[0]])
+    if pts.shape[0] == 0:
+        return xyz
+    height = depth.shape[0]
+    width = depth.shape[1]
+    u = pts[:, 0]
+    v = pts[:, 1]
+    u0 = u.astype(np.int64)
+    v0 = v.astype(np.int64)
+    valid = (u0 > 0) & (u0 < width - 1) & (v0 > 0) & (v0 < height - 1)
+    u = u[valid]
+    v = v[valid]
+    u0 = u0[valid]
+    v0 = v0[valid]
+    # bilinear depth interpolation
+    up = u - u0
+    vp = v - v0
+    d0 = depth[v0, u0]
+    d1 = depth[v0, u0 + 1]
+    d2 = depth[v0 + 1, u0]
+    d3 = depth[v0 + 1, u0 + 1]
+    d = (1 - vp) * (d1 * up + d0 * (1 - up)) + vp * (d3 * up + d2 *
+                                                     (1 - up))
+    if focal != 0:
+        xyz[0, valid] = (u - px) / focal * d
+        xyz[1, valid] = (v - py) / focal * d
+    xyz[2, valid] = d
+    return xyz
+
+
 def get_xyz_from_uv(u, v, d, px, py, focal):
     if focal != 0:
         x = (u - px) / focal * d
@@ -10,10 +10,13 @@
 import open3d as o3d
 from os.path import join
 
+from posegraph_store import read_pose_graph, write_pose_graph
+from profiling import span
+
 
 def run_posegraph_optimization(pose_graph_name, pose_graph_optimized_name,
                                max_correspondence_distance,
-                               preference_loop_closure):
+                               preference_loop_closure, config):
     # to display messages from o3d.pipelines.registration.global_optimization
     o3d.utility.set_verbosity_level(o3d.utility.VerbosityLevel.Debug)
     method = o3d.pipelines.registration.GlobalOptimizationLevenbergMarquardt()
@@ -24,10 +27,12 @@ def run_posegraph_optimization(pose_graph_name, pose_graph_optimized_name,
         edge_prune_threshold=0.25,
         preference_loop_closure=preference_loop_closure,
         reference_node=0)
-    pose_graph = o3d.io.read_pose_graph(pose_graph_name)
-    o3d.pipelines.registration.global_optimization(pose_graph, method, criteria,
-                                                   option)
-    o3d.io.write_pose_graph(pose_graph_optimized_name, pose_graph)
+    pose_graph = read_pose_graph(pose_graph_name)
+    with span("posegraph_optimization", n_nodes=len(pose_graph.nodes),
+              n_edges=len(pose_graph.edges)):
+        o3d.pipelines.registration.global_optimization(pose_graph, method, criteria,
+                                                       option)
+    write_pose_graph(pose_graph_optimized_name, pose_graph, config)
     o3d.utility.set_verbosity_level(o3d.utility.VerbosityLevel.Error)
 
 
@@ -40,7 +45,8 @@ def optimize_posegraph_for_fragment(path_dataset, fragment_id, config):
     run_posegraph_optimization(pose_graph_name, pose_graph_optimized_name,
             max_correspondence_distance = config["depth_diff_max"],
             preference_loop_closure = \
-            config["preference_loop_closure_odometry"])
+            config["preference_loop_closure_odometry"],
+            config = config)
 
 
 def optimize_posegraph_for_scene(path_dataset, config):
@@ -50,7 +56,8 @@ def optimize_posegraph_for_scene(path_dataset, config):
     run_posegraph_optimization(pose_graph_name, pose_graph_optimized_name,
             max_correspondence_distance = config["voxel_size"] * 1.4,
             preference_loop_closure = \
-            config["preference_loop_closure_registration"])
+            config["preference_loop_closure_registration"],
+            config = config)
 
 
 def optimize_posegraph_for_refined_scene(path_dataset, config):
@@ -60,4 +67,5 @@ def optimize_posegraph_for_refined_scene(path_dataset, config):
     run_posegraph_optimization(pose_graph_name, pose_graph_optimized_name,
             max_correspondence_distance = config["voxel_size"] * 1.4,
             preference_loop_closure = \
-            config["preference_loop_closure_registration"])
+            config["preference_loop_closure_registration"],
+            config = config)
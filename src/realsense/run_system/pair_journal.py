@@ -0,0 +1,118 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+
+
+def input_fingerprint(file_names, config, keys, arrays=()):
+    """
+    計算配準輸入的指紋：輸入檔案的大小與修改時間、相關配置值與附加陣列。
+    指紋不同時舊的日誌不再有效。
+
+    參數:
+    file_names (list): 輸入檔案路徑。
+    config (dict): 重建配置。
+    keys (list): 影響結果的配置鍵。
+    arrays (iterable, optional): 影響結果的附加陣列，例如初始變換。預設為空。
+    """
+    digest = hashlib.sha1()
+    for name in file_names:
+        stat = os.stat(name)
+        digest.update(f"{os.path.basename(name)}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    for key in keys:
+        digest.update(f"{key}={config[key]};".encode())
+    for array in arrays:
+        digest.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+class PairJournal:
+    def __init__(self, filename, fingerprint):
+        """
+        初始化 PairJournal 類別，將完成的配對結果逐筆附加到日誌檔。
+        重新執行時若輸入指紋相同，已記錄的配對直接沿用，只計算缺少的配對。
+
+        參數:
+        filename (str): 日誌檔路徑（JSON Lines）。
+        fingerprint (str): 輸入指紋。
+        """
+        self.filename = filename
+        self.results = {}
+        if os.path.isfile(filename) and self._load(fingerprint):
+            self.file = open(filename, 'a')
+        else:
+            self.results = {}
+            self.file = open(filename, 'w')
+            self._write({"fingerprint": fingerprint})
+
+    def _load(self, fingerprint):
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+        # 中斷時最後一行可能只寫入一部分，只讀取完整的行
+        end = data.rfind(b"\n") + 1
+        lines = data[:end].decode("utf-8", errors="replace").splitlines()
+        try:
+            if not lines or json.loads(lines[0]).get("fingerprint") != fingerprint:
+                return False
+        except json.JSONDecodeError:
+            return False
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            self.results[(entry["s"], entry["t"])] = (
+                entry["success"],
+                np.array(entry["transformation"]).reshape(4, 4),
+                np.array(entry["information"]).reshape(6, 6))
+        # 截掉不完整的最後一行，之後附加的紀錄才不會接在殘行後面而無法讀取
+        if end < len(data):
+            os.truncate(self.filename, end)
+        return True
+
+    def _write(self, entry):
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+
+    def __contains__(self, pair):
+        return pair in self.results
+
+    def __len__(self):
+        return len(self.results)
+
+    def get(self, s, t):
+        """
+        回傳已記錄的配對結果 (success, transformation, information)。
+
+        參數:
+        s (int): 來源片段索引。
+        t (int): 目標片段索引。
+        """
+        return self.results[(s, t)]
+
+    def append(self, s, t, success, transformation, information):
+        """
+        記錄一個完成的配對結果並立即寫入日誌檔。
+
+        參數:
+        s (int): 來源片段索引。
+        t (int): 目標片段索引。
+        success (bool): 配準是否成功。
+        transformation (numpy.ndarray): 變換矩陣。
+        information (numpy.ndarray): 資訊矩陣。
+        """
+        self.results[(s, t)] = (success, transformation, information)
+        self._write({
+            "s": int(s),
+            "t": int(t),
+            "success": bool(success),
+            "transformation": np.asarray(transformation).ravel().tolist(),
+            "information": np.asarray(information).ravel().tolist(),
+        })
+
+    def close(self):
+        """
+        關閉日誌檔。
+        """
+        self.file.close()
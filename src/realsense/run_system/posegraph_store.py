@@ -0,0 +1,176 @@
+import os
+
+import numpy as np
+import open3d as o3d
+
+from open3d_example import join, write_poses_to_log
+from fragment_table import read_fragment_table
+
+
+def npz_name(filename):
+    """
+    回傳姿態圖 JSON 檔名對應的二進位檔名。
+
+    參數:
+    filename (str): 配置中的姿態圖檔名（.json）。
+    """
+    return os.path.splitext(filename)[0] + ".npz"
+
+
+def pose_graph_to_arrays(pose_graph):
+    """
+    將姿態圖轉換為節點姿態、邊索引、變換矩陣與資訊矩陣的陣列。
+
+    參數:
+    pose_graph (o3d.pipelines.registration.PoseGraph): 姿態圖。
+    """
+    n_nodes = len(pose_graph.nodes)
+    n_edges = len(pose_graph.edges)
+    return {
+        "nodes": np.array([node.pose for node in pose_graph.nodes]).reshape(n_nodes, 4, 4),
+        "edges": np.array([(edge.source_node_id, edge.target_node_id)
+                           for edge in pose_graph.edges], dtype=np.int64).reshape(n_edges, 2),
+        "transformations": np.array([edge.transformation
+                                     for edge in pose_graph.edges]).reshape(n_edges, 4, 4),
+        "information": np.array([edge.information
+                                 for edge in pose_graph.edges]).reshape(n_edges, 6, 6),
+        "uncertain": np.array([edge.uncertain for edge in pose_graph.edges], dtype=bool),
+        "confidence": np.array([edge.confidence for edge in pose_graph.edges], dtype=np.float64),
+    }
+
+
+def arrays_to_pose_graph(arrays):
+    """
+    由陣列重建姿態圖。
+
+    參數:
+    arrays (dict): pose_graph_to_arrays 產生的陣列。
+    """
+    pose_graph = o3d.pipelines.registration.PoseGraph()
+    for pose in arrays["nodes"]:
+        pose_graph.nodes.append(o3d.pipelines.registration.PoseGraphNode(pose))
+    for (s, t), transformation, information, uncertain, confidence in zip(
+            arrays["edges"], arrays["transformations"], arrays["information"],
+            arrays["uncertain"], arrays["confidence"]):
+        pose_graph.edges.append(
+            o3d.pipelines.registration.PoseGraphEdge(int(s), int(t), transformation, information,
+                                                     uncertain=bool(uncertain),
+                                                     confidence=float(confidence)))
+    return pose_graph
+
+
+def write_pose_graph(filename, pose_graph, config):
+    """
+    以二進位格式寫出姿態圖，並依配置另外匯出 Open3D JSON。
+
+    參數:
+    filename (str): 配置中的姿態圖檔名（.json）。
+    pose_graph (o3d.pipelines.registration.PoseGraph): 姿態圖。
+    config (dict): 重建配置。
+    """
+    np.savez(npz_name(filename), **pose_graph_to_arrays(pose_graph))
+    if config["export_json_pose_graphs"]:
+        o3d.io.write_pose_graph(filename, pose_graph)
+
+
+def read_pose_graph(filename):
+    """
+    讀取姿態圖，沒有二進位檔時改讀 Open3D JSON（例如舊版流程產生的資料）。
+
+    參數:
+    filename (str): 配置中的姿態圖檔名（.json）。
+    """
+    if os.path.isfile(npz_name(filename)):
+        with np.load(npz_name(filename)) as data:
+            return arrays_to_pose_graph(data)
+    return o3d.io.read_pose_graph(filename)
+
+
+def read_node_poses(filename):
+    """
+    只讀取姿態圖的節點姿態，回傳形狀為 (N, 4, 4) 的陣列。
+
+    參數:
+    filename (str): 配置中的姿態圖檔名（.json）。
+    """
+    if os.path.isfile(npz_name(filename)):
+        with np.load(npz_name(filename)) as data:
+            return data["nodes"]
+    pose_graph = o3d.io.read_pose_graph(filename)
+    return np.array([node.pose for node in pose_graph.nodes]).reshape(len(pose_graph.nodes), 4, 4)
+
+
+def compose_trajectory(fragment_poses, local_poses, config):
+    """
+    以批次矩陣乘法將片段姿態與片段內的幀姿態組合為全域軌跡。
+
+    參數:
+    fragment_poses (numpy.ndarray): 每個片段在場景中的姿態，形狀為 (F, 4, 4)。
+    local_poses (list): 每個片段內各幀的姿態陣列。
+    config (dict): 重建配置。
+
+    回傳:
+    tuple: (幀索引, 片段索引, 幀姿態)
+    """
+    fragment_table = read_fragment_table(config)
+    frame_ids = [fragment_table[fragment_id][0] + np.arange(len(poses))
+                 for fragment_id, poses in enumerate(local_poses)]
+    fragment_ids = np.concatenate([np.full(len(poses), fragment_id)
+                                   for fragment_id, poses in enumerate(local_poses)])
+    poses = np.matmul(fragment_poses[fragment_ids], np.concatenate(local_poses))
+    return np.concatenate(frame_ids), fragment_ids, poses
+
+
+def build_global_trajectory(path_dataset, config):
+    """
+    由細化後的場景姿態圖與各片段的姿態圖計算全域軌跡並寫出。
+
+    參數:
+    path_dataset (str): 數據集路徑。
+    config (dict): 重建配置。
+    """
+    fragment_poses = read_node_poses(
+        join(path_dataset, config["template_refined_posegraph_optimized"]))
+    local_poses = [
+        read_node_poses(join(path_dataset,
+                             config["template_fragment_posegraph_optimized"] % fragment_id))
+        for fragment_id in range(len(fragment_poses))
+    ]
+    frame_ids, fragment_ids, poses = compose_trajectory(fragment_poses, local_poses, config)
+    write_global_trajectory(path_dataset, config, frame_ids, fragment_ids, poses)
+    return frame_ids, fragment_ids, poses
+
+
+def write_global_trajectory(path_dataset, config, frame_ids, fragment_ids, poses):
+    """
+    寫出全域軌跡陣列，並依配置另外匯出 .log 格式。
+
+    參數:
+    path_dataset (str): 數據集路徑。
+    config (dict): 重建配置。
+    frame_ids (numpy.ndarray): 幀索引。
+    fragment_ids (numpy.ndarray): 每一幀所屬的片段索引。
+    poses (numpy.ndarray): 每一幀的姿態，形狀為 (N, 4, 4)。
+    """
+    np.savez(join(path_dataset, config["template_global_trajectory"]),
+             frame_ids=frame_ids, fragment_ids=fragment_ids, poses=poses)
+    if config["export_trajectory_log"]:
+        write_poses_to_log(join(path_dataset, config["template_global_traj"]), poses)
+
+
+def read_global_trajectory(path_dataset, config):
+    """
+    一次讀入全域軌跡；尚未產生時由姿態圖計算。
+
+    參數:
+    path_dataset (str): 數據集路徑。
+    config (dict): 重建配置。
+
+    回傳:
+    tuple: (幀索引, 片段索引, 幀姿態)
+    """
+    filename = join(path_dataset, config["template_global_trajectory"])
+    if not os.path.isfile(filename):
+        return build_global_trajectory(path_dataset, config)
+    with np.load(filename) as data:
+        return data["frame_ids"], data["fragment_ids"], data["poses"]
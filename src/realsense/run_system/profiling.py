@@ -0,0 +1,185 @@
+import os
+import io
+import glob
+import json
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+# 目前行程記錄的區段事件，啟用分析模式時才會寫入檔案
+_spans = []
+_lock = threading.Lock()
+_trace_dir = None
+
+
+def enable(trace_dir):
+    """
+    啟用目前行程的區段記錄，事件會寫入 trace_dir 下以行程編號命名的檔案。
+
+    參數:
+    trace_dir (str): 分析結果資料夾。
+    """
+    global _trace_dir
+    os.makedirs(trace_dir, exist_ok=True)
+    _trace_dir = trace_dir
+
+
+def disable():
+    """
+    停用目前行程的區段記錄。
+    """
+    global _trace_dir
+    flush()
+    _trace_dir = None
+
+
+def enabled():
+    """
+    回傳目前行程是否啟用區段記錄。
+    """
+    return _trace_dir is not None
+
+
+def configure(config):
+    """
+    依配置啟用或停用目前行程的區段記錄，工作行程在初始化時呼叫。
+
+    參數:
+    config (dict): 重建配置。
+    """
+    if config.get("profiling"):
+        enable(get_trace_dir(config))
+    else:
+        disable()
+
+
+def get_trace_dir(config):
+    """
+    回傳分析結果資料夾。
+
+    參數:
+    config (dict): 重建配置。
+    """
+    return os.path.join(config["path_dataset"], config["folder_profiling"])
+
+
+@contextmanager
+def span(name, category="task", **args):
+    """
+    記錄一個區段事件；未啟用時不做任何事。
+
+    參數:
+    name (str): 區段名稱。
+    category (str, optional): 區段分類。預設為 "task"。
+    **args: 附加在事件上的資訊。
+    """
+    if _trace_dir is None:
+        yield
+        return
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": start_time * 1e6,
+            "dur": (time.time() - start_time) * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        }
+        with _lock:
+            _spans.append(event)
+
+
+def flush():
+    """
+    將尚未寫出的區段事件附加到目前行程的事件檔。
+    """
+    global _spans
+    if _trace_dir is None:
+        return
+    with _lock:
+        if not _spans:
+            return
+        spans, _spans = _spans, []
+    with open(os.path.join(_trace_dir, f"spans_{os.getpid()}.jsonl"), 'a') as f:
+        f.write("".join(json.dumps(event) + "\n" for event in spans))
+
+
+def merge_trace(trace_dir, filename, main_pid=None):
+    """
+    合併所有行程的區段事件為一個 Chrome trace-event JSON。
+
+    參數:
+    trace_dir (str): 分析結果資料夾。
+    filename (str): 輸出的 trace 檔案路徑。
+    main_pid (int, optional): 主行程編號，用於標示行程名稱。預設為 None。
+    """
+    events = []
+    pids = set()
+    for spans_file in sorted(glob.glob(os.path.join(trace_dir, "spans_*.jsonl"))):
+        with open(spans_file) as f:
+            for line in f:
+                event = json.loads(line)
+                pids.add(event["pid"])
+                events.append(event)
+    for pid in sorted(pids):
+        events.append({"name": "process_name", "ph": "M", "pid": pid,
+                       "args": {"name": "main" if pid == main_pid else f"worker {pid}"}})
+    with open(filename, 'w') as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    return len(events)
+
+
+class StageProfiler:
+    def __init__(self, stage, trace_dir, n_stats=40):
+        """
+        初始化 StageProfiler 類別，在主行程中以 cProfile 與 tracemalloc 分析單一階段。
+
+        參數:
+        stage (str): 階段名稱。
+        trace_dir (str): 分析結果資料夾。
+        n_stats (int, optional): 文字摘要列出的函數數量。預設為 40。
+        """
+        self.stage = stage
+        self.trace_dir = trace_dir
+        self.n_stats = n_stats
+        self.profile = cProfile.Profile()
+        self.peak_memory = 0
+
+    def __enter__(self):
+        self._span = span(self.stage, "stage")
+        self._span.__enter__()
+        tracemalloc.start()
+        self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profile.disable()
+        _, self.peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self._span.__exit__(exc_type, exc, tb)
+        with _lock:
+            if _spans and _spans[-1]["name"] == self.stage:
+                _spans[-1]["args"]["peak_python_memory_mb"] = self.peak_memory / 1024.0 ** 2
+        flush()
+
+        self.profile.dump_stats(os.path.join(self.trace_dir, f"{self.stage}.prof"))
+        text = io.StringIO()
+        pstats.Stats(self.profile, stream=text).sort_stats("cumulative").print_stats(self.n_stats)
+        with open(os.path.join(self.trace_dir, f"{self.stage}.txt"), 'w') as f:
+            f.write(text.getvalue())
+        return False
+
+    def summary(self):
+        """
+        回傳階段分析的文字摘要。
+        """
+        return (f"{self.stage}: peak Python memory {self.peak_memory / 1024.0 ** 2:.1f} MB, "
+                f"profile written to {self.stage}.prof")
@@ -0,0 +1,186 @@
+import time
+import datetime
+import threading
+
+
+class ProgressChannel:
+    def __init__(self, queue, interval=0.5):
+        """
+        初始化 ProgressChannel 類別，作為主行程與工作行程之間的輕量進度通道。
+
+        工作行程送出的結構化進度事件會先在行程內合併，再由背景執行緒以固定頻率送出，
+        取代每一幀、每一對都經過 Manager 行程的字串訊息。
+
+        參數:
+        queue (multiprocessing.Queue): 傳送事件的佇列，需在建立工作行程時傳入。
+        interval (float, optional): 合併事件送出的間隔秒數。預設為 0.5。
+        """
+        self.queue = queue
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flusher = None
+
+    def __getstate__(self):
+        return {"queue": self.queue, "interval": self.interval}
+
+    def __setstate__(self, state):
+        self.__init__(state["queue"], state["interval"])
+
+    def put(self, message):
+        """
+        送出一行文字訊息，介面與原本的訊息佇列相同，供少量的狀態訊息使用。
+
+        參數:
+        message (str): 訊息內容。
+        """
+        self.flush()
+        self.queue.put(("log", message))
+
+    def begin(self, stage, total, unit):
+        """
+        宣告一個階段的工作總量。
+
+        參數:
+        stage (str): 階段名稱。
+        total (int): 工作總數。
+        unit (str): 工作單位，例如 "pairs"、"frames"。
+        """
+        self.flush()
+        self.queue.put(("begin", stage, total, unit, time.time()))
+
+    def end(self, stage):
+        """
+        宣告一個階段已完成。
+
+        參數:
+        stage (str): 階段名稱。
+        """
+        self.flush()
+        self.queue.put(("end", stage))
+
+    def update(self, stage, fragment=None, done=1, elapsed=0.0):
+        """
+        記錄完成的工作，事件會與同一階段、同一片段的事件合併後再送出。
+
+        參數:
+        stage (str): 階段名稱。
+        fragment (int, optional): 片段索引。預設為 None。
+        done (int, optional): 完成的工作數。預設為 1。
+        elapsed (float, optional): 這些工作花費的秒數。預設為 0.0。
+        """
+        with self._lock:
+            key = (stage, fragment)
+            count, seconds = self._pending.get(key, (0, 0.0))
+            self._pending[key] = (count + done, seconds + elapsed)
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+                self._flusher.start()
+
+    def empty(self):
+        """
+        回傳佇列是否已清空。
+        """
+        return self.queue.empty()
+
+    def flush(self):
+        """
+        立即送出尚未送出的進度事件。
+        """
+        with self._lock:
+            if not self._pending:
+                return
+            events = [(stage, fragment, count, seconds)
+                      for (stage, fragment), (count, seconds) in self._pending.items()]
+            self._pending = {}
+        self.queue.put(("progress", events))
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+
+class StageProgress:
+    def __init__(self, stage, total, unit, start_time):
+        """
+        初始化 StageProgress 類別，記錄單一階段的彙總進度。
+
+        參數:
+        stage (str): 階段名稱。
+        total (int): 工作總數。
+        unit (str): 工作單位。
+        start_time (float): 階段開始時間。
+        """
+        self.stage = stage
+        self.total = total
+        self.unit = unit
+        self.start_time = start_time
+        self.done = 0
+        self.work_time = 0.0
+
+    def summary(self):
+        """
+        回傳包含完成比例與預估剩餘時間的進度文字。
+        """
+        elapsed = time.time() - self.start_time
+        if self.total > 0:
+            percent = 100.0 * self.done / self.total
+        else:
+            percent = 100.0
+        if self.done > 0 and self.total > self.done:
+            eta = datetime.timedelta(seconds=int(elapsed / self.done * (self.total - self.done)))
+        else:
+            eta = "-"
+        message = (f"{self.stage} :: {self.done} / {self.total} {self.unit} ({percent:.1f}%), "
+                   f"elapsed {datetime.timedelta(seconds=int(elapsed))}, ETA {eta}")
+        if self.done > 0:
+            message += f", {self.work_time / self.done:.2f} s per {self.unit[:-1] if self.unit.endswith('s') else self.unit}"
+        return message
+
+
+class ProgressAggregator:
+    def __init__(self):
+        """
+        初始化 ProgressAggregator 類別，在主行程彙總各工作行程的進度事件。
+        """
+        self.stages = {}
+        self.changed = set()
+
+    def handle(self, event):
+        """
+        處理一個進度通道的事件，若為文字訊息則回傳該訊息。
+
+        參數:
+        event (tuple): 進度通道送出的事件。
+        """
+        kind = event[0]
+        if kind == "log":
+            return event[1]
+        if kind == "begin":
+            _, stage, total, unit, start_time = event
+            self.stages[stage] = StageProgress(stage, total, unit, start_time)
+            self.changed.add(stage)
+        elif kind == "end":
+            progress = self.stages.get(event[1])
+            if progress is not None:
+                progress.done = max(progress.done, progress.total)
+                self.changed.add(event[1])
+        elif kind == "progress":
+            for stage, fragment, count, seconds in event[1]:
+                progress = self.stages.get(stage)
+                if progress is None:
+                    progress = self.stages[stage] = StageProgress(stage, 0, "tasks", time.time())
+                progress.done += count
+                progress.work_time += seconds
+                progress.total = max(progress.total, progress.done)
+                self.changed.add(stage)
+        return None
+
+    def pop_changed(self):
+        """
+        取出自上次呼叫後有更新的階段進度。
+        """
+        changed = [self.stages[stage] for stage in sorted(self.changed)]
+        self.changed = set()
+        return changed
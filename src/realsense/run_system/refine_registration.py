@@ -7,16 +7,25 @@
 
 # examples/python/reconstruction_system/refine_registration.py
 
-import multiprocessing
 import os
 import sys
+import json
+import time
 
 import numpy as np
 import open3d as o3d
 
-from open3d_example import join, get_file_list, write_poses_to_log, draw_registration_result_original_color
+from open3d_example import join, get_file_list, draw_registration_result_original_color
 
 from optimize_posegraph import optimize_posegraph_for_refined_scene
+from posegraph_store import read_pose_graph, write_pose_graph, build_global_trajectory
+from worker_pool import get_shared, stage_pool
+from profiling import span
+from fragment_levels import read_fragment_pointcloud, get_level_file_names, get_level_voxel_sizes
+from pair_journal import PairJournal, input_fingerprint
+
+# 進度通道中的階段名稱
+PROGRESS_REFINE = "Refine registration"
 
 
 def update_posegraph_for_scene(s, t, transformation, information, odometry,
@@ -42,6 +51,106 @@ def update_posegraph_for_scene(s, t, transformation, information, odometry,
     return (odometry, pose_graph)
 
 
+class PoseGraphBuilder:
+
+    def __init__(self):
+        """
+        初始化 PoseGraphBuilder 類別，在配對結果陸續完成時即時加入姿態圖。
+
+        里程計邊必須依序串接節點，未接續的結果會先暫存；閉環邊則直接加入。
+        """
+        self.odometry = np.identity(4)
+        self.pose_graph = o3d.pipelines.registration.PoseGraph()
+        self.pose_graph.nodes.append(
+            o3d.pipelines.registration.PoseGraphNode(self.odometry))
+        self.next_source = 0
+        self.pending_odometry = {}
+
+    def add(self, s, t, transformation, information):
+        """
+        加入一個配對結果。
+
+        參數:
+        s (int): 來源片段索引。
+        t (int): 目標片段索引。
+        transformation (numpy.ndarray): 變換矩陣。
+        information (numpy.ndarray): 資訊矩陣。
+        """
+        if t != s + 1:
+            (self.odometry, self.pose_graph) = update_posegraph_for_scene(
+                s, t, transformation, information, self.odometry,
+                self.pose_graph)
+            return
+        self.pending_odometry[s] = (transformation, information)
+        while self.next_source in self.pending_odometry:
+            (transformation, information) = \
+                self.pending_odometry.pop(self.next_source)
+            (self.odometry, self.pose_graph) = update_posegraph_for_scene(
+                self.next_source, self.next_source + 1, transformation,
+                information, self.odometry, self.pose_graph)
+            self.next_source += 1
+
+
+def predict_pair_cost(ply_file_names, s, t):
+    # 配準成本大致與兩個片段的點數成正比，以檔案大小估計
+    return os.path.getsize(ply_file_names[s]) + os.path.getsize(ply_file_names[t])
+
+
+def predict_pair_memory(ply_file_names, s, t, factor=6.0):
+    # 點雲在記憶體中另有法向量、KD 樹與降採樣副本，峰值約為檔案大小的數倍
+    return int(factor * predict_pair_cost(ply_file_names, s, t)) + 64 * 1024 ** 2
+
+
+def icp_distance_threshold(voxel_size, config):
+    # 彩色 ICP 以該尺度的體素大小為對應距離，其他方法固定使用 voxel_size * 1.4
+    if config["icp_method"] == "color":
+        return voxel_size
+    return config["voxel_size"] * 1.4
+
+
+def icp_criteria(max_iteration, config):
+    # 自適應模式在一次 ICP 呼叫內依適配度與 RMSE 的相對變化提前結束，
+    # KD 樹與彩色梯度每個尺度只建立一次
+    if config["icp_adaptive"]:
+        return o3d.pipelines.registration.ICPConvergenceCriteria(
+            relative_fitness=config["icp_converged_fitness"],
+            relative_rmse=config["icp_converged_rmse"],
+            max_iteration=max_iteration)
+    return o3d.pipelines.registration.ICPConvergenceCriteria(
+        relative_fitness=1e-6,
+        relative_rmse=1e-6,
+        max_iteration=max_iteration)
+
+
+def run_icp(source_down, target_down, voxel_size, transformation, max_iteration, config):
+    distance_threshold = icp_distance_threshold(voxel_size, config)
+    criteria = icp_criteria(max_iteration, config)
+    if config["icp_method"] == "point_to_point":
+        return o3d.pipelines.registration.registration_icp(
+            source_down, target_down, distance_threshold,
+            transformation,
+            o3d.pipelines.registration.TransformationEstimationPointToPoint(),
+            criteria)
+    if config["icp_method"] == "point_to_plane":
+        return o3d.pipelines.registration.registration_icp(
+            source_down, target_down, distance_threshold,
+            transformation,
+            o3d.pipelines.registration.TransformationEstimationPointToPlane(),
+            criteria)
+    if config["icp_method"] == "color":
+        return o3d.pipelines.registration.registration_colored_icp(
+            source_down, target_down, distance_threshold,
+            transformation,
+            o3d.pipelines.registration.TransformationEstimationForColoredICP(),
+            criteria)
+    if config["icp_method"] == "generalized":
+        return o3d.pipelines.registration.registration_generalized_icp(
+            source_down, target_down, distance_threshold,
+            transformation,
+            o3d.pipelines.registration.TransformationEstimationForGeneralizedICP(),
+            criteria)
+
+
 def multiscale_icp(source,
                    target,
                    voxel_size,
@@ -49,100 +158,130 @@ def multiscale_icp(source,
                    config,
                    init_transformation=np.identity(4),
                    stop_event=None,
-                   message_queue=None):
+                   message_queue=None,
+                   stats=None):
+    start_time = time.time()
     current_transformation = init_transformation
+    n_scales = 0
+    overlap = None
     for i, scale in enumerate(range(len(max_iter))):  # multi-scale approach
         if stop_event is not None and stop_event.is_set():
             message_queue.put("Stopping multiscale ICP")
             return (current_transformation, np.zeros((6, 6)))
 
         iter = max_iter[scale]
-        distance_threshold = config["voxel_size"] * 1.4
-        message_queue.put(f"voxel_size {voxel_size[scale]}")
-        source_down = source.voxel_down_sample(voxel_size[scale])
-        target_down = target.voxel_down_sample(voxel_size[scale])
-        if config["icp_method"] == "point_to_point":
-            result_icp = o3d.pipelines.registration.registration_icp(
-                source_down, target_down, distance_threshold,
-                current_transformation,
-                o3d.pipelines.registration.TransformationEstimationPointToPoint(),
-                o3d.pipelines.registration.ICPConvergenceCriteria(
-                    max_iteration=iter))
+        # 傳入各尺度的降採樣點雲時直接使用，否則由完整點雲降採樣
+        if isinstance(source, list):
+            source_down = source[scale]
+            target_down = target[scale]
         else:
-            source_down.estimate_normals(
-                o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size[scale] *
-                                                     2.0,
-                                                     max_nn=30))
-            target_down.estimate_normals(
-                o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size[scale] *
-                                                     2.0,
-                                                     max_nn=30))
-            if config["icp_method"] == "point_to_plane":
-                result_icp = o3d.pipelines.registration.registration_icp(
-                    source_down, target_down, distance_threshold,
-                    current_transformation,
-                    o3d.pipelines.registration.TransformationEstimationPointToPlane(),
-                    o3d.pipelines.registration.ICPConvergenceCriteria(
-                        max_iteration=iter))
-            if config["icp_method"] == "color":
-                result_icp = o3d.pipelines.registration.registration_colored_icp(
-                    source_down, target_down, voxel_size[scale],
-                    current_transformation,
-                    o3d.pipelines.registration.TransformationEstimationForColoredICP(),
-                    o3d.pipelines.registration.ICPConvergenceCriteria(
-                        relative_fitness=1e-6,
-                        relative_rmse=1e-6,
-                        max_iteration=iter))
-            if config["icp_method"] == "generalized":
-                result_icp = o3d.pipelines.registration.registration_generalized_icp(
-                    source_down, target_down, distance_threshold,
-                    current_transformation,
-                    o3d.pipelines.registration.TransformationEstimationForGeneralizedICP(),
-                    o3d.pipelines.registration.ICPConvergenceCriteria(
-                        relative_fitness=1e-6,
-                        relative_rmse=1e-6,
-                        max_iteration=iter))
+            source_down = source.voxel_down_sample(voxel_size[scale])
+            target_down = target.voxel_down_sample(voxel_size[scale])
+        if config["icp_method"] != "point_to_point":
+            if not source_down.has_normals():
+                source_down.estimate_normals(
+                    o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size[scale] *
+                                                         2.0,
+                                                         max_nn=30))
+            if not target_down.has_normals():
+                target_down.estimate_normals(
+                    o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size[scale] *
+                                                         2.0,
+                                                         max_nn=30))
+        icp_source = source_down
+        if overlap is not None:
+            # 只保留靠近上一尺度對應點的來源點，離重疊區太遠的點在此尺度也找不到對應
+            distances = np.asarray(source_down.compute_point_cloud_distance(overlap))
+            icp_source = source_down.select_by_index(
+                np.flatnonzero(distances <= voxel_size[scale - 1]).tolist())
+        if config["icp_adaptive"]:
+            start = o3d.pipelines.registration.evaluate_registration(
+                icp_source, target_down, icp_distance_threshold(voxel_size[scale], config),
+                current_transformation)
+        # 上一尺度的結果作為此尺度的初始變換
+        result_icp = run_icp(icp_source, target_down, voxel_size[scale],
+                             current_transformation, iter, config)
+        n_scales += 1
         current_transformation = result_icp.transformation
-        if i == len(max_iter) - 1:
-            information_matrix = o3d.pipelines.registration.get_information_matrix_from_point_clouds(
-                source_down, target_down, voxel_size[scale] * 1.4,
-                result_icp.transformation)
+        # 自適應模式以此尺度的對應點集合限制下一尺度的來源點
+        correspondences = np.asarray(result_icp.correspondence_set)
+        if config["icp_adaptive"] and len(correspondences) > 0:
+            overlap = icp_source.select_by_index(np.unique(correspondences[:, 0]).tolist())
+        else:
+            overlap = None
+        # 粗尺度上幾乎沒有改善時，初始變換已足夠準確，略過更細的尺度
+        if (config["icp_adaptive"] and scale < len(max_iter) - 1 and
+                abs(result_icp.fitness - start.fitness) < config["icp_skip_fitness"] and
+                abs(result_icp.inlier_rmse - start.inlier_rmse) < config["icp_skip_rmse"]):
+            break
+
+    # 資訊矩陣一律在最精細的尺度上計算，略過尺度時姿態圖的權重仍一致
+    if n_scales < len(max_iter):
+        if isinstance(source, list):
+            source_down = source[-1]
+            target_down = target[-1]
+        else:
+            source_down = source.voxel_down_sample(voxel_size[-1])
+            target_down = target.voxel_down_sample(voxel_size[-1])
+    information_matrix = o3d.pipelines.registration.get_information_matrix_from_point_clouds(
+        source_down, target_down, voxel_size[-1] * 1.4,
+        current_transformation)
 
+    if stats is not None:
+        stats["scales_run"] = n_scales
+        stats["n_scales"] = len(max_iter)
+        stats["time"] = time.time() - start_time
     if config["debug_mode"]:
-        draw_registration_result_original_color(source, target,
-                                                result_icp.transformation)
-    return (result_icp.transformation, information_matrix)
+        draw_registration_result_original_color(source_down, target_down,
+                                                current_transformation)
+    return (current_transformation, information_matrix)
 
 
-def local_refinement(source, target, transformation_init, config, stop_event, message_queue):
-    voxel_size = config["voxel_size"]
-    (transformation, information) = \
-            multiscale_icp(
-            source, target,
-            [voxel_size, voxel_size/2.0, voxel_size/4.0], [50, 30, 14],
-            config, transformation_init, stop_event, message_queue)
+def local_refinement(source, target, transformation_init, config, stop_event, message_queue, stats=None):
+    with span("multiscale_icp"):
+        (transformation, information) = \
+                multiscale_icp(
+                source, target,
+                get_level_voxel_sizes(config), [50, 30, 14],
+                config, transformation_init, stop_event, message_queue, stats)
 
     return (transformation, information)
 
 
 def register_point_cloud_pair(ply_file_names, s, t, transformation_init,
-                              config, stop_event, message_queue):
+                              config, stop_event, message_queue, stats=None):
     if stop_event.is_set():
         message_queue.put(f"Stopping registration of point cloud pair {s} and {t}")
         return (np.identity(4), np.identity(6))
 
-    message_queue.put(f"reading {ply_file_names[s]} ...")
-    source = o3d.io.read_point_cloud(ply_file_names[s])
-    message_queue.put(f"reading {ply_file_names[t]} ...")
-    target = o3d.io.read_point_cloud(ply_file_names[t])
+    # 只讀取各尺度需要的降採樣點雲
+    source = [read_fragment_pointcloud(config, s, v) for v in get_level_voxel_sizes(config)]
+    target = [read_fragment_pointcloud(config, t, v) for v in get_level_voxel_sizes(config)]
     (transformation, information) = \
-            local_refinement(source, target, transformation_init, config, stop_event, message_queue)
+            local_refinement(source, target, transformation_init, config, stop_event, message_queue, stats)
     if config["debug_mode"]:
         message_queue.put(str(transformation))
         message_queue.put(str(information))
     return (transformation, information)
 
 
+def register_point_cloud_pair_task(s, t, transformation_init):
+    config = get_shared("config")
+    ply_file_names = {
+        i: join(config["path_dataset"], config["template_fragment_pointcloud"] % i)
+        for i in (s, t)
+    }
+    message_queue = get_shared("message_queue")
+    start_time = time.time()
+    stats = {}
+    result = register_point_cloud_pair(ply_file_names, s, t,
+                                       transformation_init, config,
+                                       get_shared("stop_event"),
+                                       message_queue, stats)
+    message_queue.update(PROGRESS_REFINE, None, 1, time.time() - start_time)
+    return (s, t, result, stats)
+
+
 class matching_result:
 
     def __init__(self, s, t, trans):
@@ -153,8 +292,18 @@ class matching_result:
         self.infomation = np.identity(6)
 
 
-def make_posegraph_for_refined_scene(ply_file_names, config, stop_event, message_queue):
-    pose_graph = o3d.io.read_pose_graph(
+def write_icp_stats(filename, icp_stats, message_queue):
+    # 每個邊執行的尺度數與 ICP 耗時
+    with open(filename, 'w') as f:
+        json.dump(icp_stats, f, indent=4)
+    n_skipped = sum(stats["scales_run"] < stats["n_scales"] for stats in icp_stats)
+    message_queue.put(
+        f"Multiscale ICP :: finer scales skipped on {n_skipped} of {len(icp_stats)} edges, "
+        f"{sum(stats['time'] for stats in icp_stats):.1f} s of worker time")
+
+
+def make_posegraph_for_refined_scene(ply_file_names, config, stop_event, message_queue, pool):
+    pose_graph = read_pose_graph(
         join(config["path_dataset"],
              config["template_global_posegraph_optimized"]))
 
@@ -166,71 +315,67 @@ def make_posegraph_for_refined_scene(ply_file_names, config, stop_event, message
         matching_results[s * n_files + t] = \
             matching_result(s, t, edge.transformation)
 
-    if config["python_multi_threading"] is True:
-        os.environ['OMP_NUM_THREADS'] = '1'
-        max_workers = max(
-            1, min(multiprocessing.cpu_count() - 1, len(pose_graph.edges)))
-        mp_context = multiprocessing.get_context('spawn')
-        with mp_context.Pool(processes=max_workers) as pool:
-            args = [(ply_file_names, v.s, v.t, v.transformation, config, stop_event, message_queue)
-                    for k, v in matching_results.items()]
-            results = pool.starmap(register_point_cloud_pair, args)
-
-        for i, r in enumerate(matching_results):
-            matching_results[r].transformation = results[i][0]
-            matching_results[r].information = results[i][1]
+    message_queue.begin(PROGRESS_REFINE, len(matching_results), "pairs")
+
+    # 每個完成的配對都寫入日誌，重新執行時只計算日誌中缺少的配對；
+    # 初始變換來自全域配準，因此也納入輸入指紋
+    journal = PairJournal(
+        join(config["path_dataset"], config["template_refine_journal"]),
+        input_fingerprint(ply_file_names, config, ["voxel_size", "icp_method"],
+                          [v.transformation for k, v in matching_results.items()]))
+    builder = PoseGraphBuilder()
+    for k, v in matching_results.items():
+        if (v.s, v.t) in journal:
+            (_, v.transformation, v.information) = journal.get(v.s, v.t)
+            builder.add(v.s, v.t, v.transformation, v.information)
+    if len(journal) > 0:
+        message_queue.put(f"Resuming refined registration :: {len(journal)} pairs from journal")
+        message_queue.update(PROGRESS_REFINE, None, len(journal), 0.0)
+
+    # 配對結果一完成就加入姿態圖，不必等待所有工作結束
+    remaining = [v for k, v in matching_results.items() if (v.s, v.t) not in journal]
+    args = [(v.s, v.t, v.transformation) for v in remaining]
+    costs = [predict_pair_cost(ply_file_names, v.s, v.t) for v in remaining]
+    memory = [predict_pair_memory(ply_file_names, v.s, v.t) for v in remaining]
+    pool.plan_stage(len(args))
+    icp_stats = []
+    for (s, t, result, stats) in pool.imap_unordered(register_point_cloud_pair_task, args, costs, memory):
+        r = s * n_files + t
+        (matching_results[r].transformation,
+         matching_results[r].information) = result
+        if stats:
+            icp_stats.append(dict(stats, s=s, t=t))
+        # 停止後完成的配對可能是提前中止的結果，不寫入日誌
+        if not stop_event.is_set():
+            journal.append(s, t, True, *result)
+        builder.add(s, t, matching_results[r].transformation,
+                    matching_results[r].information)
+    journal.close()
+    if icp_stats:
+        write_icp_stats(join(config["path_dataset"], config["template_refine_icp_stats"]),
+                        icp_stats, message_queue)
+    if stop_event.is_set():
+        message_queue.put("Stopping posegraph creation for refined scene")
     else:
-        for r in matching_results:
-            if stop_event.is_set():
-                message_queue.put("Stopping posegraph creation for refined scene")
-                break
-            (matching_results[r].transformation,
-             matching_results[r].information) = \
-                register_point_cloud_pair(ply_file_names,
-                                          matching_results[r].s, matching_results[r].t,
-                                          matching_results[r].transformation, config, stop_event, message_queue)
-
-    pose_graph_new = o3d.pipelines.registration.PoseGraph()
-    odometry = np.identity(4)
-    pose_graph_new.nodes.append(
-        o3d.pipelines.registration.PoseGraphNode(odometry))
-    for r in matching_results:
-        (odometry, pose_graph_new) = update_posegraph_for_scene(
-            matching_results[r].s, matching_results[r].t,
-            matching_results[r].transformation, matching_results[r].information,
-            odometry, pose_graph_new)
+        message_queue.end(PROGRESS_REFINE)
+
+    pose_graph_new = builder.pose_graph
     message_queue.put(str(pose_graph_new))
-    o3d.io.write_pose_graph(
+    write_pose_graph(
         join(config["path_dataset"], config["template_refined_posegraph"]),
-        pose_graph_new)
+        pose_graph_new, config)
 
 
-def run(config, stop_event, message_queue):
+def run(config, stop_event, message_queue, pool=None):
     message_queue.put("refine rough registration of fragments.")
     o3d.utility.set_verbosity_level(o3d.utility.VerbosityLevel.Debug)
     ply_file_names = get_file_list(
         join(config["path_dataset"], config["folder_fragment"]), ".ply")
-    make_posegraph_for_refined_scene(ply_file_names, config, stop_event, message_queue)
+    # 成本與記憶體依最精細尺度的降採樣點雲估計
+    ply_file_names = get_level_file_names(config, len(ply_file_names), get_level_voxel_sizes(config)[-1])
+    with stage_pool(pool, config, stop_event, message_queue) as pool:
+        make_posegraph_for_refined_scene(ply_file_names, config, stop_event, message_queue, pool)
     if not stop_event.is_set():
         optimize_posegraph_for_refined_scene(config["path_dataset"], config)
-
-    path_dataset = config['path_dataset']
-    n_fragments = len(ply_file_names)
-
-    # Save to trajectory
-    poses = []
-    pose_graph_fragment = o3d.io.read_pose_graph(
-        join(path_dataset, config["template_refined_posegraph_optimized"]))
-    for fragment_id in range(len(pose_graph_fragment.nodes)):
-        pose_graph_rgbd = o3d.io.read_pose_graph(
-            join(path_dataset,
-                 config["template_fragment_posegraph_optimized"] % fragment_id))
-        for frame_id in range(len(pose_graph_rgbd.nodes)):
-            frame_id_abs = fragment_id * \
-                    config['n_frames_per_fragment'] + frame_id
-            pose = np.dot(pose_graph_fragment.nodes[fragment_id].pose,
-                          pose_graph_rgbd.nodes[frame_id].pose)
-            poses.append(pose)
-
-    traj_name = join(path_dataset, config["template_global_traj"])
-    write_poses_to_log(traj_name, poses)
+        # Save to trajectory, later stages load it in one call
+        build_global_trajectory(config['path_dataset'], config)
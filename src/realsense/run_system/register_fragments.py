@@ -7,9 +7,9 @@
 
 # examples/python/reconstruction_system/register_fragments.py
 
-import multiprocessing
 import os
 import sys
+import time
 
 import numpy as np
 import open3d as o3d
@@ -17,15 +17,20 @@ import open3d as o3d
 from open3d_example import join, get_file_list, make_clean_folder, draw_registration_result
 
 from optimize_posegraph import optimize_posegraph_for_scene
-from refine_registration import multiscale_icp
+from posegraph_store import read_node_poses, write_pose_graph
+from refine_registration import multiscale_icp, PoseGraphBuilder, predict_pair_cost, predict_pair_memory
+from worker_pool import get_shared, stage_pool
+from profiling import span
+from fragment_levels import read_fragment_pointcloud, get_level_file_names
+from pair_journal import PairJournal, input_fingerprint
 
+# 進度通道中的階段名稱
+PROGRESS_REGISTER = "Register fragments"
 
-def preprocess_point_cloud(pcd, config):
+
+def preprocess_point_cloud(pcd_down, config):
+    # 片段點雲已以 voxel_size 降採樣並估計法向量
     voxel_size = config["voxel_size"]
-    pcd_down = pcd.voxel_down_sample(voxel_size)
-    pcd_down.estimate_normals(
-        o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 2.0,
-                                             max_nn=30))
     pcd_fpfh = o3d.pipelines.registration.compute_fpfh_feature(
         pcd_down,
         o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 5.0,
@@ -54,7 +59,7 @@ def register_point_cloud_fpfh(source, target, source_fpfh, target_fpfh, config):
                     distance_threshold)
             ],
             o3d.pipelines.registration.RANSACConvergenceCriteria(
-                1000000, 0.999))
+                config["ransac_max_iteration"], config["ransac_confidence"]))
     if (result.transformation.trace() == 4.0):
         return (False, np.identity(4), np.zeros((6, 6)))
     information = o3d.pipelines.registration.get_information_matrix_from_point_clouds(
@@ -71,13 +76,10 @@ def compute_initial_registration(s, t, source_down, target_down, source_fpfh,
         return (False, np.identity(4), np.zeros((6, 6)))
 
     if t == s + 1:  # odometry case
-        message_queue.put("Using RGBD odometry")
-        pose_graph_frag = o3d.io.read_pose_graph(
+        fragment_poses = read_node_poses(
             join(path_dataset,
                  config["template_fragment_posegraph_optimized"] % s))
-        n_nodes = len(pose_graph_frag.nodes)
-        transformation_init = np.linalg.inv(pose_graph_frag.nodes[n_nodes -
-                                                                  1].pose)
+        transformation_init = np.linalg.inv(fragment_poses[-1])
         (transformation, information) = \
                 multiscale_icp(source_down, target_down,
                 [config["voxel_size"]], [50], config, transformation_init, stop_event=stop_event, message_queue=message_queue)
@@ -87,49 +89,24 @@ def compute_initial_registration(s, t, source_down, target_down, source_fpfh,
                                                   source_fpfh, target_fpfh,
                                                   config)
         if not success:
-            message_queue.put("No reasonable solution. Skip this pair")
             return (False, np.identity(4), np.zeros((6, 6)))
-    message_queue.put(str(transformation))
 
     if config["debug_mode"]:
+        message_queue.put(str(transformation))
         draw_registration_result(source_down, target_down, transformation)
     return (True, transformation, information)
 
 
-def update_posegraph_for_scene(s, t, transformation, information, odometry,
-                               pose_graph):
-    if t == s + 1:  # odometry case
-        odometry = np.dot(transformation, odometry)
-        odometry_inv = np.linalg.inv(odometry)
-        pose_graph.nodes.append(
-            o3d.pipelines.registration.PoseGraphNode(odometry_inv))
-        pose_graph.edges.append(
-            o3d.pipelines.registration.PoseGraphEdge(s,
-                                                     t,
-                                                     transformation,
-                                                     information,
-                                                     uncertain=False))
-    else:  # loop closure case
-        pose_graph.edges.append(
-            o3d.pipelines.registration.PoseGraphEdge(s,
-                                                     t,
-                                                     transformation,
-                                                     information,
-                                                     uncertain=True))
-    return (odometry, pose_graph)
-
-
 def register_point_cloud_pair(ply_file_names, s, t, config, stop_event, message_queue):
     if stop_event.is_set():
         message_queue.put(f"Stopping registration of point cloud pair {s} and {t}")
         return (False, np.identity(4), np.identity(6))
 
-    message_queue.put(f"reading {ply_file_names[s]} ...")
-    source = o3d.io.read_point_cloud(ply_file_names[s])
-    message_queue.put(f"reading {ply_file_names[t]} ...")
-    target = o3d.io.read_point_cloud(ply_file_names[t])
-    (source_down, source_fpfh) = preprocess_point_cloud(source, config)
-    (target_down, target_fpfh) = preprocess_point_cloud(target, config)
+    source = read_fragment_pointcloud(config, s, config["voxel_size"])
+    target = read_fragment_pointcloud(config, t, config["voxel_size"])
+    with span("fpfh", s=s, t=t):
+        (source_down, source_fpfh) = preprocess_point_cloud(source, config)
+        (target_down, target_fpfh) = preprocess_point_cloud(target, config)
     (success, transformation, information) = \
             compute_initial_registration(
             s, t, source_down, target_down,
@@ -142,6 +119,24 @@ def register_point_cloud_pair(ply_file_names, s, t, config, stop_event, message_
     return (True, transformation, information)
 
 
+def get_fragment_pointcloud_names(config, fragment_ids):
+    return {
+        i: join(config["path_dataset"], config["template_fragment_pointcloud"] % i)
+        for i in fragment_ids
+    }
+
+
+def register_point_cloud_pair_task(s, t):
+    config = get_shared("config")
+    message_queue = get_shared("message_queue")
+    start_time = time.time()
+    result = register_point_cloud_pair(
+        get_fragment_pointcloud_names(config, (s, t)), s, t, config,
+        get_shared("stop_event"), message_queue)
+    message_queue.update(PROGRESS_REGISTER, None, 1, time.time() - start_time)
+    return (s, t, result)
+
+
 class matching_result:
     def __init__(self, s, t):
         self.s = s
@@ -151,58 +146,70 @@ class matching_result:
         self.infomation = np.identity(6)
 
 
-def make_posegraph_for_scene(ply_file_names, config, stop_event, message_queue):
-    pose_graph = o3d.pipelines.registration.PoseGraph()
-    odometry = np.identity(4)
-    pose_graph.nodes.append(o3d.pipelines.registration.PoseGraphNode(odometry))
-
+def make_posegraph_for_scene(ply_file_names, config, stop_event, message_queue, pool):
     n_files = len(ply_file_names)
     matching_results = {}
     for s in range(n_files):
         for t in range(s + 1, n_files):
             matching_results[s * n_files + t] = matching_result(s, t)
 
-    if config["python_multi_threading"] is True:
-        os.environ['OMP_NUM_THREADS'] = '1'
-        max_workers = max(
-            1, min(multiprocessing.cpu_count() - 1, len(matching_results)))
-        mp_context = multiprocessing.get_context('spawn')
-        with mp_context.Pool(processes=max_workers) as pool:
-            args = [(ply_file_names, v.s, v.t, config, stop_event, message_queue)
-                    for k, v in matching_results.items()]
-            results = pool.starmap(register_point_cloud_pair, args)
-
-        for i, r in enumerate(matching_results):
-            matching_results[r].success = results[i][0]
-            matching_results[r].transformation = results[i][1]
-            matching_results[r].information = results[i][2]
-    else:
-        for r in matching_results:
-            if stop_event.is_set():
-                message_queue.put("Stopping posegraph creation for scene")
-                break
-            (matching_results[r].success, matching_results[r].transformation,
-             matching_results[r].information) = \
-                register_point_cloud_pair(ply_file_names,
-                                          matching_results[r].s, matching_results[r].t, config, stop_event, message_queue)
-
-    for r in matching_results:
+    message_queue.begin(PROGRESS_REGISTER, len(matching_results), "pairs")
+
+    # 每個完成的配對都寫入日誌，重新執行時只計算日誌中缺少的配對
+    journal = PairJournal(
+        join(config["path_dataset"], config["template_register_journal"]),
+        input_fingerprint(ply_file_names, config, ["voxel_size", "global_registration", "icp_method"]))
+    builder = PoseGraphBuilder()
+    for k, v in matching_results.items():
+        if (v.s, v.t) in journal:
+            (v.success, v.transformation, v.information) = journal.get(v.s, v.t)
+            if v.success:
+                builder.add(v.s, v.t, v.transformation, v.information)
+    if len(journal) > 0:
+        message_queue.put(f"Resuming scene registration :: {len(journal)} pairs from journal")
+        message_queue.update(PROGRESS_REGISTER, None, len(journal), 0.0)
+
+    # 配對結果一完成就加入姿態圖，成本高的閉環配對優先派送
+    remaining = [v for k, v in matching_results.items() if (v.s, v.t) not in journal]
+    args = [(v.s, v.t) for v in remaining]
+    costs = [predict_pair_cost(ply_file_names, v.s, v.t) *
+             (1.0 if v.t == v.s + 1 else 4.0)
+             for v in remaining]
+    # FPFH 特徵每點 33 個浮點數，記憶體比精細配準高
+    memory = [predict_pair_memory(ply_file_names, v.s, v.t, factor=12.0)
+              for v in remaining]
+    pool.plan_stage(len(args))
+    for (s, t, result) in pool.imap_unordered(register_point_cloud_pair_task, args, costs, memory):
+        r = s * n_files + t
+        (matching_results[r].success, matching_results[r].transformation,
+         matching_results[r].information) = result
+        # 停止後完成的配對可能是提前中止的結果，不寫入日誌
+        if not stop_event.is_set():
+            journal.append(s, t, *result)
         if matching_results[r].success:
-            (odometry, pose_graph) = update_posegraph_for_scene(
-                matching_results[r].s, matching_results[r].t,
-                matching_results[r].transformation,
-                matching_results[r].information, odometry, pose_graph)
-    o3d.io.write_pose_graph(
+            builder.add(s, t, matching_results[r].transformation,
+                        matching_results[r].information)
+    journal.close()
+    if stop_event.is_set():
+        message_queue.put("Stopping posegraph creation for scene")
+    else:
+        message_queue.end(PROGRESS_REGISTER)
+
+    pose_graph = builder.pose_graph
+    write_pose_graph(
         join(config["path_dataset"], config["template_global_posegraph"]),
-        pose_graph)
+        pose_graph, config)
 
 
-def run(config, stop_event, message_queue):
+def run(config, stop_event, message_queue, pool=None):
     message_queue.put("register fragments.")
     o3d.utility.set_verbosity_level(o3d.utility.VerbosityLevel.Debug)
     ply_file_names = get_file_list(
         join(config["path_dataset"], config["folder_fragment"]), ".ply")
     make_clean_folder(join(config["path_dataset"], config["folder_scene"]))
-    make_posegraph_for_scene(ply_file_names, config, stop_event, message_queue)
+    # 成本與記憶體依實際讀取的降採樣點雲估計
+    ply_file_names = get_level_file_names(config, len(ply_file_names), config["voxel_size"])
+    with stage_pool(pool, config, stop_event, message_queue) as pool:
+        make_posegraph_for_scene(ply_file_names, config, stop_event, message_queue, pool)
     if not stop_event.is_set():
         optimize_posegraph_for_scene(config["path_dataset"], config)
@@ -6,14 +6,22 @@ import sys
 import threading
 import multiprocessing
 import traceback
+import inspect
+import queue
+import contextlib
 
 # 將當前文件的目錄添加到 sys.path
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from os.path import isfile
 import open3d as o3d
-from open3d_example import check_folder_structure
+from open3d_example import check_folder_structure, make_clean_folder
 from initialize_config import initialize_config, dataset_loader
+from worker_pool import create_pool, make_shared_state, get_memory_budget, GB
+from frame_prepass import dedup_static_frames, read_frame_lists
+from cost_model import STAGES, apply_time_budget, record_run
+from progress import ProgressChannel, ProgressAggregator
+import profiling
 
 class Args_run_system:
     def __init__(self, config=None, make=False, register=False, refine=False, integrate=False, slac=False, slac_integrate=False, debug_mode=False):
@@ -52,50 +60,79 @@ class ReconstructionSystem:
         self.callback = callback
         self.config = None
         self.times = [0, 0, 0, 0, 0, 0]
+        self.completed = set()
+        self.predicted_times = None
+        self.frame_counts = None
         self.thread = None
-        self.manager = multiprocessing.Manager()
-        self.stop_event = self.manager.Event()  # 使用 multiprocessing.Manager 提供的 Event
-        self.message_queue = self.manager.Queue()
+        self.pool = None
+        # 停止事件與進度通道在建立工作行程時傳入，不再經由 Manager 行程轉送
+        mp_context = multiprocessing.get_context('spawn')
+        self.stop_event = mp_context.Event()
+        self.message_queue = ProgressChannel(mp_context.Queue())
+        self.progress = ProgressAggregator()
+        self.progress_interval = 1.0
         self.monitor_event = threading.Event()
         self.monitor_thread = threading.Thread(target=self.monitor_messages)
         self.monitor_thread.start()
 
     def monitor_messages(self):
         """
-        監控訊息佇列，並將其發送到模型。
+        監控進度通道，文字訊息直接發送到模型，進度事件則彙總後以固定頻率發送。
         """
+        last_report = time.time()
         while not self.monitor_event.is_set():
             try:
-                message = self.message_queue.get(timeout=1)
-                if message:
-                    self.send_to_model("terminal_print", {"owner": "run_system", "message": message})
-                    print(f"multiprocess : {message}")
-            except:
-                continue
-        
+                self.handle_event(self.message_queue.queue.get(timeout=0.2))
+            except queue.Empty:
+                pass
+            if time.time() - last_report >= self.progress_interval:
+                self.report_progress()
+                last_report = time.time()
+
         # 在 monitor_event 被設置後，確保佇列中的所有訊息都被處理完畢
-        while not self.message_queue.empty():
+        while True:
             try:
-                message = self.message_queue.get_nowait()
-                if message:
-                    self.send_to_model("terminal_print", {"owner": "run_system", "message": message})
-                    print(f"multiprocess : {message}")
-            except:
+                self.handle_event(self.message_queue.queue.get_nowait())
+            except queue.Empty:
                 break
+        self.report_progress()
+
+    def handle_event(self, event):
+        """
+        處理進度通道的單一事件。
+
+        參數:
+        event (tuple): 進度通道送出的事件。
+        """
+        message = self.progress.handle(event)
+        if message:
+            self.send_to_model("terminal_print", {"owner": "run_system", "message": message})
+            print(f"multiprocess : {message}")
+
+    def report_progress(self):
+        """
+        發送有更新的階段進度。
+        """
+        for stage_progress in self.progress.pop_changed():
+            message = stage_progress.summary()
+            self.send_to_model("terminal_progress", {"owner": "run_system", "key": stage_progress.stage, "message": message})
+            print(f"progress : {message}")
 
     def load_config(self, message_queue=None):
         """
         加載配置文件。
 
         參數:
-        message_queue (multiprocessing.Queue, optional): 訊息佇列。預設為 None。
+        message_queue (ProgressChannel, optional): 進度通道。預設為 None。
         """
         try:
             if self.args.config is not None:
                 with open(self.args.config, encoding='utf-8') as json_file:
                     self.config = json.load(json_file)
                     initialize_config(self.config, message_queue)
-                    check_folder_structure(self.config['path_dataset'])
+                    # 直接讀取 bag 時沒有 color/depth 資料夾
+                    if not self.config["path_bag"]:
+                        check_folder_structure(self.config['path_dataset'])
 
             assert self.config is not None
             self.config['debug_mode'] = self.args.debug_mode
@@ -117,23 +154,39 @@ class ReconstructionSystem:
             for key, val in self.config.items():
                 self.message_queue.put(f"{key:40} : {val}")
 
+            self.start_profiling()
+            if self.args.make:
+                self.dedup_frames()
+            self.apply_time_budget()
+            self.start_pool()
+
             if self.args.make:
                 self.execute_step("make_fragments", "run", 0, self.stop_event, self.message_queue)
-            if self.args.register:
-                self.execute_step("register_fragments", "run", 1, self.stop_event, self.message_queue)
-            if self.args.refine:
-                self.execute_step("refine_registration", "run", 2, self.stop_event, self.message_queue)
-            if self.args.integrate:
-                self.execute_step("integrate_scene", "run", 3, self.stop_event, self.message_queue)
+                self.report_dedup_savings()
+            if self.config["incremental_base"]:
+                # 加入既有場景時，新場次的配準、最佳化與整合在同一個步驟完成
+                if self.args.register or self.args.refine or self.args.integrate:
+                    self.execute_step("incremental", "run", 1, self.stop_event, self.message_queue)
+            else:
+                if self.args.register:
+                    self.execute_step("register_fragments", "run", 1, self.stop_event, self.message_queue)
+                if self.args.refine:
+                    self.execute_step("refine_registration", "run", 2, self.stop_event, self.message_queue)
+                if self.args.integrate:
+                    self.execute_step("integrate_scene", "run", 3, self.stop_event, self.message_queue)
             if self.args.slac:
                 self.execute_step("slac", "run", 4, self.stop_event, self.message_queue)
             if self.args.slac_integrate:
                 self.execute_step("slac_integrate", "run", 5, self.stop_event, self.message_queue)
 
+            self.close_pool()
+            self.finish_profiling()
+
             while not self.message_queue.empty():
                 time.sleep(0.5)
 
             self.print_elapsed_time()
+            self.record_stage_times()
             if not self.stop_event.is_set():
                 self.message_queue.put("Reconstruction System finished")
             else:
@@ -143,6 +196,110 @@ class ReconstructionSystem:
             tb = traceback.format_exc()
             print(f"Error during execution: {e}\n{tb}")
             self.send_to_model("show_error", {"title": "Error during execution", "message": str(e)})
+            self.close_pool()
+            self.finish_profiling()
+
+    def start_profiling(self):
+        """
+        啟用分析模式時清空分析結果資料夾，並開始記錄主行程的區段事件。
+        工作行程在初始化時依配置各自開始記錄。
+        """
+        if self.config.get("profiling"):
+            make_clean_folder(profiling.get_trace_dir(self.config))
+            profiling.configure(self.config)
+
+    def finish_profiling(self):
+        """
+        合併主行程與工作行程的區段事件為一個 Chrome trace-event JSON。
+        """
+        if not profiling.enabled():
+            return
+        profiling.flush()
+        trace_dir = profiling.get_trace_dir(self.config)
+        trace_name = os.path.join(trace_dir, "trace.json")
+        n_events = profiling.merge_trace(trace_dir, trace_name, os.getpid())
+        profiling.disable()
+        self.message_queue.put(f"Profiling :: {n_events} trace events written to {trace_name}")
+
+    def dedup_frames(self):
+        """
+        建立行程池之前移除相機靜止時的重複幀，工作行程的共享狀態因此使用縮減後的幀列表。
+        """
+        self.frame_counts = dedup_static_frames(self.config, self.message_queue)
+
+    def report_dedup_savings(self):
+        """
+        以 make_fragments 每幀的平均耗時估計移除重複幀所節省的時間。
+        """
+        if self.frame_counts is None or self.stop_event.is_set():
+            return
+        n_files, n_kept = self.frame_counts
+        if n_kept < n_files:
+            saved = self.times[0] / max(n_kept, 1) * (n_files - n_kept)
+            self.message_queue.put(
+                f"Static frame dedup :: {n_files - n_kept} frames removed, "
+                f"about {datetime.timedelta(seconds=int(saved))} saved in make_fragments")
+
+    def selected_stages(self):
+        """
+        回傳這次執行的階段模組名稱。
+        """
+        flags = [self.args.make, self.args.register, self.args.refine,
+                 self.args.integrate, self.args.slac, self.args.slac_integrate]
+        return [stage for stage, flag in zip(STAGES, flags) if flag]
+
+    def apply_time_budget(self):
+        """
+        設定時間預算時，在建立行程池之前依校準的成本模型選擇參數並回報各階段的預測時間。
+        """
+        if self.config["time_budget_s"] <= 0 or self.config["streaming"]:
+            return
+        n_frames = len(read_frame_lists(self.config)[0])
+        if n_frames > 0:
+            self.predicted_times = apply_time_budget(
+                self.config, self.selected_stages(), n_frames, self.message_queue)
+
+    def record_stage_times(self):
+        """
+        將完整執行的階段實際時間與預測時間記錄到本機的成本紀錄，供之後的執行校準。
+        """
+        try:
+            if self.config["streaming"] or self.config["incremental_base"]:
+                # 串流模式的時間包含等待錄製，加入場次的步驟與完整流程的階段不同，都不代表階段成本
+                return
+            stage_times = {STAGES[i]: self.times[i] for i in sorted(self.completed)}
+            n_frames = len(read_frame_lists(self.config)[0])
+            if stage_times and n_frames > 0:
+                record_run(self.config, stage_times, n_frames, self.predicted_times)
+            if self.predicted_times:
+                for stage, seconds in stage_times.items():
+                    if stage in self.predicted_times:
+                        self.message_queue.put(
+                            f"Time budget :: {stage:20} predicted {self.predicted_times[stage]:.0f} s, "
+                            f"actual {seconds:.0f} s")
+        except Exception as e:
+            print(f"Error recording stage times: {e}")
+
+    def start_pool(self):
+        """
+        建立整個重建流程共用的常駐行程池，工作行程只預載模組與接收共享狀態一次。
+        """
+        shared = make_shared_state(self.config, self.stop_event, self.message_queue)
+        self.pool = create_pool(self.config, shared)
+        self.message_queue.put(
+            f"Worker pool started with {self.pool.processes} processes in {self.pool.startup_time:.2f} s "
+            f"(memory budget {get_memory_budget(self.config) / GB:.2f} GB)")
+
+    def close_pool(self):
+        """
+        關閉常駐行程池。
+        """
+        if self.pool is not None:
+            if self.stop_event.is_set():
+                self.pool.terminate()
+            else:
+                self.pool.close()
+            self.pool = None
 
     def execute_step(self, module_name, function_name, index, stop_event=None, message_queue=None):
         """
@@ -153,21 +310,40 @@ class ReconstructionSystem:
         function_name (str): 函數名稱。
         index (int): 步驟索引。
         stop_event (multiprocessing.Event, optional): 停止事件。預設為 None。
-        message_queue (multiprocessing.Queue, optional): 訊息佇列。預設為 None。
+        message_queue (ProgressChannel, optional): 進度通道。預設為 None。
         """
         try:
             if self.stop_event.is_set():
                 return
             start_time = time.time()
             module = __import__(module_name)
-            if stop_event:
-                if message_queue:
-                    getattr(module, function_name)(self.config, stop_event, message_queue)
-                else:
-                    getattr(module, function_name)(self.config, stop_event)
+            function = getattr(module, function_name)
+            # 支援行程池的階段使用重建系統持有的常駐行程池
+            kwargs = {}
+            if self.pool is not None and "pool" in inspect.signature(function).parameters:
+                kwargs["pool"] = self.pool
+                stats = self.pool.begin_stage(module_name)
             else:
-                getattr(module, function_name)(self.config)
+                stats = None
+            # 分析模式下以 cProfile 與 tracemalloc 記錄主行程中的階段
+            profiler = None
+            if profiling.enabled():
+                profiler = profiling.StageProfiler(module_name, profiling.get_trace_dir(self.config))
+            with profiler if profiler is not None else contextlib.nullcontext():
+                if stop_event:
+                    if message_queue:
+                        function(self.config, stop_event, message_queue, **kwargs)
+                    else:
+                        function(self.config, stop_event, **kwargs)
+                else:
+                    function(self.config, **kwargs)
             self.times[index] = time.time() - start_time
+            if not self.stop_event.is_set():
+                self.completed.add(index)
+            if stats is not None:
+                self.message_queue.put(f"Worker pool :: {stats.summary()}")
+            if profiler is not None:
+                self.message_queue.put(f"Profiling :: {profiler.summary()}")
         except Exception as e:
             tb = traceback.format_exc()
             print(f"Error in execute_step {module_name}: {e}")
@@ -243,7 +419,7 @@ class ReconstructionSystem:
         """
         if self.callback is not None:
             try:
-                if mode == "show_error" or mode == "terminal_print":
+                if mode in ["show_error", "terminal_print", "terminal_progress"]:
                     self.callback(mode, data)
             except Exception as e:
                 print(f"Error sending to model: {e}")
@@ -11,7 +11,9 @@ import numpy as np
 import open3d as o3d
 import os, sys
 
-from open3d_example import join, get_file_list, write_poses_to_log
+from open3d_example import join, get_file_list
+from posegraph_store import read_pose_graph, write_pose_graph, read_node_poses
+from fragment_levels import get_level_file_names
 
 
 def run(config, stop_event, message_queue):
@@ -27,8 +29,10 @@ def run(config, stop_event, message_queue):
         raise RuntimeError(
             "No fragment found in {}, please make sure the reconstruction_system has finished running on the dataset."
             .format(join(config["path_dataset"], config["folder_fragment"])))
+    # SLAC 以 voxel_size 降採樣片段，直接讀取該解析度的點雲
+    ply_file_names = get_level_file_names(config, len(ply_file_names), config["voxel_size"])
 
-    pose_graph_fragment = o3d.io.read_pose_graph(
+    pose_graph_fragment = read_pose_graph(
         join(path_dataset, config["template_refined_posegraph_optimized"]))
 
     # SLAC optimizer parameters.
@@ -85,22 +89,21 @@ def run(config, stop_event, message_queue):
         return
 
     # Write updated pose graph.
-    o3d.io.write_pose_graph(
+    write_pose_graph(
         join(slac_params.get_subfolder_name(),
-             config["template_optimized_posegraph_slac"]), pose_graph_updated)
+             config["template_optimized_posegraph_slac"]), pose_graph_updated, config)
 
     # Write trajectory for slac-integrate stage.
-    fragment_folder = join(path_dataset, config["folder_fragment"])
     params = []
     for i in range(len(pose_graph_updated.nodes)):
         if stop_event.is_set():
             message_queue.put("Stopping SLAC optimization")
             return
 
-        fragment_pose_graph = o3d.io.read_pose_graph(
-            join(fragment_folder, "fragment_optimized_%03d.json" % i))
-        for node in fragment_pose_graph.nodes:
-            pose = np.dot(pose_graph_updated.nodes[i].pose, node.pose)
+        fragment_poses = read_node_poses(
+            join(path_dataset, config["template_fragment_posegraph_optimized"] % i))
+        for local_pose in fragment_poses:
+            pose = np.dot(pose_graph_updated.nodes[i].pose, local_pose)
             param = o3d.camera.PinholeCameraParameters()
             param.extrinsic = np.linalg.inv(pose)
             params.append(param)
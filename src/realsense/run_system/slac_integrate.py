@@ -11,8 +11,15 @@ import numpy as np
 import open3d as o3d
 import open3d.core as o3c
 import os, sys
+import time
 
-from open3d_example import join, get_rgbd_file_lists
+from open3d_example import join
+from frame_prepass import read_frame_lists
+from bag_frames import read_tensor_image
+from posegraph_store import read_pose_graph, read_node_poses
+
+# 進度通道中的階段名稱
+PROGRESS_SLAC_INTEGRATE = "SLAC integrate"
 
 def run(config, stop_event, message_queue):
     message_queue.put("slac non-rigid optimization.")
@@ -21,13 +28,13 @@ def run(config, stop_event, message_queue):
     path_dataset = config["path_dataset"]
     slac_folder = join(path_dataset, config["subfolder_slac"])
 
-    [color_files, depth_files] = get_rgbd_file_lists(config["path_dataset"])
+    [color_files, depth_files] = read_frame_lists(config)
     if len(color_files) != len(depth_files):
         raise ValueError(
             "The number of color images {} must equal to the number of depth images {}."
             .format(len(color_files), len(depth_files)))
 
-    posegraph = o3d.io.read_pose_graph(
+    posegraph = read_pose_graph(
         join(slac_folder, config["template_optimized_posegraph_slac"]))
 
     if config["path_intrinsic"]:
@@ -63,8 +70,7 @@ def run(config, stop_event, message_queue):
                                                  ctr_grid_values.to(device),
                                                  device)
 
-    fragment_folder = join(path_dataset, config["folder_fragment"])
-
+    message_queue.begin(PROGRESS_SLAC_INTEGRATE, len(depth_files), "frames")
     k = 0
     depth_scale = float(config['depth_scale'])
     depth_max = float(config['depth_max'])
@@ -72,23 +78,22 @@ def run(config, stop_event, message_queue):
         if stop_event.is_set():
             message_queue.put("Stopping SLAC integration")
             return
-        fragment_pose_graph = o3d.io.read_pose_graph(
-            join(fragment_folder, "fragment_optimized_%03d.json" % i))
-        for node in fragment_pose_graph.nodes:
+        fragment_poses = read_node_poses(
+            join(path_dataset, config["template_fragment_posegraph_optimized"] % i))
+        for pose_local in fragment_poses:
             if stop_event.is_set():
                 message_queue.put("Stopping SLAC integration")
                 return
-            pose_local = node.pose
             extrinsic_local_t = o3d.core.Tensor(np.linalg.inv(pose_local))
 
-            pose = np.dot(posegraph.nodes[i].pose, node.pose)
+            pose = np.dot(posegraph.nodes[i].pose, pose_local)
             extrinsic_t = o3d.core.Tensor(np.linalg.inv(pose))
 
-            depth = o3d.t.io.read_image(depth_files[k]).to(device)
-            color = o3d.t.io.read_image(color_files[k]).to(device)
+            depth = read_tensor_image(depth_files[k]).to(device)
+            color = read_tensor_image(color_files[k]).to(device)
             rgbd = o3d.t.geometry.RGBDImage(color, depth)
 
-            message_queue.put('Deforming and integrating Frame {:3d}'.format(k))
+            start_time = time.time()
             rgbd_projected = ctr_grid.deform(rgbd, intrinsic_t,
                                              extrinsic_local_t, depth_scale,
                                              depth_max)
@@ -100,7 +105,9 @@ def run(config, stop_event, message_queue):
             voxel_grid.integrate(frustum_block_coords, rgbd_projected.depth,
                                  rgbd_projected.color, intrinsic_t, extrinsic_t,
                                  depth_scale, depth_max)
+            message_queue.update(PROGRESS_SLAC_INTEGRATE, i, 1, time.time() - start_time)
             k = k + 1
+    message_queue.end(PROGRESS_SLAC_INTEGRATE)
 
     if (config["save_output_as"] == "pointcloud"):
         pcd = voxel_grid.extract_point_cloud().to(o3d.core.Device("CPU:0"))
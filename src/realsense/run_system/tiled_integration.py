@@ -0,0 +1,298 @@
+import os
+import json
+import time
+import itertools
+
+import numpy as np
+import open3d as o3d
+import open3d.core as o3c
+
+from open3d_example import join, make_clean_folder
+from worker_pool import get_shared, get_frame_files
+from bag_frames import read_tensor_image
+
+# 進度通道中的階段名稱
+PROGRESS_TILES = "Integrate tiles"
+
+# VoxelBlockGrid 每個體素的位元組數（tsdf、weight 各 4 bytes，color 12 bytes），
+# 另加上雜湊表的額外開銷
+BYTES_PER_VOXEL = 20
+HASHMAP_OVERHEAD = 1.25
+BLOCK_RESOLUTION = 16
+
+
+def get_tile_geometry(config):
+    """
+    計算圖塊的幾何參數，圖塊邊長會對齊到體素區塊的整數倍。
+
+    參數:
+    config (dict): 重建配置。
+    """
+    voxel_size = config["tsdf_cubic_size"] / 512.0
+    block_size = voxel_size * BLOCK_RESOLUTION
+    tile_blocks = max(1, int(round(config["tile_size"] / block_size)))
+    return voxel_size, block_size, tile_blocks
+
+
+def get_frustum_corners(intrinsic, depth_min, depth_max):
+    """
+    回傳相機座標系中截頭視錐的 8 個角點。
+
+    參數:
+    intrinsic (o3d.camera.PinholeCameraIntrinsic): 相機內參。
+    depth_min (float): 最小深度。
+    depth_max (float): 最大深度。
+    """
+    fx, fy = intrinsic.get_focal_length()
+    cx, cy = intrinsic.get_principal_point()
+    u = np.array([0, intrinsic.width, 0, intrinsic.width], dtype=np.float64)
+    v = np.array([0, 0, intrinsic.height, intrinsic.height], dtype=np.float64)
+    corners = []
+    for d in (depth_min, depth_max):
+        corners.append(np.stack([(u - cx) / fx * d, (v - cy) / fy * d, np.full(4, d)], axis=1))
+    return np.concatenate(corners)
+
+
+def route_frames_to_tiles(poses, intrinsic, config):
+    """
+    依每一幀視錐的世界座標包圍盒，將幀分配到其涵蓋的圖塊。
+
+    參數:
+    poses (numpy.ndarray): 每一幀的相機姿態，形狀為 (N, 4, 4)。
+    intrinsic (o3d.camera.PinholeCameraIntrinsic): 相機內參。
+    config (dict): 重建配置。
+    """
+    voxel_size, block_size, tile_blocks = get_tile_geometry(config)
+    tile_length = tile_blocks * block_size
+    corners = get_frustum_corners(intrinsic, config["depth_min"], config["depth_max"])
+    # (N, 8, 3) 世界座標角點，一次以批次矩陣乘法計算
+    world = np.matmul(poses[:, :3, :3], corners.T).transpose(0, 2, 1) + poses[:, None, :3, 3]
+    # 以截斷距離加一個區塊作為邊界，讓相鄰圖塊重疊區域的 TSDF 完全一致
+    margin = config["sdf_trunc"] + block_size
+    lo = np.floor((world.min(axis=1) - margin) / tile_length).astype(np.int64)
+    hi = np.floor((world.max(axis=1) + margin) / tile_length).astype(np.int64)
+
+    tiles = {}
+    for i in range(len(poses)):
+        ranges = [range(lo[i, k], hi[i, k] + 1) for k in range(3)]
+        for key in itertools.product(*ranges):
+            tiles.setdefault(key, []).append(i)
+    return tiles
+
+
+def estimate_tile_blocks(n_frames, intrinsic, config):
+    """
+    估計圖塊整合時需要配置的體素區塊數量。
+
+    參數:
+    n_frames (int): 分配到圖塊的幀數。
+    intrinsic (o3d.camera.PinholeCameraIntrinsic): 相機內參。
+    config (dict): 重建配置。
+    """
+    voxel_size, block_size, tile_blocks = get_tile_geometry(config)
+    # 圖塊本身加上兩側各一個區塊的重疊區域
+    dense_blocks = (tile_blocks + 2) ** 3
+    # 以中間深度估計單一幀在表面上覆蓋的區塊數，截斷距離內會有數層區塊
+    fx, fy = intrinsic.get_focal_length()
+    depth = 0.5 * (config["depth_min"] + config["depth_max"])
+    area = (intrinsic.width * depth / fx) * (intrinsic.height * depth / fy)
+    layers = 1.0 + 2.0 * config["sdf_trunc"] / block_size
+    frame_blocks = area / (block_size * block_size) * layers
+    # 連續幀大多重疊，新增區塊以幀數的平方根成長
+    surface_blocks = frame_blocks * max(1.0, np.sqrt(n_frames))
+    return int(min(dense_blocks, surface_blocks)) + 1
+
+
+def estimate_tile_memory(n_blocks):
+    """
+    估計圖塊整合的峰值記憶體（位元組）。
+
+    參數:
+    n_blocks (int): 體素區塊數量。
+    """
+    return int(n_blocks * BLOCK_RESOLUTION ** 3 * BYTES_PER_VOXEL * HASHMAP_OVERHEAD)
+
+
+def integrate_tile_task(key, frame_ids, extrinsics, n_blocks, path_store=None):
+    """
+    整合並網格化單一圖塊，只配置落在圖塊（含重疊區域）內的體素區塊。
+    圖塊已有保存的 TSDF 時讀入後繼續整合，只需整合新的幀。
+
+    參數:
+    key (tuple): 圖塊索引 (ix, iy, iz)。
+    frame_ids (list): 分配到圖塊的幀索引。
+    extrinsics (numpy.ndarray): 對應幀的外參矩陣。
+    n_blocks (int): 預估的體素區塊數量。
+    path_store (str, optional): 圖塊網格與 TSDF 的資料集路徑。預設為 None，即 path_dataset。
+    """
+    config = get_shared("config")
+    stop_event = get_shared("stop_event")
+    message_queue = get_shared("message_queue")
+    color_files, depth_files = get_frame_files(max(frame_ids))
+    if stop_event.is_set():
+        return None
+
+    start_time = time.time()
+    voxel_size, block_size, tile_blocks = get_tile_geometry(config)
+    block_lo = np.array(key, dtype=np.int64) * tile_blocks - 1
+    block_hi = block_lo + tile_blocks + 2
+
+    if config["path_intrinsic"]:
+        intrinsic = o3d.io.read_pinhole_camera_intrinsic(config["path_intrinsic"])
+    else:
+        intrinsic = o3d.camera.PinholeCameraIntrinsic(
+            o3d.camera.PinholeCameraIntrinsicParameters.PrimeSenseDefault)
+    intrinsic_t = o3c.Tensor(intrinsic.intrinsic_matrix, o3c.float64)
+    depth_scale = float(config["depth_scale"])
+    depth_max = float(config["depth_max"])
+    trunc_voxel_multiplier = config["sdf_trunc"] / voxel_size
+
+    if path_store is None:
+        path_store = config["path_dataset"]
+    tsdf_name = join(path_store, config["template_tile_tsdf"] % key)
+    if os.path.isfile(tsdf_name):
+        voxel_grid = o3d.t.geometry.VoxelBlockGrid.load(tsdf_name)
+    else:
+        voxel_grid = o3d.t.geometry.VoxelBlockGrid(
+            attr_names=('tsdf', 'weight', 'color'),
+            attr_dtypes=(o3c.float32, o3c.float32, o3c.float32),
+            attr_channels=((1), (1), (3)),
+            voxel_size=voxel_size,
+            block_resolution=BLOCK_RESOLUTION,
+            block_count=n_blocks,
+            device=o3d.core.Device("CPU:0"))
+
+    n_integrated = 0
+    for frame_id, extrinsic in zip(frame_ids, extrinsics):
+        if stop_event.is_set():
+            return None
+        depth = read_tensor_image(depth_files[frame_id])
+        color = read_tensor_image(color_files[frame_id])
+        extrinsic_t = o3c.Tensor(extrinsic, o3c.float64)
+        block_coords = voxel_grid.compute_unique_block_coordinates(
+            depth, intrinsic_t, extrinsic_t, depth_scale, depth_max,
+            trunc_voxel_multiplier).numpy()
+        inside = np.all((block_coords >= block_lo) & (block_coords < block_hi), axis=1)
+        if np.any(inside):
+            voxel_grid.integrate(o3c.Tensor(block_coords[inside]), depth, color,
+                                 intrinsic_t, extrinsic_t, depth_scale,
+                                 depth_max, trunc_voxel_multiplier)
+            n_integrated += 1
+
+    if config["save_tsdf"]:
+        voxel_grid.save(tsdf_name)
+
+    tile_length = tile_blocks * block_size
+    bounds_lo = np.array(key, dtype=np.float64) * tile_length
+    bounds_hi = bounds_lo + tile_length
+    mesh = voxel_grid.extract_triangle_mesh().to_legacy()
+    # 以三角形重心裁切到圖塊本身的範圍，重疊區域的三角形只保留在其中一個圖塊
+    if len(mesh.triangles) > 0:
+        vertices = np.asarray(mesh.vertices)
+        centroids = vertices[np.asarray(mesh.triangles)].mean(axis=1)
+        inside = np.all((centroids >= bounds_lo) & (centroids < bounds_hi), axis=1)
+        mesh.remove_triangles_by_mask(~inside)
+        mesh.remove_unreferenced_vertices()
+
+    tile_name = join(path_store, config["template_tile_mesh"] % key)
+    n_triangles = len(mesh.triangles)
+    if n_triangles > 0:
+        mesh.compute_vertex_normals()
+        o3d.io.write_triangle_mesh(tile_name, mesh, False, True)
+    message_queue.update(PROGRESS_TILES, None, 1, time.time() - start_time)
+    return {
+        "key": list(key),
+        "bounds": [bounds_lo.tolist(), bounds_hi.tolist()],
+        "file": tile_name if n_triangles > 0 else None,
+        "n_frames": len(frame_ids),
+        "n_frames_integrated": n_integrated,
+        "n_triangles": n_triangles,
+        "n_blocks": int(voxel_grid.hashmap().size()),
+        "seconds": time.time() - start_time,
+    }
+
+
+def stitch_tiles(tiles, config):
+    """
+    依序讀入各圖塊的網格並合併成單一場景網格。合併後的網格包含整個場景，
+    記憶體用量不再受圖塊大小限制，因此只在啟用 stitch_tiles 時執行。
+
+    參數:
+    tiles (list): 圖塊索引資料。
+    config (dict): 重建配置。
+    """
+    voxel_size, block_size, tile_blocks = get_tile_geometry(config)
+    mesh = o3d.geometry.TriangleMesh()
+    for tile in tiles:
+        if tile["file"] is not None:
+            mesh += o3d.io.read_triangle_mesh(tile["file"])
+    # 相鄰圖塊在邊界上產生的頂點位置相同，合併後即可縫合
+    mesh.merge_close_vertices(voxel_size * 0.01)
+    mesh.remove_unreferenced_vertices()
+    mesh.compute_vertex_normals()
+    return mesh
+
+
+def tiled_integrate_rgb_frames(path_dataset, intrinsic, frame_ids, poses, config, stop_event, message_queue, pool,
+                               incremental=False):
+    """
+    以空間圖塊分區整合場景，各圖塊在記憶體預算內平行整合並各自寫入磁碟。
+    回傳縫合後的場景網格；未啟用縫合或中途停止時回傳 None。
+    incremental 為 True 時 path_dataset 是既有的圖塊庫：只重新整合新幀涵蓋的圖塊，
+    其餘圖塊保留原本的網格。
+
+    參數:
+    path_dataset (str): 數據集路徑。
+    intrinsic (o3d.camera.PinholeCameraIntrinsic): 相機內參。
+    frame_ids (numpy.ndarray): 要整合的幀索引。
+    poses (numpy.ndarray): 對應幀在場景中的姿態，形狀為 (N, 4, 4)。
+    config (dict): 重建配置。
+    stop_event (multiprocessing.Event): 停止事件。
+    message_queue (ProgressChannel): 進度通道。
+    pool (WorkerPool or SerialPool): 行程池。
+    incremental (bool, optional): 是否整合到既有的圖塊庫。預設為 False。
+    """
+    if not incremental:
+        make_clean_folder(join(path_dataset, config["folder_tiles"]))
+    extrinsics = np.linalg.inv(poses)
+    tiles = route_frames_to_tiles(poses, intrinsic, config)
+
+    args = []
+    memory = []
+    for key, indices in tiles.items():
+        n_blocks = estimate_tile_blocks(len(indices), intrinsic, config)
+        args.append((key, [int(frame_ids[i]) for i in indices], extrinsics[indices], n_blocks, path_dataset))
+        memory.append(estimate_tile_memory(n_blocks))
+
+    # 同時整合的圖塊數量由行程池依記憶體預算控制
+    message_queue.put(
+        f"Integrating {len(tiles)} tiles of {config['tile_size']} m "
+        f"(largest tile estimate {max(memory, default=0) / 1024 ** 3:.2f} GB)")
+    pool.plan_stage(len(args))
+    message_queue.begin(PROGRESS_TILES, len(args), "tiles")
+
+    index = []
+    for result in pool.imap_unordered(integrate_tile_task, args, memory, memory):
+        if result is not None:
+            index.append(result)
+    if stop_event.is_set():
+        message_queue.put("Stopping tiled integration")
+        return None
+    message_queue.end(PROGRESS_TILES)
+
+    index_name = join(path_dataset, config["template_tile_index"])
+    if incremental and os.path.isfile(index_name):
+        # 沒有新幀的圖塊沿用原本的索引資料
+        updated = {tuple(tile["key"]) for tile in index}
+        with open(index_name) as f:
+            index += [tile for tile in json.load(f)["tiles"] if tuple(tile["key"]) not in updated]
+    index.sort(key=lambda tile: tile["key"])
+    with open(index_name, 'w') as f:
+        json.dump({"tile_size": config["tile_size"], "tiles": index}, f, indent=4)
+
+    message_queue.put(
+        f"Wrote {sum(tile['file'] is not None for tile in index)} tile meshes, "
+        f"{sum(tile['n_triangles'] for tile in index)} triangles")
+    if not config["stitch_tiles"]:
+        return None
+    return stitch_tiles(index, config)
@@ -0,0 +1,600 @@
+import os
+import sys
+import time
+import queue
+import pickle
+import threading
+import multiprocessing
+from contextlib import contextmanager
+
+import psutil
+
+import profiling
+
+# 將當前文件的目錄添加到 sys.path，子行程才能以模組名稱載入各階段
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+# 每個行程共享的狀態（配置、檔案列表、停止事件、訊息佇列），
+# 工作行程在初始化時只接收一次，主行程在序列模式下也使用同一份
+_shared = {}
+
+# 工作行程以背景執行緒取樣的 RSS 峰值，用於量測每個工作實際使用的記憶體
+_peak_rss = 0
+_process = None
+
+GB = 1024 ** 3
+
+
+def set_shared(shared):
+    """
+    設置目前行程的共享狀態。
+
+    參數:
+    shared (dict): 共享狀態。
+    """
+    _shared.clear()
+    _shared.update(shared)
+
+
+def get_shared(key):
+    """
+    取得目前行程的共享狀態。
+
+    參數:
+    key (str): 共享狀態的鍵。
+    """
+    return _shared[key]
+
+
+def get_frame_files(index):
+    """
+    回傳共享的彩色與深度影像列表。串流模式下資料夾中的幀持續增加，
+    要求的幀尚未列出時重新列出並更新目前行程的共享狀態。
+
+    參數:
+    index (int): 需要的最大幀索引。
+    """
+    if index >= len(_shared["color_files"]):
+        from frame_prepass import read_frame_lists
+        [_shared["color_files"], _shared["depth_files"]] = read_frame_lists(_shared["config"])
+    return _shared["color_files"], _shared["depth_files"]
+
+
+def stop_requested():
+    """
+    回傳共享的停止事件是否已設置。
+    """
+    stop_event = _shared.get("stop_event")
+    return stop_event is not None and stop_event.is_set()
+
+
+def make_shared_state(config, stop_event, message_queue):
+    """
+    建立整個重建流程共用的狀態。
+
+    參數:
+    config (dict): 重建配置。
+    stop_event (multiprocessing.Event): 停止事件。
+    message_queue (ProgressChannel): 進度通道。
+    """
+    from frame_prepass import read_frame_lists
+    import bag_frames
+    bag_frames.configure(config)
+    [color_files, depth_files] = read_frame_lists(config)
+    return {
+        "config": config,
+        "color_files": color_files,
+        "depth_files": depth_files,
+        "stop_event": stop_event,
+        "message_queue": message_queue,
+    }
+
+
+def get_memory_budget(config):
+    """
+    回傳工作可使用的記憶體預算（位元組）。未指定固定預算時，
+    以目前可用記憶體乘上配置的比例計算。
+
+    參數:
+    config (dict): 重建配置。
+    """
+    if config["memory_budget_gb"] > 0:
+        return int(config["memory_budget_gb"] * GB)
+    return int(psutil.virtual_memory().available * config["memory_budget_fraction"])
+
+
+def get_core_count(config):
+    """
+    回傳重建可使用的核心數；多個工作同時執行時由工作服務分配。
+
+    參數:
+    config (dict): 重建配置。
+    """
+    if config["worker_cores"] > 0:
+        return config["worker_cores"]
+    return multiprocessing.cpu_count()
+
+
+def plan_pool_size(config):
+    """
+    依核心數與可用記憶體決定工作行程數量。
+
+    參數:
+    config (dict): 重建配置。
+    """
+    n_cores = get_core_count(config)
+    # 使用整台機器時保留一個核心給主行程
+    by_cores = max(1, n_cores - 1 if config["worker_cores"] <= 0 else n_cores)
+    by_memory = int(get_memory_budget(config) // (config["worker_memory_gb"] * GB))
+    return max(1, min(by_cores, by_memory))
+
+
+def plan_parallelism(n_tasks, config):
+    """
+    依工作數量與核心數決定行程數 × 每個行程的執行緒數。
+    工作數少於核心數時，每個行程改用多個 OpenMP 執行緒，讓核心不致閒置。
+
+    參數:
+    n_tasks (int): 階段的工作數量。
+    config (dict): 重建配置。
+    """
+    processes = max(1, min(plan_pool_size(config), n_tasks))
+    if config["worker_threads"] > 0:
+        threads = config["worker_threads"]
+    else:
+        threads = max(1, get_core_count(config) // processes)
+    return processes, threads
+
+
+THREAD_VARIABLES = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+
+
+@contextmanager
+def thread_environment(threads):
+    """
+    暫時設置 OpenMP 與 BLAS 的執行緒數環境變數，期間 spawn 的子行程會繼承這些值。
+    spawn 的子行程在執行初始化函數之前就會重新載入主模組（已載入 open3d），
+    因此執行緒數必須在建立行程之前由父行程設置；結束後恢復父行程原本的值。
+
+    參數:
+    threads (int): 每個子行程的執行緒數。
+    """
+    saved = {name: os.environ.get(name) for name in THREAD_VARIABLES}
+    for name in THREAD_VARIABLES:
+        os.environ[name] = str(threads)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def get_thread_count():
+    """
+    回傳目前行程實際使用的 OpenMP/BLAS 執行緒數。安裝 threadpoolctl 時
+    讀取已載入函式庫的設定，否則以行程啟動時繼承的 OMP_NUM_THREADS 為準。
+    """
+    try:
+        from threadpoolctl import threadpool_info
+        counts = [info["num_threads"] for info in threadpool_info()]
+        if counts:
+            return max(counts)
+    except ImportError:
+        pass
+    return int(os.environ.get("OMP_NUM_THREADS", multiprocessing.cpu_count()))
+
+
+def _set_affinity(index, threads, config):
+    # 每個工作行程綁定到重建分配範圍內連續的 threads 個核心
+    n_cores = get_core_count(config)
+    offset = config["worker_core_offset"]
+    n_total = multiprocessing.cpu_count()
+    cores = sorted({(offset + (index * threads + k) % n_cores) % n_total for k in range(threads)})
+    try:
+        psutil.Process().cpu_affinity(cores)
+    except (AttributeError, psutil.Error):
+        pass
+
+
+def _sample_rss(interval):
+    global _peak_rss
+    while True:
+        try:
+            rss = _process.memory_info().rss
+        except psutil.Error:
+            return
+        if rss > _peak_rss:
+            _peak_rss = rss
+        time.sleep(interval)
+
+
+def _init_worker(shared, threads=1, counter=None):
+    # 執行緒數由父行程在建立行程時以環境變數傳入，這裡只預先載入重量級模組
+    import numpy
+    import open3d
+    try:
+        import cv2
+        cv2.setNumThreads(threads)
+    except ImportError:
+        pass
+    if counter is not None:
+        with counter.get_lock():
+            index = counter.value
+            counter.value += 1
+        _set_affinity(index, threads, shared["config"])
+    set_shared(shared)
+    profiling.configure(shared["config"])
+    import bag_frames
+    bag_frames.configure(shared["config"])
+    global _process
+    _process = psutil.Process()
+    threading.Thread(target=_sample_rss, args=(0.02,), daemon=True).start()
+
+
+def _worker_ready(_):
+    time.sleep(0.05)
+    return os.getpid(), get_thread_count()
+
+
+def _run_task(payload):
+    # 回傳工作結果與工作期間增加的 RSS 峰值
+    global _peak_rss
+    function, args = pickle.loads(payload)
+    start_rss = _peak_rss = _process.memory_info().rss
+    try:
+        with profiling.span(function.__name__):
+            result = function(*args)
+    finally:
+        profiling.flush()
+    return result, max(0, _peak_rss - start_rss)
+
+
+def schedule_by_cost(args_list, costs=None):
+    """
+    依預測成本排序工作，回傳的列表由尾端取出時會先取得成本最高的工作。
+
+    參數:
+    args_list (list): 每個工作的參數。
+    costs (list, optional): 每個工作的預測成本。預設為 None，保持原順序。
+    """
+    args_list = list(args_list)
+    if costs is None:
+        return args_list[::-1]
+    # 成本相同的工作維持原本的先後順序
+    order = sorted(range(len(args_list)), key=lambda i: (costs[i], -i))
+    return [args_list[i] for i in order]
+
+
+class _TaskError:
+    def __init__(self, error):
+        self.error = error
+
+
+class StageStats:
+    def __init__(self, name):
+        """
+        初始化 StageStats 類別，記錄單一階段提交工作的統計。
+
+        參數:
+        name (str): 階段名稱。
+        """
+        self.name = name
+        self.n_tasks = 0
+        self.pickle_bytes = 0
+        self.pickle_time = 0.0
+        self.memory_budget = 0
+        self.peak_task_memory = 0
+        self.peak_reserved = 0
+
+    def summary(self):
+        """
+        回傳階段統計的文字摘要。
+        """
+        message = (f"{self.name}: {self.n_tasks} tasks, "
+                   f"{self.pickle_bytes / 1024.0:.1f} KB pickled in {self.pickle_time * 1000.0:.1f} ms")
+        if self.memory_budget > 0:
+            message += (f", peak task {self.peak_task_memory / 1024.0 ** 2:.0f} MB, "
+                        f"peak reserved {self.peak_reserved / GB:.2f} / {self.memory_budget / GB:.2f} GB")
+        return message
+
+
+class WorkerPool:
+    def __init__(self, processes, shared, threads=1, affinity=False):
+        """
+        初始化 WorkerPool 類別，建立在整個重建流程中常駐的 spawn 行程池。
+
+        參數:
+        processes (int): 工作行程數量。
+        shared (dict): 傳送給每個工作行程一次的共享狀態。
+        threads (int, optional): 每個工作行程的 OpenMP 執行緒數。預設為 1。
+        affinity (bool, optional): 是否將工作行程綁定到固定的核心。預設為 False。
+        """
+        self.shared = shared
+        self.config = shared["config"]
+        self.affinity = affinity
+        self.stats = StageStats("setup")
+        # 執行中工作預估記憶體的總和，派送前檢查是否超過階段的記憶體預算
+        self._lock = threading.Lock()
+        self._reserved = 0
+        self._memory_ratio = None
+        self._terminated = False
+        self._start(processes, threads)
+        set_shared(shared)
+
+    def _start(self, processes, threads):
+        self.processes = processes
+        self.threads = threads
+        start_time = time.time()
+        mp_context = multiprocessing.get_context('spawn')
+        counter = mp_context.Value('i', 0) if self.affinity else None
+        with thread_environment(threads):
+            self.pool = mp_context.Pool(processes=processes, initializer=_init_worker,
+                                        initargs=(self.shared, threads, counter))
+        # 等待所有工作行程完成模組預載，並記錄工作行程回報的實際執行緒數
+        reports = self.pool.map(_worker_ready, range(processes), chunksize=1)
+        self.worker_threads = sorted({count for _, count in reports})
+        self.startup_time = time.time() - start_time
+
+    def plan_stage(self, n_tasks):
+        """
+        依階段的工作數量選擇行程數 × 執行緒數並記錄計畫。執行緒數只能在
+        工作行程啟動時設定，因此行程數或執行緒數改變時會重新啟動行程池，
+        記錄的執行緒數為工作行程實際回報的值。
+
+        參數:
+        n_tasks (int): 階段的工作數量。
+        """
+        processes, threads = plan_parallelism(n_tasks, self.config)
+        if processes != self.processes or threads != self.threads:
+            self.pool.close()
+            self.pool.join()
+            self._start(processes, threads)
+            restarted = f", pool restarted in {self.startup_time:.2f} s"
+        else:
+            restarted = ""
+        self.shared["message_queue"].put(
+            f"Parallel plan :: {self.stats.name}: {n_tasks} tasks on {self.processes} processes "
+            f"x {'/'.join(str(count) for count in self.worker_threads)} threads{restarted}")
+        return self.processes, self.threads
+
+    def begin_stage(self, name):
+        """
+        開始記錄新階段的統計，並依目前可用記憶體重新計算階段的記憶體預算。
+
+        參數:
+        name (str): 階段名稱。
+        """
+        self.stats = StageStats(name)
+        self.stats.memory_budget = get_memory_budget(self.config)
+        self._memory_ratio = None
+        return self.stats
+
+    def _pack(self, function, args):
+        start_time = time.perf_counter()
+        with profiling.span("pickle", "dispatch"):
+            payload = pickle.dumps((function, args), protocol=pickle.HIGHEST_PROTOCOL)
+        self.stats.pickle_time += time.perf_counter() - start_time
+        self.stats.pickle_bytes += len(payload)
+        self.stats.n_tasks += 1
+        return payload
+
+    def _project(self, memory):
+        # 已有實測值時，以實測與預估的最大比例修正預估值
+        if self._memory_ratio is None:
+            return int(memory)
+        return int(memory * self._memory_ratio)
+
+    def _admit(self, need):
+        return self._reserved == 0 or self._reserved + need <= self.stats.memory_budget
+
+    def _reserve(self, need):
+        with self._lock:
+            self._reserved += need
+            self.stats.peak_reserved = max(self.stats.peak_reserved, self._reserved)
+
+    def _release(self, need):
+        with self._lock:
+            self._reserved -= need
+
+    def _record(self, memory, measured):
+        self.stats.peak_task_memory = max(self.stats.peak_task_memory, measured)
+        if memory > 0:
+            ratio = min(4.0, max(0.25, measured / memory))
+            self._memory_ratio = ratio if self._memory_ratio is None else max(self._memory_ratio, ratio)
+
+    def apply_async(self, function, args, memory=0):
+        """
+        提交單一工作。工作會立即提交，但其預估記憶體會計入預算，
+        使同時進行的 imap_unordered 暫緩派送。
+
+        參數:
+        function (callable): 模組層級的工作函數。
+        args (tuple): 工作參數。
+        memory (int, optional): 工作的預估峰值記憶體（位元組）。預設為 0。
+        """
+        need = self._project(memory)
+        self._reserve(need)
+
+        def done(result):
+            self._release(need)
+            self._record(memory, result[1])
+
+        return _PoolResult(self.pool.apply_async(_run_task, (self._pack(function, args),),
+                                                 callback=done,
+                                                 error_callback=lambda e: self._release(need)))
+
+    def imap_unordered(self, function, args_list, costs=None, memory=None, max_running=None):
+        """
+        動態派送多個工作並依完成順序串流回傳結果。
+
+        工作依預測成本由大到小排序，每次只派送一個，工作行程空閒時才補上下一個，
+        避免 starmap 靜態分塊造成的負載不均。提供預估記憶體時，只在執行中工作的
+        預估總和加上新工作仍低於記憶體預算時才派送。
+
+        參數:
+        function (callable): 模組層級的工作函數。
+        args_list (list): 每個工作的參數。
+        costs (list, optional): 每個工作的預測成本（數值或可比較的 tuple）。預設為 None。
+        memory (list, optional): 每個工作的預估峰值記憶體（位元組）。預設為 None。
+        max_running (int, optional): 同時執行的工作數上限。預設為 None，即工作行程數量。
+        """
+        args_list = list(args_list)
+        if memory is None:
+            memory = [0] * len(args_list)
+        pending = schedule_by_cost(range(len(args_list)), costs)
+        results = queue.Queue()
+        n_running = 0
+        limit = self.processes if max_running is None else max(1, min(self.processes, max_running))
+        try:
+            while pending or n_running > 0:
+                # 停止事件設置後不再派送新的工作，只等待執行中的工作結束
+                if stop_requested():
+                    pending = []
+                while pending and n_running < limit:
+                    i = pending[-1]
+                    need = self._project(memory[i])
+                    # 超過記憶體預算時暫緩派送，但至少保留一個執行中的工作
+                    if n_running > 0 and not self._admit(need):
+                        break
+                    pending.pop()
+                    self._reserve(need)
+                    self.pool.apply_async(_run_task, (self._pack(function, args_list[i]),),
+                                          callback=lambda r, i=i, need=need: results.put((i, need, r)),
+                                          error_callback=lambda e, need=need: results.put((None, need, _TaskError(e))))
+                    n_running += 1
+                i, need, result = results.get()
+                n_running -= 1
+                self._release(need)
+                if isinstance(result, _TaskError):
+                    raise result.error
+                value, measured = result
+                self._record(memory[i], measured)
+                yield value
+        finally:
+            # 工作失敗或呼叫端提前結束時，等待已派送的工作結束並釋放其預留的記憶體，
+            # 之後的階段共用同一個行程池，不能繼承未釋放的預留
+            while n_running > 0 and not self._terminated:
+                try:
+                    _, need, _ = results.get(timeout=1.0)
+                except queue.Empty:
+                    continue
+                n_running -= 1
+                self._release(need)
+
+    def close(self):
+        """
+        關閉行程池。
+        """
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        """
+        強制終止行程池。
+        """
+        self._terminated = True
+        self.pool.terminate()
+        self.pool.join()
+
+
+class _PoolResult:
+    def __init__(self, async_result):
+        self.async_result = async_result
+
+    def ready(self):
+        return self.async_result.ready()
+
+    def get(self, timeout=None):
+        return self.async_result.get(timeout)[0]
+
+
+class _ImmediateResult:
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def get(self, timeout=None):
+        return self.value
+
+
+class SerialPool:
+    def __init__(self, shared):
+        """
+        初始化 SerialPool 類別，在目前行程中依序執行工作，介面與 WorkerPool 相同。
+
+        參數:
+        shared (dict): 共享狀態。
+        """
+        self.processes = 1
+        self.threads = get_core_count(shared["config"])
+        self.startup_time = 0.0
+        self.stats = StageStats("setup")
+        set_shared(shared)
+
+    def begin_stage(self, name):
+        self.stats = StageStats(name)
+        return self.stats
+
+    def plan_stage(self, n_tasks):
+        return self.processes, self.threads
+
+    def apply_async(self, function, args, memory=0):
+        self.stats.n_tasks += 1
+        with profiling.span(function.__name__):
+            return _ImmediateResult(function(*args))
+
+    def imap_unordered(self, function, args_list, costs=None, memory=None, max_running=None):
+        pending = schedule_by_cost(args_list, costs)
+        while pending and not stop_requested():
+            self.stats.n_tasks += 1
+            with profiling.span(function.__name__):
+                result = function(*pending.pop())
+            yield result
+
+    def close(self):
+        pass
+
+    def terminate(self):
+        pass
+
+
+def create_pool(config, shared):
+    """
+    依配置建立行程池。
+
+    參數:
+    config (dict): 重建配置。
+    shared (dict): 共享狀態。
+    """
+    if config["distributed_queue"]:
+        from distributed_pool import SharedFolderPool
+        return SharedFolderPool(config, shared)
+    if config["python_multi_threading"] is True:
+        return WorkerPool(plan_pool_size(config), shared, affinity=config["worker_cpu_affinity"])
+    return SerialPool(shared)
+
+
+@contextmanager
+def stage_pool(pool, config, stop_event, message_queue):
+    """
+    取得階段使用的行程池；單獨執行階段時會建立暫時的行程池。
+
+    參數:
+    pool (WorkerPool or SerialPool or None): 重建系統持有的行程池。
+    config (dict): 重建配置。
+    stop_event (multiprocessing.Event): 停止事件。
+    message_queue (ProgressChannel): 進度通道。
+    """
+    if pool is not None:
+        yield pool
+        return
+    pool = create_pool(config, make_shared_state(config, stop_event, message_queue))
+    try:
+        yield pool
+    finally:
+        pool.close()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# run_system 的模組以模組名稱互相載入，測試以相同方式載入
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "src", "realsense", "run_system")))
@@ -0,0 +1,149 @@
+import os
+import json
+
+import pytest
+
+np = pytest.importorskip("numpy")
+o3d = pytest.importorskip("open3d")
+
+import bag_frames
+from bag_frames import (BAG_SEPARATOR, configure, get_index_name, open_bag_dataset, read_bag_frame_lists,
+                        read_image, read_tensor_image)
+
+N_FRAMES = 10
+TIMESTAMPS = [1000 + 33333 * i for i in range(N_FRAMES)]
+
+
+class FakeImage:
+    def __init__(self, array):
+        self.array = array
+
+    def to_legacy(self):
+        return self.array
+
+
+class FakeFrame:
+    def __init__(self, index):
+        # 影像內容即幀索引，可檢查讀到的是哪一幀
+        self.color = FakeImage(np.full((4, 6, 3), index, dtype=np.uint8))
+        self.depth = FakeImage(np.full((4, 6), 1000 + index, dtype=np.uint16))
+
+
+class FakeMetadata:
+    depth_scale = 1000.0
+    intrinsics = o3d.camera.PinholeCameraIntrinsic(6, 4, 5.0, 5.0, 3.0, 2.0)
+
+
+class FakeBagReader:
+    """
+    以記憶體中的幀模擬 RSBagReader，記錄開啟與定位的次數。
+    """
+    opened = 0
+    seeks = []
+
+    def __init__(self):
+        self.position = 0
+        self.current = None
+        self.eof = False
+        self.metadata = FakeMetadata()
+
+    def open(self, filename):
+        FakeBagReader.opened += 1
+
+    def close(self):
+        pass
+
+    def next_frame(self):
+        if self.position >= N_FRAMES:
+            self.eof = True
+            return None
+        self.current = self.position
+        self.position += 1
+        return FakeFrame(self.current)
+
+    def is_eof(self):
+        return self.eof
+
+    def get_timestamp(self):
+        return TIMESTAMPS[self.current]
+
+    def seek_timestamp(self, timestamp):
+        FakeBagReader.seeks.append(TIMESTAMPS.index(timestamp))
+        self.position = TIMESTAMPS.index(timestamp)
+        self.eof = False
+
+
+@pytest.fixture
+def bag_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(bag_frames.o3d.t.io, "RSBagReader", FakeBagReader)
+    FakeBagReader.opened = 0
+    FakeBagReader.seeks = []
+    # 每個測試從未開啟 bag 的行程狀態開始
+    monkeypatch.setattr(bag_frames, "_reader", None)
+    monkeypatch.setattr(bag_frames, "_reader_file", None)
+    bag_frames._cache.clear()
+    configure({"bag_cache_frames": 4, "bag_read_ahead": 3})
+    filename = str(tmp_path / "capture.bag")
+    open(filename, 'w').close()
+    yield filename
+    bag_frames._cache.clear()
+    configure({"bag_cache_frames": 120, "bag_read_ahead": 30})
+
+
+def test_open_bag_dataset_indexes_timestamps_once(bag_file):
+    frames_folder, path_intrinsic, depth_scale = open_bag_dataset(bag_file)
+    assert frames_folder == os.path.splitext(bag_file)[0] and os.path.isdir(frames_folder)
+    assert depth_scale == 1000.0
+    assert o3d.io.read_pinhole_camera_intrinsic(path_intrinsic).width == 6
+    with open(get_index_name(bag_file)) as f:
+        assert json.load(f)["timestamps"] == TIMESTAMPS
+    # 索引存在時不再掃描 bag
+    open_bag_dataset(bag_file)
+    assert FakeBagReader.opened == 1
+
+
+def test_frame_lists_reference_every_frame(bag_file):
+    open_bag_dataset(bag_file)
+    color_files, depth_files = read_bag_frame_lists(bag_file)
+    assert len(color_files) == len(depth_files) == N_FRAMES
+    assert color_files[7] == f"{bag_file}{BAG_SEPARATOR}color/000007"
+    assert depth_files[7] == f"{bag_file}{BAG_SEPARATOR}depth/000007"
+
+
+def test_read_seeks_to_the_frame_timestamp_and_reads_ahead(bag_file):
+    open_bag_dataset(bag_file)
+    color_files, depth_files = read_bag_frame_lists(bag_file)
+    assert np.asarray(read_image(color_files[5]))[0, 0, 0] == 5
+    assert np.asarray(read_image(depth_files[6]))[0, 0] == 1006
+    assert read_tensor_image(color_files[7]).as_tensor().numpy()[0, 0, 0] == 7
+    # 第 5 幀定位一次後預讀到第 7 幀，第 8 幀需要再定位
+    assert FakeBagReader.seeks == [5]
+    assert np.asarray(read_image(color_files[8]))[0, 0, 0] == 8
+    assert FakeBagReader.seeks == [5, 8]
+
+
+def test_read_ahead_stops_at_the_last_frame(bag_file):
+    open_bag_dataset(bag_file)
+    color_files, _ = read_bag_frame_lists(bag_file)
+    assert np.asarray(read_image(color_files[N_FRAMES - 1]))[0, 0, 0] == N_FRAMES - 1
+    assert sorted(index for _, index in bag_frames._cache) == [N_FRAMES - 1]
+
+
+def test_cache_is_bounded_and_keeps_recent_frames(bag_file):
+    open_bag_dataset(bag_file)
+    color_files, _ = read_bag_frame_lists(bag_file)
+    for i in range(N_FRAMES):
+        read_image(color_files[i])
+    assert len(bag_frames._cache) <= 4
+    n_seeks = len(FakeBagReader.seeks)
+    read_image(color_files[N_FRAMES - 1])
+    assert len(FakeBagReader.seeks) == n_seeks
+    read_image(color_files[0])
+    assert len(FakeBagReader.seeks) == n_seeks + 1
+
+
+def test_image_files_are_read_directly(tmp_path):
+    filename = str(tmp_path / "depth.png")
+    o3d.io.write_image(filename, o3d.geometry.Image(np.full((4, 6), 1234, dtype=np.uint16)))
+    assert np.asarray(read_image(filename))[0, 0] == 1234
+    assert read_tensor_image(filename).as_tensor().numpy()[0, 0, 0] == 1234
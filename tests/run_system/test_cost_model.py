@@ -0,0 +1,106 @@
+import itertools
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("psutil")
+
+from cost_model import (CANDIDATES, DEFAULT_SECONDS_PER_UNIT, STAGES, CostModel, apply_time_budget,
+                        choose_profile, read_history, record_run)
+
+CONFIG = {
+    "n_frames_per_fragment": 100,
+    "tsdf_cubic_size": 3.0,
+    "voxel_size": 0.05,
+    "n_keyframes_per_n_frame": 5,
+    "ransac_max_iteration": 1000000,
+    "max_iterations": 5,
+    "time_budget_s": 0,
+    "time_budget_fixed": [],
+    "worker_cores": 4,
+    "worker_memory_gb": 1.0,
+    "memory_budget_gb": 100.0,
+}
+
+
+def make_config(tmp_path, **overrides):
+    return dict(CONFIG, cost_history=str(tmp_path / "history.jsonl"), **overrides)
+
+
+def test_uncalibrated_model_uses_default_costs():
+    model = CostModel([], 4)
+    assert model.seconds_per_unit == DEFAULT_SECONDS_PER_UNIT
+    assert all(n == 0 for n in model.n_samples.values())
+
+
+def test_recorded_run_calibrates_the_model(tmp_path):
+    config = make_config(tmp_path)
+    actual = {"make_fragments": 120.0, "register_fragments": 30.0}
+    record_run(config, actual, 1000)
+    model = CostModel(read_history(config["cost_history"]), 4)
+    # 相同參數與幀數時，預測值等於記錄的實際時間
+    for stage, seconds in actual.items():
+        assert model.n_samples[stage] == 1
+        assert model.predict(stage, 1000, config) == pytest.approx(seconds)
+    assert model.n_samples["integrate_scene"] == 0
+
+
+def test_calibration_uses_the_median(tmp_path):
+    config = make_config(tmp_path)
+    for seconds in (10.0, 11.0, 12.0, 13.0, 500.0):
+        record_run(config, {"integrate_scene": seconds}, 1000)
+    model = CostModel(read_history(config["cost_history"]), 4)
+    assert model.predict("integrate_scene", 1000, config) == pytest.approx(12.0)
+
+
+def test_history_skips_corrupt_lines(tmp_path):
+    config = make_config(tmp_path)
+    record_run(config, {"slac": 5.0}, 500)
+    with open(config["cost_history"], 'a') as f:
+        f.write('{"stage": "sl')
+    assert len(read_history(config["cost_history"])) == 1
+
+
+def test_choose_profile_picks_best_quality_within_budget(tmp_path):
+    model = CostModel([], 4)
+    params, predicted = choose_profile(make_config(tmp_path, time_budget_s=1e9), STAGES, 1000, model)
+    assert params == {key: values[0] for key, values in CANDIDATES.items()}
+    assert set(predicted) == set(STAGES)
+
+
+def test_choose_profile_falls_back_to_fastest(tmp_path):
+    model = CostModel([], 4)
+    config = make_config(tmp_path, time_budget_s=1e-9)
+    params, predicted = choose_profile(config, STAGES, 1000, model)
+    fastest = min(
+        sum(model.predict_all(STAGES, 1000, dict(config, **dict(zip(CANDIDATES, values)))).values())
+        for values in itertools.product(*CANDIDATES.values()))
+    assert sum(predicted.values()) == pytest.approx(fastest)
+
+
+def test_choose_profile_respects_budget_and_fixed_keys(tmp_path):
+    model = CostModel([], 4)
+    slowest = sum(model.predict_all(STAGES, 1000, dict(CONFIG, **{k: v[0] for k, v in CANDIDATES.items()})).values())
+    config = make_config(tmp_path, time_budget_s=slowest / 2, time_budget_fixed=["voxel_size"])
+    params, predicted = choose_profile(config, STAGES, 1000, model)
+    assert "voxel_size" not in params
+    assert sum(predicted.values()) <= config["time_budget_s"]
+
+
+class MessageList(list):
+    put = list.append
+
+
+def test_time_budget_recomputes_derived_subfolder(tmp_path):
+    # 預算極小時選擇最快的組合，voxel_size 會變大
+    config = make_config(tmp_path, time_budget_s=1e-9, subfolder_slac="slac/0.050/")
+    apply_time_budget(config, STAGES, 1000, MessageList())
+    assert config["voxel_size"] != CONFIG["voxel_size"]
+    assert config["subfolder_slac"] == "slac/%0.3f/" % config["voxel_size"]
+
+
+def test_time_budget_keeps_explicit_subfolder(tmp_path):
+    config = make_config(tmp_path, time_budget_s=1e-9, subfolder_slac="my_slac/")
+    apply_time_budget(config, STAGES, 1000, MessageList())
+    assert config["voxel_size"] != CONFIG["voxel_size"]
+    assert config["subfolder_slac"] == "my_slac/"
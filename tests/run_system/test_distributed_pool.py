@@ -0,0 +1,126 @@
+import os
+import queue
+import time
+import threading
+import multiprocessing
+
+import pytest
+
+pytest.importorskip("psutil")
+pytest.importorskip("open3d")
+
+from distributed_pool import SharedFolderPool, run_worker
+from progress import ProgressChannel
+
+LEASE_TIMEOUT = 2.0
+
+
+def square(value):
+    return value * value
+
+
+def fail_on(value, bad):
+    if value == bad:
+        raise ValueError(value)
+    return value
+
+
+def hang_once(folder):
+    # 第一次執行時留下標記並卡住，模擬執行到一半當機的工作者；重新排入後立即完成
+    marker = os.path.join(folder, "started")
+    if not os.path.exists(marker):
+        open(marker, 'w').close()
+        time.sleep(60)
+    with open(os.path.join(folder, "completed"), 'a') as f:
+        f.write(f"{os.getpid()}\n")
+    return "done"
+
+
+def make_pool(queue_dir):
+    config = {
+        "distributed_queue": str(queue_dir),
+        "distributed_poll_interval": 0.05,
+        "distributed_lease_timeout": LEASE_TIMEOUT,
+        "worker_threads": 1,
+        "profiling": False,
+        "bag_cache_frames": 1,
+        "bag_read_ahead": 1,
+    }
+    shared = {
+        "config": config,
+        "color_files": [],
+        "depth_files": [],
+        "stop_event": threading.Event(),
+        "message_queue": ProgressChannel(queue.Queue()),
+    }
+    return SharedFolderPool(config, shared)
+
+
+def start_workers(queue_dir, n_workers):
+    mp_context = multiprocessing.get_context('spawn')
+    workers = {}
+    for i in range(n_workers):
+        name = f"worker{i}"
+        workers[name] = mp_context.Process(
+            target=run_worker, args=(str(queue_dir), name, 1, 0.05, LEASE_TIMEOUT, 0), daemon=True)
+        workers[name].start()
+    return workers
+
+
+@pytest.fixture
+def queue_dir(tmp_path):
+    return tmp_path / "queue"
+
+
+@pytest.fixture
+def workers(queue_dir):
+    workers = start_workers(queue_dir, 2)
+    yield workers
+    for worker in workers.values():
+        worker.terminate()
+        worker.join()
+
+
+def run_files(queue_dir, run_id):
+    return [name for folder in ("tasks", "leases", "results")
+            for name in os.listdir(queue_dir / folder) if name.startswith(run_id)]
+
+
+def test_local_workers_run_imap_unordered_and_apply_async(queue_dir, workers):
+    pool = make_pool(queue_dir)
+    values = list(range(10))
+    assert sorted(pool.imap_unordered(square, [(v,) for v in values], costs=values)) == [v * v for v in values]
+    results = [pool.apply_async(square, (v,)) for v in values]
+    assert [result.get(timeout=60) for result in results] == [v * v for v in values]
+    pool.close()
+    assert run_files(queue_dir, pool.run_id) == []
+
+
+def test_failed_task_is_raised_on_the_coordinator(queue_dir, workers):
+    pool = make_pool(queue_dir)
+    with pytest.raises(RuntimeError, match="ValueError"):
+        list(pool.imap_unordered(fail_on, [(v, 3) for v in range(5)]))
+    pool.close()
+
+
+def test_expired_lease_is_requeued_and_completed_once(tmp_path, queue_dir, workers):
+    pool = make_pool(queue_dir)
+    result = pool.apply_async(hang_once, (str(tmp_path),))
+    deadline = time.time() + 60
+    while not os.path.exists(tmp_path / "started"):
+        assert time.time() < deadline
+        time.sleep(0.05)
+    # 終止持有租約的工作者，租約不再更新
+    [lease] = os.listdir(queue_dir / "leases")
+    holder = lease.split(".")[1]
+    workers[holder].terminate()
+    workers[holder].join()
+    assert result.get(timeout=60) == "done"
+    with open(tmp_path / "completed") as f:
+        assert len(f.read().splitlines()) == 1
+    messages = []
+    while not pool.shared["message_queue"].queue.empty():
+        messages.append(pool.shared["message_queue"].queue.get())
+    assert any(event[0] == "log" and "expired" in event[1] for event in messages)
+    pool.close()
+    assert run_files(queue_dir, pool.run_id) == []
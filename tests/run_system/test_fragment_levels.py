@@ -0,0 +1,78 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+o3d = pytest.importorskip("open3d")
+
+from fragment_levels import (get_level_file_names, get_level_name, get_level_voxel_sizes, read_fragment_pointcloud,
+                             write_fragment_levels)
+
+CONFIG = {
+    "voxel_size": 0.05,
+    "template_fragment_pointcloud": "fragments/fragment_%03d.ply",
+    "template_fragment_pointcloud_level": "fragments/levels/fragment_%03d_%0.4f.ply",
+}
+
+
+def make_config(tmp_path):
+    os.makedirs(tmp_path / "fragments", exist_ok=True)
+    return dict(CONFIG, path_dataset=str(tmp_path))
+
+
+def fragment_pointcloud(seed):
+    rng = np.random.default_rng(seed)
+    pcd = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(rng.uniform(0, 1, (20000, 3))))
+    pcd.colors = o3d.utility.Vector3dVector(rng.uniform(0, 1, (20000, 3)))
+    return pcd
+
+
+def full_name(config, fragment_id):
+    return os.path.join(config["path_dataset"], config["template_fragment_pointcloud"] % fragment_id)
+
+
+def test_level_voxel_sizes_and_names(tmp_path):
+    config = make_config(tmp_path)
+    assert get_level_voxel_sizes(config) == [0.05, 0.025, 0.0125]
+    assert get_level_name(config, 3, 0.0125) == os.path.join(
+        str(tmp_path), "fragments/levels/fragment_003_0.0125.ply")
+    # 相同體素大小的不同浮點表示對應同一個檔案
+    assert get_level_name(config, 3, 0.05 / 4.0) == get_level_name(config, 3, 0.0125)
+
+
+def test_write_fragment_levels(tmp_path):
+    config = make_config(tmp_path)
+    pcd = fragment_pointcloud(0)
+    write_fragment_levels(pcd, full_name(config, 0), 0, config)
+    assert len(o3d.io.read_point_cloud(full_name(config, 0)).points) == len(pcd.points)
+    n_points = []
+    for voxel_size in get_level_voxel_sizes(config):
+        level = o3d.io.read_point_cloud(get_level_name(config, 0, voxel_size))
+        assert level.has_normals() and level.has_colors()
+        n_points.append(len(level.points))
+    # 較細的解析度保留較多點
+    assert n_points == sorted(n_points)
+    assert n_points[-1] < len(pcd.points)
+
+
+def test_level_file_names_fall_back_to_full_fragments(tmp_path):
+    config = make_config(tmp_path)
+    write_fragment_levels(fragment_pointcloud(0), full_name(config, 0), 0, config)
+    # 舊版流程只產生完整點雲
+    o3d.io.write_point_cloud(full_name(config, 1), fragment_pointcloud(1))
+    names = get_level_file_names(config, 2, config["voxel_size"])
+    assert names == [get_level_name(config, 0, config["voxel_size"]), full_name(config, 1)]
+
+
+def test_read_fragment_pointcloud_selects_the_level(tmp_path):
+    config = make_config(tmp_path)
+    write_fragment_levels(fragment_pointcloud(0), full_name(config, 0), 0, config)
+    o3d.io.write_point_cloud(full_name(config, 1), fragment_pointcloud(1))
+    for voxel_size in get_level_voxel_sizes(config):
+        stored = read_fragment_pointcloud(config, 0, voxel_size)
+        expected = o3d.io.read_point_cloud(get_level_name(config, 0, voxel_size))
+        np.testing.assert_array_equal(np.asarray(stored.points), np.asarray(expected.points))
+        # 沒有降採樣點雲時由完整點雲降採樣並估計法向量
+        fallback = read_fragment_pointcloud(config, 1, voxel_size)
+        assert fallback.has_normals()
+        assert len(fallback.points) == len(fragment_pointcloud(1).voxel_down_sample(voxel_size).points)
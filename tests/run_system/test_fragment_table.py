@@ -0,0 +1,83 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("open3d")
+
+from fragment_table import (uniform_fragment_table, adaptive_fragment_table, predict_fragment_cost,
+                            write_fragment_table, read_fragment_table)
+from make_fragments import get_keyframes_for_fragment, get_rgbd_pairs_for_fragment
+
+CONFIG = {
+    "n_frames_per_fragment": 10,
+    "n_keyframes_per_n_frame": 5,
+    "fragment_min_frames": 3,
+    "fragment_motion_target": 1.0,
+    "fragment_max_cost": 0,
+    "template_fragment_table": "fragment_table.json",
+}
+
+
+def assert_covers(table, n_files):
+    # 片段依序相接並涵蓋所有幀
+    assert table[0][0] == 0 and table[-1][1] == n_files
+    assert all(a[1] == b[0] for a, b in zip(table, table[1:]))
+
+
+def test_uniform_fragment_table():
+    assert uniform_fragment_table(25, CONFIG) == [(0, 10), (10, 20), (20, 25)]
+    assert uniform_fragment_table(0, CONFIG) == []
+
+
+def test_fast_motion_makes_shorter_fragments():
+    motion = np.concatenate([np.full(30, 0.01), np.full(30, 0.25)])
+    table = adaptive_fragment_table(motion, CONFIG)
+    assert_covers(table, 61)
+    sizes = [eid - sid for sid, eid in table]
+    assert all(size >= CONFIG["fragment_min_frames"] for size in sizes)
+    # 緩慢段落受成本上限限制，快速段落每 4 幀累積的運動量就達到目標
+    assert sizes[0] > sizes[-2]
+    assert sizes[-2] == 4
+
+
+def test_slow_motion_is_limited_by_cost():
+    table = adaptive_fragment_table(np.zeros(99), CONFIG)
+    assert_covers(table, 100)
+    max_cost = predict_fragment_cost(2 * CONFIG["n_frames_per_fragment"], CONFIG)
+    assert all(predict_fragment_cost(eid - sid, CONFIG) <= max_cost for sid, eid in table)
+
+
+def test_short_last_fragment_is_merged():
+    # 每 3 幀切分一次，最後剩下的 2 幀少於 fragment_min_frames
+    table = adaptive_fragment_table(np.full(7, 0.5), CONFIG)
+    assert table == [(0, 3), (3, 8)]
+
+
+def test_fragment_table_round_trip(tmp_path):
+    config = dict(CONFIG, path_dataset=str(tmp_path))
+    write_fragment_table(config, [(0, 4), (4, 9)], [0.5, 1.2])
+    assert read_fragment_table(config) == [(0, 4), (4, 9)]
+
+
+def test_keyframes_start_at_the_fragment_start():
+    # 依運動切分的片段不一定從 n_keyframes_per_n_frame 的倍數開始
+    for sid, eid in [(0, 12), (7, 19), (13, 14)]:
+        keyframes = get_keyframes_for_fragment(sid, eid, CONFIG)
+        assert keyframes[0] == sid
+        assert keyframes == list(range(sid, eid, CONFIG["n_keyframes_per_n_frame"]))
+
+
+def test_fragment_pairs_use_relative_keyframes():
+    pairs = get_rgbd_pairs_for_fragment(7, 19, CONFIG)
+    odometry = [(s, s + 1) for s in range(7, 18)]
+    loops = [(7, 12), (7, 17), (12, 17)]
+    assert sorted(pairs) == sorted(odometry + loops)
+    # 有閉環候選時只保留候選中的關鍵幀對
+    pairs = get_rgbd_pairs_for_fragment(7, 19, CONFIG, candidates={(7, 17)})
+    assert sorted(pairs) == sorted(odometry + [(7, 17)])
+
+
+def test_predicted_cost_counts_the_registered_pairs():
+    for sid, eid in [(0, 12), (7, 19), (3, 25)]:
+        n_odometry = eid - sid - 1
+        n_loops = len(get_rgbd_pairs_for_fragment(sid, eid, CONFIG)) - n_odometry
+        assert predict_fragment_cost(eid - sid, CONFIG) == n_odometry + 3.0 * n_loops
@@ -0,0 +1,71 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+o3d = pytest.importorskip("open3d")
+
+from frame_prepass import (depth_change, estimate_motion, find_static_frames, iterate_downscaled,
+                           read_downscaled_depth)
+
+CONFIG = {
+    "prepass_downscale": 4,
+    "depth_scale": 1000.0,
+    "depth_max": 3.0,
+    "integrate_prefetch_threads": 2,
+    "static_frame_depth_change": 0.01,
+    "static_frame_grey_change": 0.01,
+    "static_frame_max_run": 3,
+}
+
+
+def write_frames(folder, depths, greys):
+    color_files, depth_files = [], []
+    for i, (depth, grey) in enumerate(zip(depths, greys)):
+        depth_files.append(str(folder / f"depth_{i:03d}.png"))
+        color_files.append(str(folder / f"color_{i:03d}.png"))
+        o3d.io.write_image(depth_files[-1], o3d.geometry.Image(depth))
+        o3d.io.write_image(color_files[-1], o3d.geometry.Image(np.repeat(grey[..., None], 3, axis=2)))
+    return color_files, depth_files
+
+
+def ramp(shift):
+    # 深度與灰階都隨 shift 平移的斜坡影像
+    x = np.arange(64)[None, :] + shift
+    depth = np.repeat(1000 + 10 * x, 48, axis=0).astype(np.uint16)
+    grey = np.repeat((x * 3) % 256, 48, axis=0).astype(np.uint8)
+    return depth, grey
+
+
+def test_iterate_downscaled_keeps_order_and_bounds_prefetch():
+    reading = []
+    peak = []
+
+    def read(value, config):
+        reading.append(value)
+        peak.append(len(reading) - len(results))
+        return value * 2
+
+    results = []
+    for value in iterate_downscaled(range(50), read, CONFIG):
+        results.append(value)
+    assert results == [2 * v for v in range(50)]
+    # 最多預先讀取執行緒數兩倍的幀
+    assert max(peak) <= 2 * CONFIG["integrate_prefetch_threads"]
+
+
+def test_estimate_motion_matches_pairwise_changes(tmp_path):
+    frames = [ramp(shift) for shift in (0, 0, 2, 5, 5)]
+    _, depth_files = write_frames(tmp_path, *zip(*frames))
+    motion = estimate_motion(depth_files, CONFIG)
+    depths = [read_downscaled_depth(f, CONFIG) for f in depth_files]
+    expected = [depth_change(a, b) for a, b in zip(depths, depths[1:])]
+    np.testing.assert_allclose(motion, expected)
+    assert motion[0] == 0.0 and motion[3] == 0.0
+    assert motion[1] > 0 and motion[2] > motion[1]
+
+
+def test_static_frames_are_removed_up_to_the_max_run(tmp_path):
+    shifts = [0] * 6 + [4, 8] + [8] * 2
+    color_files, depth_files = write_frames(tmp_path, *zip(*[ramp(s) for s in shifts]))
+    keep = find_static_frames(color_files, depth_files, CONFIG)
+    # 前 6 幀靜止，最多連續移除 3 幀；移動後的幀都保留
+    assert keep.tolist() == [True, False, False, False, True, False, True, True, False, False]
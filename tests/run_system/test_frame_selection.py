@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+o3d = pytest.importorskip("open3d")
+
+from frame_selection import pose_delta, select_frames
+
+CONFIG = {
+    "depth_scale": 1000.0,
+    "depth_min": 0.3,
+    "depth_max": 3.0,
+    "depth_diff_max": 0.07,
+    "frame_selection_translation": 0.05,
+    "frame_selection_rotation": 10.0,
+    "frame_selection_novelty": 0.1,
+    "frame_selection_max_gap": 10,
+    "frame_selection_keyframes": 3,
+    "frame_selection_stride": 4,
+}
+
+
+def translation(x):
+    pose = np.identity(4)
+    pose[0, 3] = x
+    return pose
+
+
+def write_flat_depths(tmp_path, n_frames, distance=1.5):
+    # 正對平面的深度圖，所有幀相同
+    depth = np.full((48, 64), int(distance * CONFIG["depth_scale"]), dtype=np.uint16)
+    names = []
+    for i in range(n_frames):
+        name = os.path.join(str(tmp_path), f"{i:06d}.png")
+        o3d.io.write_image(name, o3d.geometry.Image(depth))
+        names.append(name)
+    return names
+
+
+def intrinsic():
+    return o3d.camera.PinholeCameraIntrinsic(64, 48, 50.0, 50.0, 31.5, 23.5)
+
+
+def test_pose_delta():
+    rotation = np.identity(4)
+    rotation[:3, :3] = o3d.geometry.get_rotation_matrix_from_xyz([0.0, 0.0, np.radians(30.0)])
+    rotation[:3, 3] = [0.3, 0.4, 0.0]
+    distance, angle = pose_delta(np.identity(4), rotation)
+    assert distance == pytest.approx(0.5)
+    assert angle == pytest.approx(30.0)
+
+
+def test_static_frames_are_skipped_up_to_the_max_gap(tmp_path):
+    depth_files = write_flat_depths(tmp_path, 12)
+    poses = np.array([np.identity(4)] * 12)
+    selected, coverage = select_frames(depth_files, poses, intrinsic(), CONFIG)
+    # 第一幀與連續略過 max_gap 幀後的一幀
+    assert np.flatnonzero(selected).tolist() == [0, 10]
+    assert np.all(coverage[~selected] > 0.99)
+
+
+def test_motion_selects_frames(tmp_path):
+    depth_files = write_flat_depths(tmp_path, 4)
+    poses = np.array([translation(0.0), translation(0.01), translation(0.2), translation(0.21)])
+    selected, _ = select_frames(depth_files, poses, intrinsic(), CONFIG)
+    assert selected.tolist() == [True, False, True, False]
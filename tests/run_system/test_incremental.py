@@ -0,0 +1,101 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+o3d = pytest.importorskip("open3d")
+
+from incremental import select_session_pairs, initial_session_poses, make_scene_pose_graph
+from optimize_posegraph import run_posegraph_optimization
+from posegraph_store import write_pose_graph, read_node_poses
+
+CONFIG = {"incremental_candidates": 2, "export_json_pose_graphs": False}
+
+
+def make_pose(angle, x, y):
+    pose = np.identity(4)
+    pose[:3, :3] = o3d.geometry.get_rotation_matrix_from_xyz([0.0, 0.0, angle])
+    pose[:3, 3] = [x, y, 0.0]
+    return pose
+
+
+def edge_transformation(pose_s, pose_t):
+    # 邊 (s, t) 的變換將 s 轉換到 t 的座標
+    return np.linalg.inv(pose_t) @ pose_s
+
+
+OLD_POSES = np.array([make_pose(0.0, 0.0, 0.0), make_pose(0.1, 1.0, 0.0), make_pose(0.2, 2.0, 0.5)])
+NEW_POSES = np.array([make_pose(0.3, 1.5, 1.0), make_pose(0.4, 2.5, 1.2)])
+
+
+def old_graph():
+    pose_graph = o3d.pipelines.registration.PoseGraph()
+    for pose in OLD_POSES:
+        pose_graph.nodes.append(o3d.pipelines.registration.PoseGraphNode(pose))
+    for s, t in [(0, 1), (1, 2)]:
+        pose_graph.edges.append(o3d.pipelines.registration.PoseGraphEdge(
+            s, t, edge_transformation(OLD_POSES[s], OLD_POSES[t]), np.identity(6) * 10.0, uncertain=False))
+    return pose_graph
+
+
+def session_results(noise=None):
+    poses = np.concatenate([OLD_POSES, NEW_POSES])
+    results = {}
+    for s, t, information in [(3, 4, 1000.0), (1, 3, 5000.0), (2, 4, 8000.0), (0, 4, 100.0)]:
+        transformation = edge_transformation(poses[s], poses[t])
+        if noise is not None and (s, t) == (3, 4):
+            transformation = noise @ transformation
+        results[(s, t)] = (True, transformation, np.identity(6) * information)
+    results[(0, 3)] = (False, np.identity(4), np.zeros((6, 6)))
+    return results
+
+
+def test_select_session_pairs():
+    old_descriptors = np.identity(4)[:3]
+    new_descriptors = np.array([[0.0, 0.9, 0.1, 0.0], [0.0, 0.1, 0.8, 0.2]])
+    pairs = select_session_pairs(3, 2, old_descriptors, new_descriptors, CONFIG)
+    # 新片段之間的所有配對，以及每個新片段最相似的兩個舊片段
+    assert sorted(pairs) == [(1, 3), (1, 4), (2, 3), (2, 4), (3, 4)]
+    assert all(s < t for s, t in pairs)
+
+
+def test_select_session_pairs_with_fewer_old_fragments_than_candidates():
+    pairs = select_session_pairs(1, 2, np.ones((1, 4)), np.ones((2, 4)), dict(CONFIG, incremental_candidates=5))
+    assert sorted(pairs) == [(0, 1), (0, 2), (1, 2)]
+
+
+def test_initial_session_poses_places_the_session_in_the_scene():
+    poses = initial_session_poses(OLD_POSES, 3, 2, session_results())
+    np.testing.assert_allclose(poses, NEW_POSES, atol=1e-9)
+
+
+def test_initial_session_poses_without_scene_pairs():
+    results = {(3, 4): (True, edge_transformation(NEW_POSES[0], NEW_POSES[1]), np.identity(6))}
+    assert initial_session_poses(OLD_POSES, 3, 2, results) is None
+
+
+def test_scene_pose_graph_without_anchors():
+    pose_graph = make_scene_pose_graph(old_graph(), NEW_POSES, session_results(), 3)
+    assert len(pose_graph.nodes) == 5
+    # 兩條舊邊加上四條成功的新邊，失敗的配對不加入
+    assert len(pose_graph.edges) == 6
+    uncertain = {(edge.source_node_id, edge.target_node_id): edge.uncertain for edge in pose_graph.edges}
+    assert not uncertain[(3, 4)] and uncertain[(1, 3)]
+
+
+def test_anchored_optimization_keeps_existing_fragments(tmp_path):
+    # 新場次的里程計邊與新舊配對不一致時，最佳化會拉動舊片段；錨定邊使舊片段保持原本的姿態
+    results = session_results(noise=make_pose(0.01, 0.03, -0.02))
+    pose_graph = make_scene_pose_graph(old_graph(), NEW_POSES, results, 3, anchor=True)
+    assert len(pose_graph.edges) == 6 + 2
+    name = os.path.join(str(tmp_path), "posegraph.json")
+    optimized_name = os.path.join(str(tmp_path), "posegraph_optimized.json")
+    write_pose_graph(name, pose_graph, CONFIG)
+    run_posegraph_optimization(name, optimized_name, max_correspondence_distance=0.07,
+                               preference_loop_closure=0.1, config=CONFIG)
+    optimized = read_node_poses(optimized_name)
+    np.testing.assert_allclose(optimized[:3], OLD_POSES, atol=1e-4)
+    # 保存的場景姿態圖寫回舊節點原本的姿態且不含錨定邊
+    scene_graph = make_scene_pose_graph(old_graph(), optimized[3:], results, 3)
+    np.testing.assert_array_equal([node.pose for node in scene_graph.nodes][:3], OLD_POSES)
+    assert len(scene_graph.edges) == 6
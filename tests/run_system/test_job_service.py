@@ -0,0 +1,141 @@
+import os
+
+import pytest
+
+pytest.importorskip("psutil")
+
+from job_service import JobFiles, JobService, read_json, write_json
+
+
+class FakeProcess:
+    """
+    不實際執行工作的行程替身，由測試決定何時結束。
+    """
+    def __init__(self, target, args, name):
+        self.job_dir = args[0]
+        self.alive = False
+        self.exitcode = None
+
+    def start(self):
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+    def join(self):
+        pass
+
+    def finish(self):
+        JobFiles(self.job_dir).update_status(state="done")
+        self.alive = False
+        self.exitcode = 0
+
+
+class FakeContext:
+    Process = FakeProcess
+
+
+@pytest.fixture
+def service(tmp_path):
+    service = JobService(str(tmp_path), cores=8, memory_gb=16.0, max_jobs=2, poll_interval=0)
+    service.mp_context = FakeContext()
+    return service
+
+
+def submit(service, name, owner="default"):
+    path = os.path.join(service.incoming_dir, f"{name}.json")
+    write_json(path, {"config": {"path_dataset": name}, "stages": ["make"], "owner": owner})
+    # 提交時間取自檔案修改時間，明確遞增避免同一時刻提交的順序不確定
+    submitted = 1000.0 + len(os.listdir(service.incoming_dir)) + len(os.listdir(service.jobs_dir))
+    os.utime(path, (submitted, submitted))
+
+
+def job_config(service, name):
+    return read_json(JobFiles(os.path.join(service.jobs_dir, name)).config)
+
+
+def finish(service, name):
+    service.running[name][0].finish()
+
+
+def test_job_running_alone_gets_the_whole_budget(service):
+    submit(service, "a")
+    service.step()
+    config = job_config(service, "a")
+    assert (config["worker_core_offset"], config["worker_cores"], config["memory_budget_gb"]) == (0, 8, 16.0)
+
+
+def test_jobs_starting_together_split_the_budget(service):
+    submit(service, "a")
+    submit(service, "b")
+    service.step()
+    configs = [job_config(service, name) for name in ("a", "b")]
+    assert sorted(c["worker_core_offset"] for c in configs) == [0, 4]
+    assert all(c["worker_cores"] == 4 and c["memory_budget_gb"] == 8.0 for c in configs)
+
+
+def test_job_waits_until_resources_are_returned(service):
+    submit(service, "a")
+    service.step()
+    submit(service, "b")
+    service.step()
+    # 第一個工作佔用整個預算，第二個工作等待
+    assert list(service.running) == ["a"]
+    assert JobFiles(os.path.join(service.jobs_dir, "b")).read_status()["state"] == "queued"
+    finish(service, "a")
+    service.step()
+    assert list(service.running) == ["b"]
+    assert job_config(service, "b")["worker_cores"] == 8
+    assert service.free_resources() == (0, 0, 0.0)
+
+
+def test_later_job_gets_what_is_free(service):
+    submit(service, "a")
+    submit(service, "b")
+    service.step()
+    finish(service, "a")
+    submit(service, "c")
+    service.step()
+    # c 只分到 a 歸還的核心與記憶體，與 b 不重疊
+    config_b, config_c = job_config(service, "b"), job_config(service, "c")
+    assert config_c["worker_cores"] == 4 and config_c["memory_budget_gb"] == 8.0
+    assert config_c["worker_core_offset"] != config_b["worker_core_offset"]
+
+
+def test_budget_is_split_only_among_jobs_it_can_hold(tmp_path):
+    service = JobService(str(tmp_path), cores=8, memory_gb=1.5, max_jobs=2, poll_interval=0)
+    service.mp_context = FakeContext()
+    submit(service, "a")
+    submit(service, "b")
+    service.step()
+    # 平分後每個工作只有 0.75 GB，因此只開始一個工作並給它全部記憶體
+    assert len(service.running) == 1
+    assert job_config(service, next(iter(service.running)))["memory_budget_gb"] == 1.5
+    assert service.job_share(1) is None
+
+
+def test_fair_ordering_alternates_owners(tmp_path):
+    service = JobService(str(tmp_path), cores=8, memory_gb=16.0, max_jobs=1, poll_interval=0)
+    service.mp_context = FakeContext()
+    for name in ("a1", "a2", "a3"):
+        submit(service, name, owner="alice")
+    submit(service, "b1", owner="bob")
+    order = []
+    while True:
+        service.step()
+        if not service.running:
+            break
+        [name] = service.running
+        order.append(name)
+        finish(service, name)
+        service.reap_jobs()
+    # 最久沒有開始工作的提交者優先，bob 不必等 alice 較早提交的工作全部完成
+    assert order == ["a1", "b1", "a2", "a3"]
+
+
+def test_invalid_job_is_marked_failed(service):
+    write_json(os.path.join(service.incoming_dir, "bad.json"), {"config": {}, "stages": ["mesh"]})
+    service.step()
+    status = JobFiles(os.path.join(service.jobs_dir, "bad")).read_status()
+    assert status["state"] == "failed"
+    assert not service.running
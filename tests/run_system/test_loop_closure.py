@@ -0,0 +1,47 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from loop_closure import (unpack_descriptors, hamming_distances, train_vocabulary, bow_histograms,
+                          select_loop_closure_candidates)
+
+CONFIG = {"loop_closure_candidates": 1, "loop_closure_min_score": 0.5}
+
+
+def random_descriptors(rng, n):
+    return rng.integers(0, 256, size=(n, 32), dtype=np.uint8)
+
+
+def test_hamming_distances_match_bit_counts():
+    rng = np.random.default_rng(0)
+    a = random_descriptors(rng, 5)
+    b = random_descriptors(rng, 3)
+    expected = np.array([[np.unpackbits(x ^ y).sum() for y in b] for x in a])
+    np.testing.assert_allclose(hamming_distances(unpack_descriptors(a), unpack_descriptors(b)), expected)
+
+
+def test_candidates_keep_neighbours_and_similar_keyframes():
+    rng = np.random.default_rng(0)
+    # 關鍵幀 0 與 15 看到同一個場景，其餘關鍵幀各看到不同的場景
+    scenes = [random_descriptors(rng, 40) for _ in range(3)]
+    descriptor_sets = [unpack_descriptors(d) for d in (scenes[0], scenes[1], scenes[2], scenes[0])]
+    words = train_vocabulary(np.concatenate(descriptor_sets), 16)
+    histograms = bow_histograms(descriptor_sets, words)
+    keyframes = [0, 5, 10, 15]
+    candidates = select_loop_closure_candidates(keyframes, histograms, CONFIG)
+    # 相鄰關鍵幀一律保留，另外只保留看到同一場景的 (0, 15)
+    assert candidates == {(0, 5), (5, 10), (10, 15), (0, 15)}
+
+
+def test_min_score_filters_dissimilar_keyframes():
+    histograms = np.identity(3)
+    candidates = select_loop_closure_candidates([0, 5, 10], histograms, CONFIG)
+    assert candidates == {(0, 5), (5, 10)}
+
+
+def test_keyframes_without_features_have_empty_histograms():
+    rng = np.random.default_rng(0)
+    bits = unpack_descriptors(random_descriptors(rng, 20))
+    words = train_vocabulary(bits, 4)
+    histograms = bow_histograms([bits, None], words)
+    assert np.linalg.norm(histograms[1]) == 0.0
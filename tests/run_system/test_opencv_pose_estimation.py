@@ -0,0 +1,26 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("cv2")
+pytest.importorskip("matplotlib")
+
+from opencv_pose_estimation import get_xyz_from_pts, get_xyz_from_pts_array
+
+
+def test_array_lookup_matches_per_point_lookup():
+    rng = np.random.default_rng(0)
+    depth = rng.uniform(0.5, 3.0, size=(48, 64))
+    # 包含影像內部、邊界上與影像外的點
+    pts = np.concatenate([
+        rng.uniform([1.0, 1.0], [62.0, 46.0], size=(200, 2)),
+        [[0.0, 10.0], [10.0, 0.0], [63.0, 10.0], [10.0, 47.0], [62.5, 46.5], [-3.0, 5.0], [70.0, 5.0]],
+    ])
+    expected = np.array([get_xyz_from_pts(row, depth, 31.5, 23.5, 50.0) for row in pts]).T
+    np.testing.assert_allclose(get_xyz_from_pts_array(pts, depth, 31.5, 23.5, 50.0), expected)
+
+
+def test_array_lookup_handles_zero_focal_and_empty_input():
+    depth = np.full((10, 10), 2.0)
+    xyz = get_xyz_from_pts_array([[4.5, 5.5]], depth, 5.0, 5.0, 0)
+    np.testing.assert_allclose(xyz[:, 0], get_xyz_from_pts([4.5, 5.5], depth, 5.0, 5.0, 0))
+    assert get_xyz_from_pts_array(np.zeros((0, 2)), depth, 5.0, 5.0, 50.0).shape == (3, 0)
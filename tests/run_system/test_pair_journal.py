@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from pair_journal import PairJournal, input_fingerprint
+
+
+def pair_result(seed):
+    rng = np.random.default_rng(seed)
+    return bool(seed % 2 == 0), rng.normal(size=(4, 4)), rng.normal(size=(6, 6))
+
+
+def write_journal(filename, fingerprint, pairs):
+    journal = PairJournal(filename, fingerprint)
+    for s, t in pairs:
+        journal.append(s, t, *pair_result(s * 100 + t))
+    journal.close()
+
+
+def assert_result_equal(actual, expected):
+    assert actual[0] == expected[0]
+    np.testing.assert_allclose(actual[1], expected[1])
+    np.testing.assert_allclose(actual[2], expected[2])
+
+
+def test_resume_reads_recorded_pairs(tmp_path):
+    filename = str(tmp_path / "journal.jsonl")
+    write_journal(filename, "a", [(0, 1), (0, 2), (1, 2)])
+    journal = PairJournal(filename, "a")
+    assert len(journal) == 3
+    assert (0, 2) in journal and (2, 3) not in journal
+    assert_result_equal(journal.get(0, 2), pair_result(2))
+    journal.close()
+
+
+def test_fingerprint_change_starts_a_new_journal(tmp_path):
+    filename = str(tmp_path / "journal.jsonl")
+    write_journal(filename, "a", [(0, 1)])
+    journal = PairJournal(filename, "b")
+    assert len(journal) == 0
+    journal.close()
+    assert len(PairJournal(filename, "a")) == 0
+
+
+def test_truncated_line_is_dropped_and_later_entries_survive(tmp_path):
+    filename = str(tmp_path / "journal.jsonl")
+    write_journal(filename, "a", [(0, 1), (0, 2)])
+    # 模擬寫入最後一筆時中斷
+    with open(filename, 'rb+') as f:
+        f.truncate(os.path.getsize(filename) - 25)
+    journal = PairJournal(filename, "a")
+    assert list(journal.results) == [(0, 1)]
+    journal.append(0, 2, *pair_result(2))
+    journal.append(1, 2, *pair_result(102))
+    journal.close()
+    # 再次中斷後接續時，截斷後附加的紀錄都必須可讀
+    journal = PairJournal(filename, "a")
+    assert sorted(journal.results) == [(0, 1), (0, 2), (1, 2)]
+    assert_result_equal(journal.get(1, 2), pair_result(102))
+    journal.close()
+
+
+def test_input_fingerprint_tracks_files_and_config(tmp_path):
+    name = tmp_path / "fragment_000.ply"
+    name.write_bytes(b"points")
+    config = {"voxel_size": 0.05}
+    fingerprint = input_fingerprint([str(name)], config, ["voxel_size"])
+    assert fingerprint == input_fingerprint([str(name)], config, ["voxel_size"])
+    assert fingerprint != input_fingerprint([str(name)], {"voxel_size": 0.03}, ["voxel_size"])
+    assert fingerprint != input_fingerprint([str(name)], config, ["voxel_size"], [np.identity(4)])
+    name.write_bytes(b"more points")
+    assert fingerprint != input_fingerprint([str(name)], config, ["voxel_size"])
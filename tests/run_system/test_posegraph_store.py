@@ -0,0 +1,116 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+o3d = pytest.importorskip("open3d")
+
+from fragment_table import write_fragment_table
+from posegraph_store import (compose_trajectory, npz_name, read_global_trajectory, read_node_poses,
+                             read_pose_graph, write_pose_graph)
+
+CONFIG = {
+    "export_json_pose_graphs": False,
+    "export_trajectory_log": True,
+    "template_fragment_table": "fragment_table.json",
+    "template_refined_posegraph_optimized": "refined_registration_optimized.json",
+    "template_fragment_posegraph_optimized": "fragment_optimized_%03d.json",
+    "template_global_trajectory": "trajectory.npz",
+    "template_global_traj": "trajectory.log",
+}
+
+
+def random_pose(rng):
+    pose = np.identity(4)
+    pose[:3, :3] = o3d.geometry.get_rotation_matrix_from_xyz(rng.uniform(-np.pi, np.pi, 3))
+    pose[:3, 3] = rng.normal(size=3)
+    return pose
+
+
+def random_pose_graph(seed, n_nodes=5):
+    rng = np.random.default_rng(seed)
+    pose_graph = o3d.pipelines.registration.PoseGraph()
+    for _ in range(n_nodes):
+        pose_graph.nodes.append(o3d.pipelines.registration.PoseGraphNode(random_pose(rng)))
+    for s, t in [(0, 1), (1, 2), (0, 3), (2, 4)]:
+        information = rng.normal(size=(6, 6))
+        pose_graph.edges.append(o3d.pipelines.registration.PoseGraphEdge(
+            s, t, random_pose(rng), information @ information.T, uncertain=t != s + 1,
+            confidence=rng.uniform()))
+    return pose_graph
+
+
+def assert_pose_graph_equal(actual, expected):
+    assert len(actual.nodes) == len(expected.nodes)
+    assert len(actual.edges) == len(expected.edges)
+    for a, b in zip(actual.nodes, expected.nodes):
+        np.testing.assert_array_equal(a.pose, b.pose)
+    for a, b in zip(actual.edges, expected.edges):
+        assert (a.source_node_id, a.target_node_id) == (b.source_node_id, b.target_node_id)
+        assert a.uncertain == b.uncertain
+        assert a.confidence == b.confidence
+        np.testing.assert_array_equal(a.transformation, b.transformation)
+        np.testing.assert_array_equal(a.information, b.information)
+
+
+def test_npz_round_trip(tmp_path):
+    filename = str(tmp_path / "posegraph.json")
+    pose_graph = random_pose_graph(0)
+    write_pose_graph(filename, pose_graph, CONFIG)
+    assert os.path.isfile(npz_name(filename)) and not os.path.isfile(filename)
+    assert_pose_graph_equal(read_pose_graph(filename), pose_graph)
+    np.testing.assert_array_equal(read_node_poses(filename), [node.pose for node in pose_graph.nodes])
+
+
+def test_empty_pose_graph_round_trip(tmp_path):
+    filename = str(tmp_path / "posegraph.json")
+    write_pose_graph(filename, o3d.pipelines.registration.PoseGraph(), CONFIG)
+    pose_graph = read_pose_graph(filename)
+    assert len(pose_graph.nodes) == 0 and len(pose_graph.edges) == 0
+    assert read_node_poses(filename).shape == (0, 4, 4)
+
+
+def test_json_export_and_fallback(tmp_path):
+    filename = str(tmp_path / "posegraph.json")
+    pose_graph = random_pose_graph(1)
+    write_pose_graph(filename, pose_graph, dict(CONFIG, export_json_pose_graphs=True))
+    # 沒有二進位檔時改讀 Open3D JSON，例如舊版流程產生的資料
+    os.remove(npz_name(filename))
+    json_graph = read_pose_graph(filename)
+    assert len(json_graph.edges) == len(pose_graph.edges)
+    np.testing.assert_allclose(read_node_poses(filename), [node.pose for node in pose_graph.nodes])
+
+
+def test_compose_trajectory_follows_the_fragment_table(tmp_path):
+    config = dict(CONFIG, path_dataset=str(tmp_path))
+    table = [(0, 3), (3, 5), (5, 9)]
+    write_fragment_table(config, table)
+    rng = np.random.default_rng(2)
+    fragment_poses = np.array([random_pose(rng) for _ in table])
+    local_poses = [np.array([random_pose(rng) for _ in range(eid - sid)]) for sid, eid in table]
+    frame_ids, fragment_ids, poses = compose_trajectory(fragment_poses, local_poses, config)
+    np.testing.assert_array_equal(frame_ids, np.arange(9))
+    np.testing.assert_array_equal(fragment_ids, [0, 0, 0, 1, 1, 2, 2, 2, 2])
+    for frame_id, fragment_id, pose in zip(frame_ids, fragment_ids, poses):
+        sid = table[fragment_id][0]
+        np.testing.assert_allclose(pose, fragment_poses[fragment_id] @ local_poses[fragment_id][frame_id - sid])
+
+
+def test_global_trajectory_is_built_from_the_pose_graphs(tmp_path):
+    config = dict(CONFIG, path_dataset=str(tmp_path))
+    table = [(0, 5), (5, 10)]
+    write_fragment_table(config, table)
+    scene = random_pose_graph(3, n_nodes=2)
+    scene.edges.clear()
+    write_pose_graph(str(tmp_path / config["template_refined_posegraph_optimized"]), scene, config)
+    fragments = [random_pose_graph(4 + i) for i in range(len(table))]
+    for i, fragment in enumerate(fragments):
+        write_pose_graph(str(tmp_path / (config["template_fragment_posegraph_optimized"] % i)), fragment, config)
+    frame_ids, fragment_ids, poses = read_global_trajectory(str(tmp_path), config)
+    assert os.path.isfile(tmp_path / config["template_global_trajectory"])
+    assert os.path.isfile(tmp_path / config["template_global_traj"])
+    np.testing.assert_allclose(poses[7], scene.nodes[1].pose @ fragments[1].nodes[2].pose)
+    # 第二次讀取直接使用寫出的軌跡
+    again = read_global_trajectory(str(tmp_path), config)
+    np.testing.assert_array_equal(again[0], frame_ids)
+    np.testing.assert_array_equal(again[2], poses)
@@ -0,0 +1,87 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+o3d = pytest.importorskip("open3d")
+
+from refine_registration import multiscale_icp
+
+VOXEL_SIZES = [0.05, 0.025, 0.0125]
+MAX_ITER = [50, 30, 14]
+CONFIG = {
+    "voxel_size": VOXEL_SIZES[0],
+    "icp_method": "point_to_plane",
+    "icp_adaptive": True,
+    "icp_converged_fitness": 1e-4,
+    "icp_converged_rmse": 1e-5,
+    "icp_skip_fitness": 1e-3,
+    "icp_skip_rmse": 1e-4,
+    "debug_mode": False,
+}
+
+
+def surface():
+    # 起伏的彩色曲面，各方向都有可供對齊的幾何
+    x, y = np.meshgrid(np.linspace(-1, 1, 201), np.linspace(-1, 1, 201))
+    z = 0.15 * np.sin(3 * x) * np.cos(2 * y) + 0.1 * x * y
+    points = np.stack([x.ravel(), y.ravel(), z.ravel()], axis=1)
+    pcd = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
+    colors = np.stack([(z.ravel() + 0.3) / 0.6, (x.ravel() + 1) / 2, (y.ravel() + 1) / 2], axis=1)
+    pcd.colors = o3d.utility.Vector3dVector(np.clip(colors, 0, 1))
+    return pcd
+
+
+def levels(pcd):
+    return [pcd.voxel_down_sample(v) for v in VOXEL_SIZES]
+
+
+def offset():
+    transformation = np.identity(4)
+    transformation[:3, :3] = o3d.geometry.get_rotation_matrix_from_xyz([0.0, 0.0, np.radians(2.0)])
+    transformation[:3, 3] = [0.02, -0.01, 0.0]
+    return transformation
+
+
+def run(source, target, **overrides):
+    stats = {}
+    transformation, information = multiscale_icp(
+        levels(source), levels(target), VOXEL_SIZES, MAX_ITER, dict(CONFIG, **overrides),
+        np.identity(4), stats=stats)
+    return transformation, information, stats
+
+
+def test_converged_coarse_scale_skips_finer_scales():
+    _, information, stats = run(surface(), surface())
+    assert stats["scales_run"] == 1
+    assert stats["n_scales"] == 3
+    # 略過尺度時資訊矩陣仍在最精細的尺度上計算
+    _, full_information, _ = run(surface(), surface(), icp_skip_fitness=0.0, icp_skip_rmse=0.0)
+    np.testing.assert_allclose(information, full_information)
+
+
+def test_zero_skip_thresholds_run_every_scale():
+    _, _, stats = run(surface(), surface(), icp_skip_fitness=0.0, icp_skip_rmse=0.0)
+    assert stats["scales_run"] == 3
+
+
+@pytest.mark.parametrize("icp_method", ["point_to_plane", "color"])
+def test_adaptive_icp_recovers_the_offset(icp_method):
+    source = surface()
+    source.transform(np.linalg.inv(offset()))
+    transformation, _, stats = run(source, surface(), icp_method=icp_method)
+    # 粗尺度有明顯改善，不會只執行一個尺度
+    assert stats["scales_run"] > 1
+    np.testing.assert_allclose(transformation, offset(), atol=2e-3)
+    legacy, _, _ = run(source, surface(), icp_method=icp_method, icp_adaptive=False)
+    np.testing.assert_allclose(transformation, legacy, atol=2e-3)
+
+
+def test_partial_overlap_restricts_finer_scales_to_the_coarse_correspondences():
+    # 來源與目標只有中間一段重疊，較細的尺度只使用重疊區附近的來源點
+    full = surface()
+    points = np.asarray(full.points)
+    source = full.select_by_index(np.flatnonzero(points[:, 0] < 0.3).tolist())
+    target = full.select_by_index(np.flatnonzero(points[:, 0] > -0.3).tolist())
+    source.transform(np.linalg.inv(offset()))
+    transformation, _, stats = run(source, target, icp_skip_fitness=0.0, icp_skip_rmse=0.0)
+    assert stats["scales_run"] == 3
+    np.testing.assert_allclose(transformation, offset(), atol=2e-3)
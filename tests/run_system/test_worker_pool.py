@@ -0,0 +1,142 @@
+import os
+import pickle
+
+import pytest
+
+pytest.importorskip("psutil")
+
+import worker_pool
+from worker_pool import WorkerPool, schedule_by_cost
+
+MB = 1024 ** 2
+
+
+def pop_all(scheduled):
+    order = []
+    while scheduled:
+        order.append(scheduled.pop())
+    return order
+
+
+def test_schedule_by_cost_pops_most_expensive_first():
+    args = ["a", "b", "c", "d"]
+    assert pop_all(schedule_by_cost(args, [1.0, 5.0, 3.0, 2.0])) == ["b", "c", "d", "a"]
+
+
+def test_schedule_by_cost_keeps_order_for_ties_and_without_costs():
+    args = ["a", "b", "c", "d"]
+    assert pop_all(schedule_by_cost(args, [1.0, 2.0, 2.0, 1.0])) == ["b", "c", "a", "d"]
+    assert pop_all(schedule_by_cost(args)) == args
+
+
+def test_schedule_by_cost_compares_tuples():
+    # make_fragments 先依片段順序、再依幀對成本排序
+    args = [(0, "odometry"), (0, "loop"), (1, "loop")]
+    costs = [(2, 1.0), (2, 3.0), (1, 3.0)]
+    assert pop_all(schedule_by_cost(args, costs)) == [(0, "loop"), (0, "odometry"), (1, "loop")]
+
+
+class InlinePool:
+    """
+    在 apply_async 內直接執行工作的行程池替身，記錄每次派送後（含該工作）的預留記憶體。
+    """
+    def __init__(self, owner):
+        self.owner = owner
+        self.reserved_at_dispatch = []
+
+    def apply_async(self, function, args, callback=None, error_callback=None):
+        self.reserved_at_dispatch.append(self.owner._reserved)
+        task, task_args = pickle.loads(args[0])
+        try:
+            value = task(*task_args)
+        except Exception as e:
+            error_callback(e)
+        else:
+            callback((value, 0))
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class Messages:
+    def __init__(self):
+        self.messages = []
+
+    def put(self, message):
+        self.messages.append(message)
+
+
+def identity(value):
+    return value
+
+
+def fail_on(value, bad):
+    if value == bad:
+        raise ValueError(value)
+    return value
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    def start(self, processes, threads):
+        self.processes = processes
+        self.threads = threads
+        self.worker_threads = [threads]
+        self.startup_time = 0.0
+        self.pool = InlinePool(self)
+
+    monkeypatch.setattr(WorkerPool, "_start", start)
+    config = {"memory_budget_gb": 250 * MB / worker_pool.GB}
+    pool = WorkerPool(4, {"config": config, "stop_event": None, "message_queue": Messages()})
+    pool.begin_stage("test")
+    return pool
+
+
+def test_admission_keeps_reserved_memory_within_budget(pool):
+    results = list(pool.imap_unordered(identity, [(i,) for i in range(6)], memory=[100 * MB] * 6))
+    assert sorted(results) == list(range(6))
+    # 預算 250 MB 內最多同時執行兩個 100 MB 的工作
+    assert max(pool.pool.reserved_at_dispatch) == 200 * MB
+    assert pool.stats.peak_reserved <= pool.stats.memory_budget
+    assert pool._reserved == 0
+
+
+def test_task_larger_than_budget_runs_alone(pool):
+    assert list(pool.imap_unordered(identity, [(1,)], memory=[400 * MB])) == [1]
+    assert pool.pool.reserved_at_dispatch == [400 * MB]
+    assert pool._reserved == 0
+
+
+def test_failed_task_releases_all_reservations(pool):
+    with pytest.raises(ValueError):
+        list(pool.imap_unordered(fail_on, [(i, 0) for i in range(4)], memory=[50 * MB] * 4))
+    assert pool._reserved == 0
+
+
+def test_closing_stream_early_releases_all_reservations(pool):
+    stream = pool.imap_unordered(identity, [(i,) for i in range(4)], memory=[50 * MB] * 4)
+    next(stream)
+    stream.close()
+    assert pool._reserved == 0
+
+
+def test_thread_environment_is_restored(monkeypatch):
+    monkeypatch.setenv("OMP_NUM_THREADS", "7")
+    monkeypatch.delenv("MKL_NUM_THREADS", raising=False)
+    with worker_pool.thread_environment(2):
+        assert [os.environ[name] for name in worker_pool.THREAD_VARIABLES] == ["2", "2", "2"]
+    assert os.environ["OMP_NUM_THREADS"] == "7"
+    assert "MKL_NUM_THREADS" not in os.environ
+
+
+def test_plan_stage_restarts_when_process_count_changes(pool, monkeypatch):
+    # 執行緒數相同但行程數不同時，計畫的行程數也必須實際生效
+    monkeypatch.setattr(worker_pool, "plan_parallelism", lambda n_tasks, config: (2, pool.threads))
+    first = pool.pool
+    assert pool.plan_stage(2) == (2, pool.threads)
+    assert pool.processes == 2
+    assert pool.pool is not first
+    assert "restarted" in pool.shared["message_queue"].messages[-1]